@@ -0,0 +1,54 @@
+"""Measure cache hit latency against output size.
+
+    python benchmarks/bench_hit.py
+    python benchmarks/bench_hit.py --sizes 0,1M --repeat 20 --json
+
+The command is `head -c SIZE /dev/zero`, cached once and then replayed by a
+fresh `bincache` process per run with its output read through a pipe. Cases:
+`bincache` (the whole hit, interpreter start included), `direct` (the command
+itself), `python` (the bare interpreter start, the floor of any hit), and
+`lookup` (key computation and opening the entry in this process, no replay).
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+from common import (add_common_arguments, parse_sizes, measure, use_cache_dir, bincache_command, run_quietly,
+                    subprocess_env, report)
+
+DEFAULT_SIZES = "0,4K,1M,64M"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f"comma separated output sizes, default {DEFAULT_SIZES}")
+    parser.add_argument('--conf', default="", help="bincache.conf contents, e.g. 'compression = zstd'")
+    add_common_arguments(parser, repeat=10)
+    options = parser.parse_args()
+
+    from bincache.cli import lookup
+    results = []
+    with tempfile.TemporaryDirectory(dir=options.dir) as directory:
+        use_cache_dir(os.path.join(directory, 'cache'), options.conf.replace('\\n', '\n'))
+        os.environ.update(subprocess_env())
+        results.append(dict({'benchmark': 'hit', 'case': 'python', 'size': 0},
+                            **measure(lambda: run_quietly([sys.executable, '-c', 'pass']), options.repeat)))
+        for size in parse_sizes(options.sizes):
+            argv = ['head', '-c', str(size), '/dev/zero']
+            run_quietly(bincache_command(*argv))
+
+            def open_and_close():
+                key, entry = lookup(argv)
+                if entry is None:
+                    raise RuntimeError(f"{argv} was not cached")
+                entry['file'].close()
+
+            cases = [('bincache', lambda: run_quietly(bincache_command(*argv))),
+                     ('direct', lambda: run_quietly(argv)),
+                     ('lookup', open_and_close)]
+            for case, fn in cases:
+                results.append(dict({'benchmark': 'hit', 'case': case, 'size': size}, **measure(fn, options.repeat)))
+    report(results, options, ['case', 'size'])
+
+if __name__ == "__main__":
+    main()
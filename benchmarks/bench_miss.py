@@ -0,0 +1,53 @@
+"""Measure the overhead bincache adds to a cache miss.
+
+    python benchmarks/bench_miss.py
+    python benchmarks/bench_miss.py --sizes 0,16M --repeat 10 --json
+
+The command is `head -c SIZE /dev/zero`, its entry is removed before every
+run so each one is a miss that computes the key, runs the command, streams its
+output and stores the entry. Cases: `bincache`, `direct` (the command alone)
+and `overhead`, the difference of their medians.
+"""
+import os
+import argparse
+import tempfile
+
+from common import (add_common_arguments, parse_sizes, measure, use_cache_dir, bincache_command, run_quietly,
+                    subprocess_env, report)
+
+DEFAULT_SIZES = "0,1M,64M"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f"comma separated output sizes, default {DEFAULT_SIZES}")
+    parser.add_argument('--conf', default="", help="bincache.conf contents, e.g. 'compression = zstd'")
+    add_common_arguments(parser, repeat=10)
+    options = parser.parse_args()
+
+    from bincache.cli import get_cache_key
+    from bincache.cache import get_cache_file_path
+    results = []
+    with tempfile.TemporaryDirectory(dir=options.dir) as directory:
+        use_cache_dir(os.path.join(directory, 'cache'), options.conf.replace('\\n', '\n'))
+        os.environ.update(subprocess_env())
+        for size in parse_sizes(options.sizes):
+            argv = ['head', '-c', str(size), '/dev/zero']
+            entry_path = get_cache_file_path(get_cache_key(argv))
+            # memos of head and its libraries are written by the first run, as on any real machine
+            run_quietly(bincache_command(*argv))
+
+            def remove_entry():
+                if os.path.exists(entry_path):
+                    os.remove(entry_path)
+
+            miss = measure(lambda: run_quietly(bincache_command(*argv)), options.repeat, remove_entry)
+            if not os.path.exists(entry_path):
+                raise RuntimeError(f"{argv} was not cached")
+            direct = measure(lambda: run_quietly(argv), options.repeat)
+            overhead = {name: miss[name] - direct[name] for name in ('min', 'median', 'mean')}
+            for case, timings in (('bincache', miss), ('direct', direct), ('overhead', dict(overhead, repeat=options.repeat))):
+                results.append(dict({'benchmark': 'miss', 'case': case, 'size': size}, **timings))
+    report(results, options, ['case', 'size'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Measure generate_signature against the number and size of a binary's libraries.
+
+    python benchmarks/bench_signature.py
+    python benchmarks/bench_signature.py --libs 1,100 --lib-sizes 1M --json
+
+A synthetic program linked against LIBS shared libraries of LIB_SIZE bytes each
+is compiled with the C compiler. Cases: `cold`, with the memos removed before
+every run so the binary and its libraries are resolved and hashed, and `warm`,
+where the memos answer and only stat calls are left.
+"""
+import os
+import sys
+import argparse
+import tempfile
+
+from common import add_common_arguments, parse_sizes, parse_counts, measure, use_cache_dir, clear_memos, build_binary, report
+
+DEFAULT_LIBS = "1,10,50"
+DEFAULT_LIB_SIZES = "64K,4M"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--libs', default=DEFAULT_LIBS, help=f"comma separated library counts, default {DEFAULT_LIBS}")
+    parser.add_argument('--lib-sizes', default=DEFAULT_LIB_SIZES,
+                        help=f"comma separated library sizes, default {DEFAULT_LIB_SIZES}")
+    parser.add_argument('--conf', default="", help="bincache.conf contents, e.g. 'hash_algorithm = xxh3'")
+    add_common_arguments(parser)
+    options = parser.parse_args()
+
+    from bincache.signature import generate_signature
+    results = []
+    with tempfile.TemporaryDirectory(dir=options.dir) as directory:
+        cache_dir = os.path.join(directory, 'cache')
+        use_cache_dir(cache_dir, options.conf.replace('\\n', '\n'))
+        for lib_size in parse_sizes(options.lib_sizes):
+            for lib_count in parse_counts(options.libs):
+                binary = build_binary(os.path.join(directory, f"build-{lib_count}-{lib_size}"), lib_count, lib_size)
+                if binary is None:
+                    sys.exit("bench_signature.py needs a C compiler (cc or gcc) to build the synthetic binaries")
+
+                def sign():
+                    if generate_signature(binary, ['--flag']) is None:
+                        raise RuntimeError(f"{binary} got no signature")
+
+                params = {'benchmark': 'signature', 'libs': lib_count, 'lib_size': lib_size}
+                results.append(dict(params, case='cold', **measure(sign, options.repeat, lambda: clear_memos(cache_dir))))
+                sign()
+                results.append(dict(params, case='warm', **measure(sign, options.repeat)))
+    report(results, options, ['case', 'libs', 'lib_size'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Measure trim_cache_dir_to_limit on caches of many entries.
+
+    python benchmarks/bench_trim.py
+    python benchmarks/bench_trim.py --counts 10k --repeat 5 --json
+
+A cache of COUNT synthetic entries of ENTRY_SIZE bytes, with increasing
+mtimes, is trimmed down to FRACTION of its size; the evicted entries are put
+back between runs. Cases: `scan`, without a ledger, so the size comes from a
+full scan of the cache directory; `ledger`, with a current ledger; `index`,
+with metadata_index on and its index in sync. A million entries of the default
+size take about 4G of disk, mostly in filesystem blocks; use --dir to put
+them somewhere with room.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from common import add_common_arguments, parse_size, parse_counts, measure, use_cache_dir, report
+
+DEFAULT_COUNTS = "10k,100k,1M"
+MODES = ('scan', 'ledger', 'index')
+
+def make_entries(cache_dir, count, entry_size):
+    """write count entries, return their (path, mtime), oldest first."""
+    from bincache.cache import pack_entry_header, get_entry_path, ENTRY_HEADER
+    from bincache.signature import blake2b
+    data = pack_entry_header(0, 0, entry_size - ENTRY_HEADER.size, 0) + b'x' * (entry_size - ENTRY_HEADER.size)
+    base = 1_000_000_000
+    entries = []
+    for i in range(count):
+        path = get_entry_path(cache_dir, blake2b(i.to_bytes(8, 'little'), digest_size=16).hexdigest())
+        entries.append((path, base + i))
+    for path, mtime in entries:
+        write_entry(path, data, mtime)
+    return entries, data
+
+def write_entry(path, data, mtime):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.utime(path, (mtime, mtime))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--counts', default=DEFAULT_COUNTS, help=f"comma separated entry counts, default {DEFAULT_COUNTS}")
+    parser.add_argument('--entry-size', default="256", help="size of every entry, default 256")
+    parser.add_argument('--fraction', type=float, default=0.9, help="size to trim down to, default 0.9")
+    parser.add_argument('--modes', default=','.join(MODES), help=f"comma separated cases, default {','.join(MODES)}")
+    add_common_arguments(parser, repeat=3)
+    options = parser.parse_args()
+
+    from bincache import cache
+    from bincache import config
+    entry_size = parse_size(options.entry_size)
+    results = []
+    with tempfile.TemporaryDirectory(dir=options.dir) as directory:
+        for count in parse_counts(options.counts):
+            for mode in options.modes.split(','):
+                if mode not in MODES:
+                    sys.exit(f"unknown mode {mode}, expected one of {', '.join(MODES)}")
+                cache_dir = os.path.join(directory, f"cache-{count}-{mode}")
+                use_cache_dir(cache_dir, "metadata_index = true\n" if mode == 'index' else "")
+                entries, data = make_entries(cache_dir, count, entry_size)
+                limit = int(cache.get_cache_size(cache_dir) * options.fraction)
+                ledger_path = os.path.join(cache_dir, cache.LEDGER_FILE)
+
+                def setup():
+                    for path, mtime in entries:
+                        if not os.path.exists(path):
+                            write_entry(path, data, mtime)
+                    os.remove(ledger_path)
+                    if mode != 'scan':
+                        # rebuilds the ledger and syncs the index with what was put back
+                        cache.get_cache_size(cache_dir)
+
+                def trim():
+                    cache.trim_cache_dir_to_limit(cache_dir, limit)
+
+                timings = measure(trim, options.repeat, setup)
+                if cache.get_cache_size(cache_dir) > limit:
+                    raise RuntimeError(f"{cache_dir} was not trimmed")
+                results.append(dict({'benchmark': 'trim', 'case': mode, 'entries': count, 'entry_size': entry_size},
+                                    **timings))
+                config._config = None
+                shutil.rmtree(cache_dir)
+    report(results, options, ['case', 'entries'])
+
+if __name__ == "__main__":
+    main()
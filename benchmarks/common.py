@@ -0,0 +1,131 @@
+"""Helpers shared by the benchmarks: isolated cache directories, synthetic binaries and result output."""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bincache import config
+from bincache import signature
+from bincache.config import parse_size
+
+# fields of a result that are measurements, everything else identifies the case
+MEASUREMENTS = ('min', 'median', 'mean', 'seconds', 'mib_per_second', 'repeat')
+
+def parse_sizes(text):
+    return [parse_size(s) for s in text.split(',')]
+
+def parse_counts(text):
+    """'10k,1M' -> [10000, 1000000], decimal unlike sizes."""
+    counts = []
+    for s in text.split(','):
+        s = s.strip().lower()
+        scale = {'k': 10**3, 'm': 10**6}.get(s[-1:], 1)
+        counts.append(int(float(s[:-1] if scale != 1 else s) * scale))
+    return counts
+
+def add_common_arguments(parser, repeat=5):
+    parser.add_argument('--repeat', type=int, default=repeat, help=f"runs per case, default {repeat}")
+    parser.add_argument('--dir', default=None, help="directory for the synthetic binaries and caches")
+    parser.add_argument('--json', action='store_true', help="print one JSON object per case")
+
+def measure(fn, repeat, setup=None):
+    """return min, median and mean seconds of repeat calls of fn, setup runs untimed before each."""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {'min': samples[0], 'median': samples[len(samples) // 2], 'mean': sum(samples) / len(samples),
+            'repeat': repeat}
+
+def use_cache_dir(cache_dir, conf=""):
+    """point bincache, in this process and the ones it starts, at a fresh cache_dir configured with conf."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, config.CONFIG_FILE), 'w') as f:
+        f.write(conf)
+    os.environ['BINCACHE_DIR'] = cache_dir
+    config._config = None
+    signature._memos.clear()
+
+def clear_memos(cache_dir):
+    shutil.rmtree(os.path.join(cache_dir, signature.MEMO_DIR), ignore_errors=True)
+    signature._memos.clear()
+
+def bincache_command(*argv):
+    return [sys.executable, '-m', 'bincache.cli', *argv]
+
+def run_quietly(argv):
+    """run argv with its output read through a pipe, like a caller capturing it would."""
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    while process.stdout.read(1024 * 1024):
+        pass
+    process.stdout.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"{argv} exited with {process.returncode}")
+
+def subprocess_env():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('BINCACHE_PROFILE', None)
+    return env
+
+def build_binary(directory, lib_count, lib_size):
+    """compile a program linked against lib_count shared libraries of about lib_size bytes each.
+
+    return its path, None if there is no C compiler.
+    """
+    compiler = shutil.which('cc') or shutil.which('gcc')
+    if compiler is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    libs = []
+    for i in range(lib_count):
+        source = os.path.join(directory, f"synth{i}.c")
+        with open(source, 'w') as f:
+            # initialized data is stored in the file, a single non-zero byte keeps it out of .bss
+            f.write(f"char synth_pad_{i}[{max(lib_size, 1)}] = {{1}};\nint synth_{i}(void) {{ return {i}; }}\n")
+        subprocess.run([compiler, '-shared', '-fPIC', '-o', os.path.join(directory, f"libsynth{i}.so"), source],
+                       check=True)
+        libs.append(f"-lsynth{i}")
+    source = os.path.join(directory, "main.c")
+    with open(source, 'w') as f:
+        f.write("int main(void) { return 0; }\n")
+    binary = os.path.join(directory, "synth")
+    subprocess.run([compiler, '-o', binary, source, f"-L{directory}", '-Wl,--no-as-needed', *libs,
+                    '-Wl,-rpath,$ORIGIN'], check=True)
+    # files changed in the last couple of seconds are never memoized, see signature.RACY_WINDOW_NS
+    past = time.time() - 60
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name), (past, past))
+    return binary
+
+def run_info():
+    """where the results come from, so runs of different commits can be told apart."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine()}
+
+def report(results, options, columns):
+    """print results as JSON lines with --json, else as a table of columns and the timings in milliseconds."""
+    if options.json:
+        info = run_info()
+        for result in results:
+            print(json.dumps(dict(result, **info)))
+        return
+    header = [f"{column:>12}" for column in columns] + [f"{name + ' ms':>12}" for name in ('min', 'median', 'mean')]
+    print(' '.join(header))
+    for result in results:
+        row = [f"{str(result.get(column, '')):>12}" for column in columns]
+        row += [f"{result[name] * 1000:>12.3f}" for name in ('min', 'median', 'mean')]
+        print(' '.join(row))
@@ -0,0 +1,57 @@
+"""Compare two benchmark runs saved with --json.
+
+    python benchmarks/bench_hit.py --json > before.jsonl
+    (check out the other commit)
+    python benchmarks/bench_hit.py --json > after.jsonl
+    python benchmarks/compare.py before.jsonl after.jsonl --threshold 10
+
+Cases are matched on every field that isn't a measurement or about the run,
+and their medians (the best time for bench_hash.py results) compared. The
+exit status is 1 if any case got slower by more than the threshold percent.
+"""
+import sys
+import json
+import argparse
+
+from common import MEASUREMENTS
+
+RUN_FIELDS = ('commit', 'python', 'machine')
+
+def load(path):
+    cases = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            case = tuple(sorted((name, value) for name, value in result.items()
+                                if name not in MEASUREMENTS and name not in RUN_FIELDS))
+            cases[case] = result.get('median', result.get('seconds'))
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help="percent slower that counts as a regression, default 10")
+    options = parser.parse_args()
+
+    before, after = load(options.before), load(options.after)
+    regressions = 0
+    for case in sorted(set(before) & set(after), key=repr):
+        old, new = before[case], after[case]
+        change = (new - old) / old * 100 if old > 0 else 0.0
+        flag = ''
+        # overhead cases are differences and may be near zero or negative, their percentages mean little
+        if change > options.threshold and dict(case).get('case') != 'overhead':
+            regressions += 1
+            flag = '  REGRESSION'
+        label = ' '.join(f"{name}={value}" for name, value in case)
+        print(f"{label:<60} {old * 1000:>10.3f} ms {new * 1000:>10.3f} ms {change:>+8.1f}%{flag}")
+    for name, cases in (('before', set(before) - set(after)), ('after', set(after) - set(before))):
+        for case in sorted(cases, key=repr):
+            print(f"only in {name}: {' '.join(f'{n}={v}' for n, v in case)}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
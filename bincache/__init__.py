@@ -0,0 +1,8 @@
+__all__ = ['run', 'arun', 'Result']
+
+def __getattr__(name):
+    # bincache.cli is imported on every cache hit, the library API only when it is used
+    if name in __all__:
+        from bincache import api
+        return getattr(api, name)
+    raise AttributeError(f"module 'bincache' has no attribute {name!r}")
@@ -0,0 +1,163 @@
+import time
+
+from bincache.cache import iter_entry_range, EntryWriter, acquire_key_lock, release_key_lock
+from bincache.cli import get_cache_key, exec_error, record_stats, READ_SIZE
+from bincache.batch import run_command, try_open_entry
+from bincache import logger
+
+class Result:
+    """a finished command: its returncode, stdout and stderr bytes, and whether they came from the cache."""
+    __slots__ = ('argv', 'returncode', 'stdout', 'stderr', 'cached')
+
+    def __init__(self, argv, returncode, stdout, stderr, cached):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.cached = cached
+
+    def __repr__(self):
+        return f"Result(argv={self.argv!r}, returncode={self.returncode!r}, cached={self.cached!r})"
+
+def compute_key(argv, env=None, cwd=None):
+    try:
+        return get_cache_key(argv, env, cwd)
+    except Exception as e:
+        logger.warning(f"failed to compute the cache key of {argv}: {e}")
+        return None
+
+def entry_result(argv, entry, key):
+    with entry['file'] as f:
+        stdout, stderr = (b''.join(iter_entry_range(f, *entry[name], entry.get('codec'))) for name in ('stdout', 'stderr'))
+    record_stats('hit', key, len(stdout) + len(stderr), entry.get('runtime', 0))
+    return Result(argv, entry['returncode'], stdout, stderr, True)
+
+def wait_for_key(key):
+    """take the key lock like main does; return (lock fd, None), or (None, entry) if a concurrent run cached it."""
+    try:
+        lock_fd, waited = acquire_key_lock(key)
+        # a run may also have finished between our lookup and the lock without us waiting
+        entry = try_open_entry(key, fetch=False)
+        if waited or entry is not None:
+            release_key_lock(key, lock_fd)
+            return None, entry
+        return lock_fd, None
+    except Exception:
+        return None, None
+
+def check_argv(argv):
+    argv = list(argv)
+    if not argv or not all(isinstance(arg, str) for arg in argv):
+        raise ValueError("argv must be a non-empty list of strings")
+    return argv
+
+'''
+run argv through the cache like the bincache command does and return a Result;
+env and cwd are those of the command and default to ours, output is returned
+instead of written out. Safe to call from several threads at once.
+'''
+def run(argv, env=None, cwd=None):
+    argv = check_argv(argv)
+    key = compute_key(argv, env, cwd)
+    entry = try_open_entry(key)
+    if entry is None:
+        entry = run_command(argv, key, env, cwd)
+    if 'file' in entry:
+        return entry_result(argv, entry, key)
+    with entry['stdout'] as stdout, entry['stderr'] as stderr:
+        stdout.seek(0)
+        stderr.seek(0)
+        return Result(argv, entry['returncode'], stdout.read(), stderr.read(), False)
+
+def store_output(key, outputs, returncode, runtime):
+    """store the output captured by arun as the entry of key, return whether it was cached."""
+    writer = None
+    try:
+        writer = EntryWriter(key)
+        for name in ('stdout', 'stderr'):
+            for data in outputs[name]:
+                writer.write(name, data)
+        return writer.commit(returncode, runtime)
+    except Exception:
+        if writer is not None:
+            writer.discard()
+        return False
+
+def release_abandoned(key):
+    """a done callback for a wait_for_key whose caller was cancelled, it releases what the wait got."""
+    def release(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        lock_fd, entry = future.result()
+        if entry is not None:
+            entry['file'].close()
+        try:
+            release_key_lock(key, lock_fd)
+        except Exception:
+            pass
+    return release
+
+'''
+run with an asyncio subprocess, so a single event loop can drive many commands;
+cache key lookups, lock waits, reading hits, storing entries and recording
+stats run in the loop's default executor
+'''
+async def arun(argv, env=None, cwd=None):
+    import asyncio
+    argv = check_argv(argv)
+    loop = asyncio.get_running_loop()
+    key = await loop.run_in_executor(None, compute_key, argv, env, cwd)
+    entry = await loop.run_in_executor(None, try_open_entry, key)
+    if entry is not None:
+        return await loop.run_in_executor(None, entry_result, argv, entry, key)
+    lock_fd = None
+    if key:
+        waiting = loop.run_in_executor(None, wait_for_key, key)
+        try:
+            # shielded, the thread can't be stopped and may still take the lock after a cancel
+            lock_fd, entry = await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            waiting.add_done_callback(release_abandoned(key))
+            raise
+        if entry is not None:
+            return await loop.run_in_executor(None, entry_result, argv, entry, key)
+    process = None
+    try:
+        started = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE, env=env, cwd=cwd)
+        except Exception as e:
+            returncode, message = exec_error(argv[0], e)
+            return Result(argv, returncode, b'', message.encode('utf-8'), False)
+        outputs = {'stdout': [], 'stderr': []}
+
+        async def drain(name, pipe):
+            while True:
+                data = await pipe.read(READ_SIZE)
+                if not data:
+                    return
+                outputs[name].append(data)
+
+        await asyncio.gather(drain('stdout', process.stdout), drain('stderr', process.stderr))
+        returncode = await process.wait()
+        runtime = time.monotonic() - started
+        cached = False
+        if key and returncode == 0:
+            # the output is in memory already, the entry is written from it where spilling and compressing
+            # can't hold up the loop; a cancel leaves the store running to its end
+            cached = await asyncio.shield(loop.run_in_executor(None, store_output, key, outputs, returncode, runtime))
+        await loop.run_in_executor(None, record_stats, 'miss' if cached else 'uncacheable', key, 0, runtime)
+        return Result(argv, returncode, b''.join(outputs['stdout']), b''.join(outputs['stderr']), False)
+    finally:
+        # also reached when the caller cancels us
+        if process is not None and process.returncode is None:
+            try:
+                process.kill()
+                await process.wait()
+            except ProcessLookupError:
+                pass
+        try:
+            release_key_lock(key, lock_fd)
+        except Exception:
+            pass
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+
+from bincache.cache import open_entry, get_cache_file_path, EntryWriter, acquire_key_lock, release_key_lock
+from bincache.cli import get_cache_key, replay_hit, execute_command, send_range, record_stats
+from bincache.config import get_config, DEFAULT_BATCH_WORKERS
+from bincache import logger
+
+# misses started ahead of the command being written, per worker; each finished
+# miss holds two open temporary files until its turn comes
+MISSES_AHEAD_PER_WORKER = 4
+
+def parse_batch(text):
+    """return the argv of every command in a batch.
+
+    One command per line, either in shell syntax or as a JSON array of strings;
+    blank lines and lines starting with # are skipped.
+    """
+    import shlex
+    commands = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if line.startswith('['):
+                import json
+                argv = json.loads(line)
+            else:
+                argv = shlex.split(line)
+        except ValueError as e:
+            raise ValueError(f"line {number}: {e}")
+        if not argv or not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+            raise ValueError(f"line {number}: expected a command or a JSON array of strings")
+        commands.append(argv)
+    return commands
+
+def is_cached(key):
+    return bool(key) and os.path.exists(get_cache_file_path(key))
+
+def try_open_entry(key, fetch=True):
+    try:
+        return open_entry(key, fetch=fetch)
+    except Exception as e:
+        logger.warning(f"failed to open cache entry {key}: {e}")
+        return None
+
+'''
+run a missed command like main does, with its output captured into temporary
+files instead of written out; return the captured output as
+{'returncode', 'stdout', 'stderr'}, or the entry of a concurrent identical run
+'''
+def run_command(argv, key, env=None, cwd=None):
+    import tempfile
+    temporary_dir = get_config()['temporary_dir']
+    os.makedirs(temporary_dir, exist_ok=True)
+    lock_fd = None
+    try:
+        if key:
+            lock_fd, waited = acquire_key_lock(key)
+            # a run may also have finished between our lookup and the lock without us waiting
+            entry = try_open_entry(key, fetch=False)
+            if waited or entry is not None:
+                release_key_lock(key, lock_fd)
+                lock_fd = None
+                if entry is not None:
+                    return entry
+    except Exception:
+        pass
+    try:
+        writer = None
+        try:
+            if key:
+                writer = EntryWriter(key)
+        except Exception:
+            pass
+        stdout = tempfile.TemporaryFile(dir=temporary_dir)
+        stderr = tempfile.TemporaryFile(dir=temporary_dir)
+        started = time.monotonic()
+        returncode = execute_command(argv, writer, stdout, stderr, env, cwd)
+        runtime = time.monotonic() - started
+        cached = False
+        try:
+            if writer is not None and returncode == 0:
+                cached = writer.commit(returncode, runtime)
+            elif writer is not None:
+                writer.discard()
+        except Exception:
+            pass
+        record_stats('miss' if cached else 'uncacheable', key, 0, runtime)
+        return {'returncode': returncode, 'stdout': stdout, 'stderr': stderr}
+    finally:
+        try:
+            release_key_lock(key, lock_fd)
+        except Exception:
+            pass
+
+def open_or_run(argv, key):
+    # is_cached only looks at the local tier, open_entry also asks the secondary one
+    return try_open_entry(key) or run_command(argv, key)
+
+def write_result(result, key=None):
+    """write a result of run_command or an entry of open_entry to stdout and stderr, return its returncode."""
+    if 'file' in result:
+        served = replay_hit(result, key)
+        if served is None:
+            return 1
+        record_stats('hit', key, served, result.get('runtime', 0))
+        return result['returncode']
+    for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+        with result[name] as f:
+            send_range(f, 0, os.fstat(f.fileno()).st_size, stream)
+    return result['returncode']
+
+'''
+run commands and write their outputs in input order, return their returncodes
+
+The cache keys of all commands are computed first. Hits are written as soon as
+every command before them is, misses run in a pool of workers threads, each one
+waiting on a child process, and are started at most a few per worker ahead of
+the command being written.
+'''
+def run_batch(commands, workers=None):
+    from concurrent.futures import ThreadPoolExecutor
+    if workers is None:
+        workers = get_config().get('batch_workers', DEFAULT_BATCH_WORKERS)
+    keys = []
+    for argv in commands:
+        try:
+            keys.append(get_cache_key(argv))
+        except Exception as e:
+            logger.warning(f"failed to compute the cache key of {argv}: {e}")
+            keys.append(None)
+    misses = iter([i for i, key in enumerate(keys) if not is_cached(key)])
+    futures = {}
+    returncodes = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, argv in enumerate(commands):
+            while len(futures) < workers * MISSES_AHEAD_PER_WORKER:
+                miss = next(misses, None)
+                if miss is None:
+                    break
+                futures[miss] = executor.submit(open_or_run, commands[miss], keys[miss])
+            if i in futures:
+                result = futures.pop(i).result()
+            else:
+                # an entry evicted since the keys were computed is run here
+                result = open_or_run(argv, keys[i])
+            returncodes.append(write_result(result, keys[i]))
+    return returncodes
+
+def batch_main(args):
+    """bincache --batch FILE|-, return the exit status."""
+    if len(args) != 1:
+        print("Usage: bincache --batch FILE|-", file=sys.stderr)
+        return 1
+    try:
+        if args[0] == '-':
+            text = sys.stdin.read()
+        else:
+            with open(args[0], 'r') as f:
+                text = f.read()
+        commands = parse_batch(text)
+    except (OSError, ValueError) as e:
+        print(f"bincache: {args[0]}: {e}", file=sys.stderr)
+        return 1
+    import shlex
+    status = 0
+    for number, (argv, returncode) in enumerate(zip(commands, run_batch(commands)), 1):
+        if returncode != 0:
+            print(f"bincache: command {number} exited with {returncode}: {shlex.join(argv)}", file=sys.stderr)
+            status = status or returncode
+    return status
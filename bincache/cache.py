@@ -1,64 +1,778 @@
 import os
-import pickle
-import tempfile
-from bincache.config import get_config
+import time
+import zlib
+import fcntl
+import struct
+from bincache.config import get_config, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_BACKGROUND_GC, DEFAULT_LOCK_TIMEOUT
+from bincache.config import DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_MIN_SIZE, DEFAULT_SPILL_THRESHOLD, DEFAULT_MAX_ENTRY_SIZE
+from bincache.config import DEFAULT_DEDUPLICATE
 from bincache import logger
+from bincache import index
+from bincache import compress
+from bincache.profile import phase
 
-def get_cache_file_path(key):
-    config = get_config()
+def get_entry_path(cache_dir, key):
     prefix = key[:2]
     filename = key[2:]
-    cache_file_folder = os.path.join(config['cache_dir'], prefix)
+    cache_file_folder = os.path.join(cache_dir, prefix)
     return os.path.join(cache_file_folder, filename)
 
-# TODO Add file locking or other mechanism to handle multi-process access
-def trim_cache_dir_to_limit(cache_dir, limit_size_in_bytes):
-    """removing old files if the total size exceeds the limit."""
-    total_size = 0
-    file_paths = []
-    for root, dirs, files in os.walk(cache_dir):
+def get_cache_file_path(key):
+    config = get_config()
+    return get_entry_path(config['cache_dir'], key)
+
+def use_index():
+    return get_config().get('metadata_index', False)
+
+# An entry file is a fixed header followed by the raw stdout and stderr bytes.
+ENTRY_MAGIC = b'BCE\x00'
+ENTRY_VERSION = 2
+# version 1 entries are never compressed and read the same way
+ENTRY_READ_VERSIONS = (1, 2)
+# magic, version, flags, returncode, stdout length, stderr length, runtime;
+# the lengths are of the bytes stored, after compression, the runtime is the
+# milliseconds the command took when it was cached, 0 if unknown
+ENTRY_HEADER = struct.Struct('<4sHHiQQI')
+ENTRY_RUNTIME_OFFSET = ENTRY_HEADER.size - 4
+ENTRY_RUNTIME_MAX = 2**32 - 1
+# the low byte of the flags holds the compress.CODECS id of stdout and stderr, 0 if stored raw
+ENTRY_CODEC_MASK = 0xff
+ENTRY_READ_SIZE = 1024 * 1024
+
+LEDGER_FILE = 'ledger'
+# With deduplicate, entries are hard links to a blob named by the digest of the
+# entry file; the link count is the reference count, a blob with a single link
+# left is no longer used by any entry.
+BLOB_DIR = 'blobs'
+# new entries are hard linked in here until they are uploaded to the secondary
+# tier; those links keep the bytes on disk but don't count as entries
+OUTBOX_DIR = 'outbox'
+GC_LOCK_FILE = 'gc.lock'
+LOCK_DIR = 'locks'
+LOCK_POLL_INTERVAL = 0.002
+LOCK_POLL_MAX_INTERVAL = 0.05
+# The ledger is rebuilt from a full scan after this many updates or seconds,
+# which bounds the drift left behind by crashes and external deletions.
+LEDGER_RECONCILE_UPDATES = 100000
+LEDGER_RECONCILE_INTERVAL = 24 * 60 * 60
+
+def scan_cache_dir(cache_dir):
+    """return list of (path, mtime, size) of all entries, one stat per entry."""
+    entries = []
+    with os.scandir(cache_dir) as top:
         # Ignore the files in the first level directory (configuration files)
-        if root == cache_dir:
+        # and any first level directory that is not a key prefix (tmp, memo, ...)
+        prefixes = [entry.path for entry in top if len(entry.name) == 2 and entry.is_dir(follow_symlinks=False)]
+    for prefix in prefixes:
+        try:
+            with os.scandir(prefix) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, st.st_mtime, st.st_size))
+        except FileNotFoundError:
+            pass
+    return entries
+
+def format_ledger(total_size, entry_count, updates, reconciled):
+    body = f"{total_size} {entry_count} {updates} {reconciled}"
+    return f"{body} {zlib.crc32(body.encode())}\n".encode()
+
+def parse_ledger(data):
+    """return (total_size, entry_count, updates, reconciled), None if the ledger is damaged."""
+    try:
+        fields = data.split(b'\n', 1)[0].decode().split(' ')
+        if len(fields) != 5 or zlib.crc32(' '.join(fields[:4]).encode()) != int(fields[4]):
+            return None
+        ledger = tuple(int(field) for field in fields[:4])
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if ledger[0] < 0 or ledger[1] < 0:
+        return None
+    return ledger
+
+def read_ledger(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, LEDGER_FILE), 'rb') as f:
+            return parse_ledger(f.read(4096))
+    except OSError:
+        return None
+
+def write_ledger(cache_dir, total_size, entry_count):
+    """reset the ledger to the result of a full scan."""
+    fd = os.open(os.path.join(cache_dir, LEDGER_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = format_ledger(total_size, entry_count, 0, int(time.time()))
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+
+def update_ledger(cache_dir, size_delta, count_delta):
+    """apply a put or delete to the ledger, return the new ledger or None if there is none to update."""
+    try:
+        fd = os.open(os.path.join(cache_dir, LEDGER_FILE), os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        ledger = parse_ledger(os.pread(fd, 4096, 0))
+        if ledger is None:
+            return None
+        total_size, entry_count, updates, reconciled = ledger
+        ledger = (total_size + size_delta, entry_count + count_delta, updates + 1, reconciled)
+        # a single small pwrite either lands or not, the checksum catches the rest
+        data = format_ledger(*ledger)
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+        return ledger
+    finally:
+        os.close(fd)
+
+def ledger_is_suspect(ledger):
+    if ledger is None:
+        return True
+    return ledger[2] >= LEDGER_RECONCILE_UPDATES or time.time() - ledger[3] >= LEDGER_RECONCILE_INTERVAL
+
+def scan_blobs(cache_dir):
+    """return list of (path, stat) of all blobs."""
+    blobs = []
+    try:
+        with os.scandir(os.path.join(cache_dir, BLOB_DIR)) as top:
+            prefixes = [entry.path for entry in top if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return blobs
+    for prefix in prefixes:
+        try:
+            with os.scandir(prefix) as it:
+                for entry in it:
+                    try:
+                        blobs.append((entry.path, entry.stat(follow_symlinks=False)))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+    return blobs
+
+def get_disk_usage(cache_dir, entries):
+    """the size of entries on disk, entries sharing a blob counted once, unused blobs included."""
+    blobs = scan_blobs(cache_dir)
+    if not blobs:
+        return sum(size for _, _, size in entries)
+    seen = set()
+    total_size = 0
+    stats = [st for _, st in blobs]
+    for path, _, _ in entries:
+        try:
+            stats.append(os.stat(path))
+        except FileNotFoundError:
+            pass
+    for st in stats:
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            total_size += st.st_size
+    return total_size
+
+def get_outbox_links(cache_dir):
+    """return dict of (st_dev, st_ino) to the number of outbox links to that inode."""
+    links = {}
+    try:
+        with os.scandir(os.path.join(cache_dir, OUTBOX_DIR)) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                links[(st.st_dev, st.st_ino)] = links.get((st.st_dev, st.st_ino), 0) + 1
+    except FileNotFoundError:
+        pass
+    return links
+
+def is_queued(cache_dir, key, st):
+    """whether the outbox link of key is the inode of st."""
+    try:
+        queued = os.stat(os.path.join(cache_dir, OUTBOX_DIR, key))
+    except FileNotFoundError:
+        return False
+    return (queued.st_dev, queued.st_ino) == (st.st_dev, st.st_ino)
+
+def get_freed_size(st, outbox_links=0):
+    """the bytes the cache size drops by when the entry with stat st goes.
+
+    Only entries and blobs count as references, not the outbox. An entry
+    sharing its blob with other entries frees nothing; the last one frees the
+    blob's size, the blob itself goes with the next sweep_blobs.
+    """
+    links = st.st_nlink - outbox_links
+    if links <= 1 or (links == 2 and get_config().get('deduplicate', DEFAULT_DEDUPLICATE)):
+        return st.st_size
+    return 0
+
+def sweep_blobs(cache_dir):
+    """remove the blobs no entry links to anymore, an outbox link doesn't keep a blob."""
+    blobs = scan_blobs(cache_dir)
+    outbox_links = get_outbox_links(cache_dir) if blobs else {}
+    for path, st in blobs:
+        if st.st_nlink - outbox_links.get((st.st_dev, st.st_ino), 0) > 1:
             continue
-        for name in files:
-            file_path = os.path.join(root, name)
-            file_size = os.path.getsize(file_path)
-            total_size += file_size
-            file_paths.append((file_path, os.path.getmtime(file_path), file_size))
+        try:
+            # stat again, an entry may have been linked to it since the scan
+            if os.stat(path).st_nlink == st.st_nlink:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def remove_entry(file_path, outbox_links=None):
+    """remove an entry file, return the bytes that frees, see get_freed_size.
+
+    outbox_links is get_outbox_links of the cache directory.
+    """
+    st = os.stat(file_path)
+    os.remove(file_path)
+    return get_freed_size(st, (outbox_links or {}).get((st.st_dev, st.st_ino), 0))
+
+def get_cache_size(cache_dir):
+    """return the total size of all entries from the ledger, rebuilding it with a full scan when needed."""
+    ledger = read_ledger(cache_dir)
+    if not ledger_is_suspect(ledger):
+        return ledger[0]
+    entries = scan_cache_dir(cache_dir)
+    total_size = get_disk_usage(cache_dir, entries)
+    write_ledger(cache_dir, total_size, len(entries))
+    if use_index():
+        try:
+            index.sync(cache_dir, entries)
+        except Exception as e:
+            logger.warning(f"failed to sync metadata index: {e}")
+    return total_size
+
+def evict_with_index(cache_dir, total_size, limit_size_in_bytes):
+    """remove least recently used entries, return (removed_size, removed_count)."""
+    removed_size, removed_count, removed_keys = 0, 0, []
+    outbox_links = get_outbox_links(cache_dir)
+    victims = index.iter_lru(cache_dir)
+    for key, _ in victims:
+        if total_size <= limit_size_in_bytes:
+            break
+        file_path = get_entry_path(cache_dir, key)
+        removed_keys.append(key)
+        try:
+            file_size = remove_entry(file_path, outbox_links)
+        except FileNotFoundError:
+            continue
+        logger.info(f"{file_path} removed, totle_size: {total_size}, limit_size_in_bytes: {limit_size_in_bytes}")
+        total_size -= file_size
+        removed_size += file_size
+        removed_count += 1
+    # finish the SELECT before writing through the same connection
+    victims.close()
+    index.record_delete(cache_dir, removed_keys)
+    return removed_size, removed_count
+
+def trim_cache_dir_to_limit(cache_dir, limit_size_in_bytes):
+    """removing old files if the total size exceeds the limit."""
+    total_size = get_cache_size(cache_dir)
     logger.info(f"totle_size: {total_size}, limit_size_in_bytes: {limit_size_in_bytes}")
     if total_size <= limit_size_in_bytes:
         return
+    if use_index():
+        try:
+            removed_size, removed_count = evict_with_index(cache_dir, total_size, limit_size_in_bytes)
+            update_ledger(cache_dir, -removed_size, -removed_count)
+            sweep_blobs(cache_dir)
+            return
+        except Exception as e:
+            logger.warning(f"failed to evict with metadata index, scanning instead: {e}")
+    file_paths = scan_cache_dir(cache_dir)
+    total_size = get_disk_usage(cache_dir, file_paths)
     # Sort files by modification time (oldest first)
     file_paths.sort(key=lambda x: x[1])
-    for file_path, _, file_size in file_paths:
-        os.remove(file_path)
-        logger.info(f"{file_path} removed, totle_size: {total_size}, limit_size_in_bytes: {limit_size_in_bytes}")
-        total_size -= file_size
+    removed_size, removed_count = 0, 0
+    outbox_links = get_outbox_links(cache_dir)
+    for file_path, _, _ in file_paths:
         if total_size <= limit_size_in_bytes:
             break
+        try:
+            file_size = remove_entry(file_path, outbox_links)
+        except FileNotFoundError:
+            continue
+        logger.info(f"{file_path} removed, totle_size: {total_size}, limit_size_in_bytes: {limit_size_in_bytes}")
+        total_size -= file_size
+        removed_size += file_size
+        removed_count += 1
+    update_ledger(cache_dir, -removed_size, -removed_count)
+    sweep_blobs(cache_dir)
+
+def lock_gc(cache_dir):
+    """return a file descriptor holding the gc lock, None if another gc holds it."""
+    fd = os.open(os.path.join(cache_dir, GC_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def collect_garbage():
+    """trim the cache down to the low watermark, return False if another gc is already running."""
+    config = get_config()
+    cache_dir = config['cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+    fd = lock_gc(cache_dir)
+    if fd is None:
+        return False
+    try:
+        low_watermark = config.get('low_watermark', DEFAULT_LOW_WATERMARK)
+        trim_cache_dir_to_limit(cache_dir, int(config['max_size'] * low_watermark))
+    finally:
+        os.close(fd)
+    return True
+
+def spawn_bincache(cache_dir, *args):
+    """run bincache with args detached, so the caller doesn't wait for it."""
+    import sys
+    import subprocess
+    env = dict(os.environ, BINCACHE_DIR=cache_dir)
+    subprocess.Popen([sys.executable, '-m', 'bincache.cli', *args], stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True, env=env)
+
+def spawn_gc(cache_dir):
+    """run `bincache --gc` detached, so the caller doesn't wait for the eviction."""
+    spawn_bincache(cache_dir, '--gc')
+
+def maybe_collect_garbage(config, total_size):
+    """start a gc once the cache grows past the high watermark."""
+    if total_size <= config['max_size'] * config.get('high_watermark', DEFAULT_HIGH_WATERMARK):
+        return
+    cache_dir = config['cache_dir']
+    if not config.get('background_gc', DEFAULT_BACKGROUND_GC):
+        collect_garbage()
+        return
+    fd = lock_gc(cache_dir)
+    if fd is None:
+        return
+    os.close(fd)
+    logger.info(f"totle_size: {total_size} over the high watermark, starting gc")
+    spawn_gc(cache_dir)
 
-def put(key, value):
+def get_key_lock_path(key):
+    config = get_config()
+    return os.path.join(config['cache_dir'], LOCK_DIR, key)
+
+def acquire_key_lock(key, timeout=None):
+    """take the per-key lock that lets concurrent misses of the same key wait for one run.
+
+    return (fd, waited); fd is None if the lock wasn't acquired within timeout seconds.
+    flock locks die with their holder, so a crashed holder never blocks anyone; the
+    lock file itself is unlinked on release, which is why a lock taken on an inode
+    that is no longer at the path is dropped and retried.
+    """
+    if timeout is None:
+        timeout = get_config().get('lock_timeout', DEFAULT_LOCK_TIMEOUT)
+    lock_path = get_key_lock_path(key)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    deadline = time.monotonic() + timeout
+    interval = LOCK_POLL_INTERVAL
+    waited = False
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            if time.monotonic() >= deadline:
+                logger.warning(f"timed out waiting for the lock of {key}")
+                return None, True
+            waited = True
+            time.sleep(interval)
+            interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
+            continue
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                os.pwrite(fd, f"{os.getpid()}\n".encode(), 0)
+                return fd, waited
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+def release_key_lock(key, fd):
+    if fd is None:
+        return
+    # unlink before unlocking, so nobody can lock the old inode while it is still at the path
+    try:
+        os.remove(get_key_lock_path(key))
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+def pack_entry_header(codec_id, returncode, stdout_size, stderr_size, runtime=0):
+    """runtime is in seconds."""
+    runtime_ms = min(round(runtime * 1000), ENTRY_RUNTIME_MAX)
+    return ENTRY_HEADER.pack(ENTRY_MAGIC, ENTRY_VERSION, codec_id, returncode, stdout_size, stderr_size, runtime_ms)
+
+def encode_entry(entry, compression=None, min_size=0):
+    """return the header, stdout and stderr parts of an entry file.
+
+    stdout and stderr are compressed as two separate streams with the compression
+    codec when they are at least min_size bytes together and get smaller by it.
+    """
+    stdout, stderr = entry['stdout'], entry['stderr']
+    codec_id = 0
+    if compression and compress.is_available(compression) and len(stdout) + len(stderr) >= min_size:
+        packed = compress.compress(compression, stdout), compress.compress(compression, stderr)
+        if len(packed[0]) + len(packed[1]) < len(stdout) + len(stderr):
+            stdout, stderr = packed
+            codec_id = compress.CODECS[compression]
+    header = pack_entry_header(codec_id, entry.get('returncode', 0), len(stdout), len(stderr), entry.get('runtime', 0))
+    return header, stdout, stderr
+
+def load_legacy_entry(data):
+    """read an entry written by older versions: a pickled dict of decoded strings."""
+    import pickle
+    try:
+        value = pickle.loads(data)
+        return {'stdout': value['stdout'].encode('utf-8'), 'stderr': value['stderr'].encode('utf-8'), 'returncode': 0}
+    except Exception:
+        return None
+
+def parse_entry_header(header, file_size):
+    """return (returncode, stdout_size, stderr_size, codec, runtime), None unless header describes a file_size bytes entry.
+
+    codec is the compress codec name, None for raw output; runtime is in seconds, 0 if unknown."""
+    if len(header) < ENTRY_HEADER.size or header[:len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+        return None
+    _, version, flags, returncode, stdout_size, stderr_size, runtime_ms = ENTRY_HEADER.unpack_from(header)
+    # entries of a newer format are misses, not errors
+    if version not in ENTRY_READ_VERSIONS or file_size != ENTRY_HEADER.size + stdout_size + stderr_size:
+        return None
+    codec = compress.CODEC_NAMES.get(flags & ENTRY_CODEC_MASK) if flags & ENTRY_CODEC_MASK else None
+    # so are entries compressed with a codec that isn't installed here
+    if flags & ENTRY_CODEC_MASK and not compress.is_available(codec):
+        return None
+    return returncode, stdout_size, stderr_size, codec, runtime_ms / 1000
+
+def parse_entry(data):
+    """return dict of stdout, stderr and returncode, None if data isn't a readable entry."""
+    if data[:len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+        return load_legacy_entry(data)
+    header = parse_entry_header(data, len(data))
+    if header is None:
+        return None
+    returncode, stdout_size, _, codec, _ = header
+    stdout_end = ENTRY_HEADER.size + stdout_size
+    stdout, stderr = data[ENTRY_HEADER.size:stdout_end], data[stdout_end:]
+    if codec is not None:
+        try:
+            stdout, stderr = compress.decompress(codec, stdout), compress.decompress(codec, stderr)
+        except Exception:
+            return None
+    return {'stdout': stdout, 'stderr': stderr, 'returncode': returncode}
+
+def iter_entry_range(f, offset, size, codec=None):
+    """yield the output stored in size bytes at offset of an entry file, decompressed piece by piece.
+
+    Compressed pieces are bounded by ENTRY_READ_SIZE too, output that compresses
+    well would otherwise expand a whole read at once.
+    """
+    decompressor = compress.decompressor(codec) if codec else None
+    while size:
+        data = os.pread(f.fileno(), min(size, ENTRY_READ_SIZE), offset)
+        if not data:
+            raise EOFError("entry file truncated")
+        offset += len(data)
+        size -= len(data)
+        if decompressor is None:
+            yield data
+        else:
+            yield from compress.decompress_chunks(decompressor, data, ENTRY_READ_SIZE)
+
+def new_temp_file(config, cache_file_path):
+    import tempfile
+    temporary_dir = config['temporary_dir'] or os.path.dirname(cache_file_path)
+    os.makedirs(temporary_dir, exist_ok=True)
+    return tempfile.NamedTemporaryFile(delete=False, dir=temporary_dir)
+
+def hash_entry_file(path):
+    """digest of an entry file, leaving out its runtime: entries differing only in it share a blob."""
+    from bincache.signature import blake2b
+    file_hash = blake2b(digest_size=32)
+    with open(path, 'rb', buffering=0) as f:
+        file_hash.update(f.read(ENTRY_RUNTIME_OFFSET))
+        f.seek(ENTRY_HEADER.size)
+        while True:
+            data = f.read(ENTRY_READ_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+def get_blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, BLOB_DIR, digest[:2], digest[2:])
+
+'''
+link the complete entry file at temp_path with the blob of its content; return
+the path to install as the entry, a link to the existing blob if there is
+one, and whether the entry takes new space
+'''
+def deduplicate_entry(cache_dir, temp_path, size):
+    blob_path = get_blob_path(cache_dir, hash_entry_file(temp_path))
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    try:
+        os.link(temp_path, blob_path)
+        return temp_path, True
+    except FileExistsError:
+        pass
+    if os.stat(blob_path).st_size != size:
+        return temp_path, True
+    link_path = f"{temp_path}.link"
+    os.link(blob_path, link_path)
+    os.remove(temp_path)
+    return link_path, False
+
+def install_entry(key, temp_path, new_size, push=True):
+    """atomically move a complete entry file into place and account for it.
+
+    With deduplicate an entry identical to another one becomes a hard link to
+    their shared blob and takes no new space. New entries are queued for the
+    secondary tier, if there is one, unless push is False.
+    """
+    config = get_config()
+    cache_file_path = get_cache_file_path(key)
+    added_size = new_size
+    try:
+        if config.get('deduplicate', DEFAULT_DEDUPLICATE):
+            try:
+                with phase('dedup'):
+                    temp_path, is_new = deduplicate_entry(config['cache_dir'], temp_path, new_size)
+                added_size = new_size if is_new else 0
+            except OSError as e:
+                logger.warning(f"failed to deduplicate {key}: {e}")
+        try:
+            old = os.stat(cache_file_path)
+        except FileNotFoundError:
+            old = None
+        os.rename(temp_path, cache_file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    if old is None:
+        ledger = update_ledger(config['cache_dir'], added_size, 1)
+    else:
+        freed_size = get_freed_size(old, 1 if is_queued(config['cache_dir'], key, old) else 0)
+        ledger = update_ledger(config['cache_dir'], added_size - freed_size, 0)
+    if use_index():
+        try:
+            index.record_put(config['cache_dir'], key, new_size)
+        except Exception as e:
+            logger.warning(f"failed to update metadata index: {e}")
+    if push and config.get('secondary'):
+        try:
+            from bincache import secondary
+            secondary.queue_push(key)
+        except Exception as e:
+            logger.warning(f"failed to queue {key} for the secondary cache: {e}")
+
+    if 'max_size' in config:
+        with phase('gc'):
+            total_size = get_cache_size(config['cache_dir']) if ledger_is_suspect(ledger) else ledger[0]
+            maybe_collect_garbage(config, total_size)
+
+'''
+store entry, a dict of stdout and stderr bytes and the returncode
+'''
+def put(key, entry):
     config = get_config()
     cache_file_path = get_cache_file_path(key)
     if cache_file_path is None:
         return
-    cache_file_folder = os.path.dirname(cache_file_path)
-    os.makedirs(cache_file_folder, exist_ok=True)
-    if config['temporary_dir']:
-        os.makedirs(config['temporary_dir'], exist_ok=True)
-        with tempfile.NamedTemporaryFile(delete=False, dir=config['temporary_dir']) as temp_file:
-            temp_path = temp_file.name
-            pickle.dump(value, temp_file)
-        try:
-            os.rename(temp_path, cache_file_path)
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+    with new_temp_file(config, cache_file_path) as temp_file:
+        temp_path = temp_file.name
+        for data in encode_entry(entry, config.get('compression', DEFAULT_COMPRESSION),
+                                 config.get('compression_min_size', DEFAULT_COMPRESSION_MIN_SIZE)):
+            temp_file.write(data)
+        new_size = temp_file.tell()
+    install_entry(key, temp_path, new_size)
+
+class EntryWriter:
+    """collect a running command's output into the entry of key.
+
+    Output is kept in memory up to spill_threshold bytes and stored with put().
+    Past that, stdout is streamed into the entry's temporary file behind a
+    placeholder header and stderr into a second anonymous one, both compressed
+    on the fly when compression is on; commit() appends stderr, fills in the
+    header and renames the file into the cache. Output beyond max_entry_size
+    is dropped and never cached.
+    """
+
+    def __init__(self, key):
+        config = get_config()
+        self.key = key
+        self.started = time.monotonic()
+        self.spill_threshold = config.get('spill_threshold', DEFAULT_SPILL_THRESHOLD)
+        self.max_entry_size = config.get('max_entry_size', DEFAULT_MAX_ENTRY_SIZE)
+        compression = config.get('compression', DEFAULT_COMPRESSION)
+        self.compression = compression if compress.is_available(compression) else None
+        self.chunks = {'stdout': [], 'stderr': []}
+        self.size = 0
+        self.files = None
+        self.compressors = None
+        self.stored = {'stdout': 0, 'stderr': 0}
+        self.discarded = False
+
+    def write(self, name, data):
+        """add data to the 'stdout' or 'stderr' of the entry."""
+        if self.discarded:
+            return
+        self.size += len(data)
+        if self.max_entry_size and self.size > self.max_entry_size:
+            logger.info(f"output of {self.key} is larger than max_entry_size {self.max_entry_size}, not caching it")
+            self.discard()
+            return
+        if self.files is None:
+            self.chunks[name].append(data)
+            if self.size > self.spill_threshold:
+                self.spill()
+            return
+        self.write_file(name, data)
+
+    def spill(self):
+        import tempfile
+        config = get_config()
+        cache_file_path = get_cache_file_path(self.key)
+        os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+        self.files = {'stdout': new_temp_file(config, cache_file_path)}
+        self.files['stderr'] = tempfile.TemporaryFile(dir=os.path.dirname(self.files['stdout'].name))
+        self.files['stdout'].write(b'\0' * ENTRY_HEADER.size)
+        if self.compression:
+            self.compressors = {name: compress.compressor(self.compression) for name in self.files}
+        for name, chunks in self.chunks.items():
+            for data in chunks:
+                self.write_file(name, data)
+        self.chunks = None
+
+    def write_file(self, name, data):
+        if self.compressors:
+            data = self.compressors[name].compress(data)
+        self.files[name].write(data)
+        self.stored[name] += len(data)
+
+    def commit(self, returncode, runtime=None):
+        """store the entry, return False if it was discarded.
+
+        runtime is the seconds the command took, by default the time since the writer was created."""
+        if self.discarded:
+            return False
+        if runtime is None:
+            runtime = time.monotonic() - self.started
+        if self.files is None:
+            put(self.key, {'stdout': b''.join(self.chunks['stdout']), 'stderr': b''.join(self.chunks['stderr']),
+                           'returncode': returncode, 'runtime': runtime})
+            return True
+        try:
+            if self.compressors:
+                for name, compressor in self.compressors.items():
+                    data = compressor.flush()
+                    self.files[name].write(data)
+                    self.stored[name] += len(data)
+            entry_file, stderr_file = self.files['stdout'], self.files['stderr']
+            stderr_file.seek(0)
+            import shutil
+            shutil.copyfileobj(stderr_file, entry_file, ENTRY_READ_SIZE)
+            codec_id = compress.CODECS[self.compression] if self.compressors else 0
+            entry_file.seek(0)
+            entry_file.write(pack_entry_header(codec_id, returncode, self.stored['stdout'], self.stored['stderr'], runtime))
+            entry_file.close()
+            install_entry(self.key, entry_file.name, ENTRY_HEADER.size + self.stored['stdout'] + self.stored['stderr'])
         finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-    else:
-        pickle.dump(value, cache_file_path)
+            self.close_files()
+        return True
 
-    if 'max_size' in config:
-        trim_cache_dir_to_limit(config['cache_dir'], config['max_size'])
+    def discard(self):
+        self.discarded = True
+        self.chunks = None
+        self.close_files()
+
+    def close_files(self):
+        if self.files is None:
+            return
+        for f in self.files.values():
+            f.close()
+        try:
+            os.remove(self.files['stdout'].name)
+        except FileNotFoundError:
+            pass
+        self.files = None
+
+def discard_entry(key):
+    """remove the entry of key, a damaged one, and account for it like eviction does."""
+    config = get_config()
+    try:
+        freed_size = remove_entry(get_cache_file_path(key), get_outbox_links(config['cache_dir']))
+    except FileNotFoundError:
+        return
+    update_ledger(config['cache_dir'], -freed_size, -1)
+    if use_index():
+        try:
+            index.record_delete(config['cache_dir'], [key])
+        except Exception as e:
+            logger.warning(f"failed to update metadata index: {e}")
+
+def record_hit(key):
+    if use_index():
+        try:
+            index.record_hit(get_config()['cache_dir'], key)
+        except Exception as e:
+            logger.warning(f"failed to update metadata index: {e}")
+
+def fetch_from_secondary(key):
+    """copy key's entry from the secondary tier into the local cache, return True if it was there."""
+    if not get_config().get('secondary'):
+        return False
+    from bincache import secondary
+    return secondary.fetch_entry(key)
+
+def open_entry(key, migrate=True, fetch=True):
+    """open an entry for replay without reading its output into memory.
+
+    return dict of the open binary file, the returncode, the codec and the
+    (offset, size) of stdout and stderr in the file, None on a miss. The caller closes the file.
+    Legacy pickled entries are rewritten in the current format on their first hit.
+    A local miss is looked up in the secondary tier and promoted into the local cache.
+    """
+    if not key:
+        return None
+    cache_file_path = get_cache_file_path(key)
+    if not cache_file_path:
+        return None
+    try:
+        f = open(cache_file_path, 'rb', buffering=0)
+    except FileNotFoundError:
+        if fetch and fetch_from_secondary(key):
+            return open_entry(key, migrate=False, fetch=False)
+        return None
+    try:
+        header = parse_entry_header(f.read(ENTRY_HEADER.size), os.fstat(f.fileno()).st_size)
+        if header is None:
+            f.seek(0)
+            entry = parse_entry(f.read()) if migrate else None
+            f.close()
+    except BaseException:
+        f.close()
+        raise
+    if header is None:
+        if entry is None:
+            logger.warning(f"unreadable cache entry {cache_file_path}")
+            return None
+        put(key, entry)
+        return open_entry(key, migrate=False)
+    record_hit(key)
+    returncode, stdout_size, stderr_size, codec, runtime = header
+    return {'file': f, 'returncode': returncode, 'codec': codec, 'stdout': (ENTRY_HEADER.size, stdout_size),
+            'stderr': (ENTRY_HEADER.size + stdout_size, stderr_size), 'runtime': runtime}
 
 def get(key):
     if not key:
@@ -69,6 +783,12 @@ def get(key):
     try:
         with open(cache_file_path, 'rb') as f:
             data = f.read()
-            return pickle.loads(data)
     except FileNotFoundError:
-        return None
\ No newline at end of file
+        if not fetch_from_secondary(key):
+            return None
+        return get(key)
+    record_hit(key)
+    entry = parse_entry(data)
+    if entry is None:
+        logger.warning(f"unreadable cache entry {cache_file_path}")
+    return entry
\ No newline at end of file
@@ -1,29 +1,261 @@
 import os
 import sys
-import subprocess
-import shutil
+import time
 
-from bincache.cache import get, put
+from bincache.cache import open_entry, iter_entry_range, EntryWriter, collect_garbage, acquire_key_lock, release_key_lock
+from bincache.cache import discard_entry
 from bincache.signature import generate_signature
+from bincache.config import get_config, DEFAULT_TRACK_INPUTS, DEFAULT_STATS
+from bincache.daemon import query as query_daemon
+from bincache.profile import phase, annotate, profile_run
 
-def execute_command(argv):
-    try:
-        command = argv[0]
-        result = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = result.communicate()
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        return result.returncode, stdout, stderr
-    except FileNotFoundError:
-        return 127, "", f"bincache: command not found: {command}\n"
-    except PermissionError:
-        return 126, "", f"bincache: permission denied: {command}\n"
-    except OSError as e:
-        return 1, "", f"bincache: OS error: {command}: {str(e)}\n"
+READ_SIZE = 64 * 1024
+
+def which(command, path=None, cwd=None):
+    """shutil.which for POSIX, without importing shutil on the hit path.
+
+    path defaults to our PATH, relative paths are taken relative to cwd.
+    """
+    def is_executable(path):
+        return os.access(path, os.X_OK) and not os.path.isdir(path)
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    if os.path.dirname(command):
+        command = os.path.join(cwd, command) if cwd else command
+        return command if is_executable(command) else None
+    for directory in path.split(os.pathsep):
+        candidate = os.path.join(cwd or '', directory, command)
+        if is_executable(candidate):
+            return candidate
+    return None
+
+def get_key_inputs(argv, binary, cwd=None, stdin_digest=None):
+    inputs = []
+    if binary and get_config().get('track_inputs', DEFAULT_TRACK_INPUTS):
+        from bincache.inputs import hash_arg_files
+        inputs = hash_arg_files(argv[1:], cwd)
+    if stdin_digest is not None:
+        inputs.append(('stdin', stdin_digest))
+    return inputs
+
+def get_cache_key(argv, environ=None, cwd=None, stdin_digest=None):
+    """the cache key of argv run with environ in cwd, both default to our own.
+
+    With track_inputs the contents of argument files, and stdin_digest, are part of the key.
+    """
+    with phase('which'):
+        binary = which(argv[0], None if environ is None else environ.get('PATH', os.defpath), cwd)
+    with phase('inputs'):
+        inputs = get_key_inputs(argv, binary, cwd, stdin_digest)
+    with phase('signature'):
+        return generate_signature(binary, argv[1:], environ, inputs, cwd)
+
+def explain_key(argv):
+    """print what the cache key of argv is made of, return the exit status."""
+    from bincache.signature import get_key_components, hash_key_components
+    binary = which(argv[0])
+    if binary is None:
+        print(f"bincache: command not found: {argv[0]}", file=sys.stderr)
+        return 1
+    components = get_key_components(binary, argv[1:], inputs=get_key_inputs(argv, binary))
+    if components is None:
+        print(f"{binary} is not cached: it is not a dynamically linked executable bincache can resolve")
+        return 1
+    print(f"key: {hash_key_components(components)}")
+    print(f"algorithm: {components['algorithm']}")
+    print(f"binary: {components['binary'][0]} {components['binary'][1]}")
+    for path, digest in components['libs']:
+        print(f"lib: {path} {digest}")
+    print(f"args: {components['args']!r}")
+    for name, value in components['env']:
+        print(f"env: {name}={value}" if value is not None else f"env: {name} (unset)")
+    if components['cwd'] is not None:
+        print(f"cwd: {components['cwd']}")
+    for kind, *details in components['inputs']:
+        print(f"input: {kind} {' '.join(details)}")
+    if get_config().get('track_inputs', DEFAULT_TRACK_INPUTS):
+        from bincache.inputs import get_stdin_limit
+        piped = " or a pipe" if get_stdin_limit(binary) is not None else ""
+        print(f"input: stdin is hashed too when it is a regular file{piped}, --explain-key doesn't read it; "
+              "runs with any other stdin but a terminal or /dev/null aren't cached")
+    return 0
+
+def lookup(argv, stdin_digest=None, environ=None, cwd=None):
+    """return (cache key, entry opened by open_entry or None) of a command line run with environ in cwd."""
+    cache_key = get_cache_key(argv, environ, cwd, stdin_digest)
+    with phase('open'):
+        return cache_key, open_entry(cache_key)
+
+def write_stream(stream, data):
+    """write bytes to a text stream's underlying binary buffer, return False once the reader is gone."""
+    try:
+        if hasattr(stream, 'buffer'):
+            stream.flush()
+            stream = stream.buffer
+        stream.write(data)
+        stream.flush()
+        return True
+    except (BrokenPipeError, ValueError):
+        return False
+
+def send_range(f, offset, size, stream):
+    """copy size bytes at offset of the binary file f to stream, return False once the reader is gone.
+
+    sendfile copies inside the kernel; when the stream has no real file descriptor
+    or sendfile refuses it, the range is written from an mmap of f instead.
+    """
+    if not size:
+        return True
+    try:
+        stream.flush()
+        out_fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        out_fd = None
+    if out_fd is not None:
+        try:
+            while size:
+                sent = os.sendfile(out_fd, f.fileno(), offset, size)
+                if not sent:
+                    break
+                offset += sent
+                size -= sent
+            if not size:
+                return True
+        except BrokenPipeError:
+            return False
+        except OSError:
+            pass
+    import mmap
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+        with view[offset:offset + size] as data:
+            return write_stream(stream, data)
+
+def replay_entry(entry):
+    """write a cache entry opened by open_entry to stdout and stderr, return the number of output bytes."""
+    served = 0
+    with entry['file'] as f:
+        for (offset, size), stream in ((entry['stdout'], sys.stdout), (entry['stderr'], sys.stderr)):
+            if entry.get('codec') is None:
+                send_range(f, offset, size, stream)
+                served += size
+                continue
+            for data in iter_entry_range(f, offset, size, entry['codec']):
+                served += len(data)
+                if not write_stream(stream, data):
+                    break
+    return served
+
+'''
+replay_entry a hit of key, return the bytes served or None if the entry turned
+out to be damaged; part of its output may be out already, so instead of
+running the command the entry is removed and the run fails, the next one misses
+'''
+def replay_hit(entry, key):
+    try:
+        return replay_entry(entry)
+    except Exception as e:
+        print(f"bincache: the cached output is damaged and was removed, run the command again: {e}", file=sys.stderr)
+        try:
+            discard_entry(key)
+        except Exception:
+            pass
+        return None
+
+def record_stats(kind, key=None, size=0, runtime=0):
+    """record a 'hit', 'miss' or 'uncacheable' run when stats is on."""
+    if get_config().get('stats', DEFAULT_STATS):
+        from bincache import stats
+        stats.record(kind, key, size, runtime)
+
+def show_stats(args):
+    from bincache import stats
+    count = 10
+    if args:
+        try:
+            count = int(args[0])
+        except ValueError:
+            print("Usage: bincache --show-stats [NUMBER_OF_KEYS]", file=sys.stderr)
+            return 1
+    if not get_config().get('stats', DEFAULT_STATS):
+        print("bincache: stats is off, set stats = true in bincache.conf to record them", file=sys.stderr)
+    summary = stats.read_stats(get_config()['cache_dir'])
+    sys.stdout.write(stats.format_report(summary, count))
+    return 0
+
+def export_stats(args):
+    from bincache import stats
+    if len(args) != 1:
+        print("Usage: bincache --export-stats FILE|-", file=sys.stderr)
+        return 1
+    summary = stats.read_stats(get_config()['cache_dir'])
+    if args[0] == '-':
+        sys.stdout.write(stats.format_openmetrics(summary))
+    else:
+        stats.export_openmetrics(summary, args[0])
+    return 0
+
+def stream_output(process, writer=None, stdout=None, stderr=None):
+    """forward the child's stdout and stderr as data arrives, handing the same bytes to writer.
+
+    The output goes to our own stdout and stderr unless other streams are given.
+    """
+    import selectors
+    names = {process.stdout: 'stdout', process.stderr: 'stderr'}
+    targets = {process.stdout: stdout or sys.stdout, process.stderr: stderr or sys.stderr}
+    with selectors.DefaultSelector() as selector:
+        for pipe in names:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                # keep draining the pipe if our reader went away, so the child never blocks on it
+                if targets[key.fileobj] is not None and not write_stream(targets[key.fileobj], data):
+                    targets[key.fileobj] = None
+                if writer is not None:
+                    try:
+                        writer.write(names[key.fileobj], data)
+                    except Exception:
+                        # a full disk only costs the cache entry, never the command's output
+                        writer.discard()
+                        writer = None
+    process.wait()
+
+def exec_error(command, error):
+    """return the returncode and message for a command that could not be started."""
+    if isinstance(error, FileNotFoundError):
+        return 127, f"bincache: command not found: {command}\n"
+    if isinstance(error, PermissionError):
+        return 126, f"bincache: permission denied: {command}\n"
+    if isinstance(error, OSError):
+        return 1, f"bincache: OS error: {command}: {str(error)}\n"
+    return 1, f"bincache: error executing: {command}: {str(error)}\n"
+
+def execute_command(argv, writer=None, stdout=None, stderr=None, env=None, cwd=None, stdin=None):
+    """run argv with its output streamed through and captured by writer, return the returncode.
+
+    stdin is an inputs.StdinInput standing in for our own stdin.
+    """
+    try:
+        import subprocess
+        process = subprocess.Popen(argv, stdin=None if stdin is None else stdin.popen_stdin(), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=env, cwd=cwd)
+        if stdin is not None:
+            stdin.feed(process)
+        stream_output(process, writer, stdout, stderr)
+        return process.returncode
     except Exception as e:
-        return 1, "", f"bincache: error executing: {command}: {str(e)}\n"
+        returncode, message = exec_error(argv[0], e)
+    write_stream(stderr or sys.stderr, message.encode('utf-8'))
+    return returncode
 
 def main():
+    profile_run(run_main)
+
+def run_main():
     if len(sys.argv) < 2:
         print("Usage: bincache <binary_or_command> <arg1> [arg2 ... argN]")
         print("  <binary_or_command> can be a path to an executable binary or a shell command.")
@@ -32,30 +264,112 @@ def main():
         print("Examples:")
         print("  bincache date")
         print("  bincache ./a.out -l -a")
+        print()
+        print("Commands:")
+        print("  bincache --gc       evict entries down to the low watermark")
+        print("  bincache --push     upload the entries queued for the secondary cache")
+        print("  bincache --daemon   serve cache lookups from memory until killed")
+        print("  bincache --batch FILE|-")
+        print("                      run the commands in FILE, one per line, misses in parallel")
+        print("  bincache --explain-key <binary_or_command> [args ...]")
+        print("                      print what the cache key of a command is made of")
+        print("  bincache --show-stats [N]")
+        print("                      print hit and miss counts, time saved and the N hottest keys")
+        print("  bincache --export-stats FILE|-")
+        print("                      write the stats in the OpenMetrics text format")
         sys.exit(1)
+    if sys.argv[1] == '--gc':
+        collect_garbage()
+        sys.exit(0)
+    if sys.argv[1] == '--push':
+        from bincache.secondary import push_outbox
+        push_outbox()
+        sys.exit(0)
+    if sys.argv[1] == '--daemon':
+        from bincache.daemon import serve
+        if not serve():
+            print("bincache: a daemon is already running", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+    if sys.argv[1] == '--explain-key':
+        if len(sys.argv) < 3:
+            print("Usage: bincache --explain-key <binary_or_command> [args ...]", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(explain_key(sys.argv[2:]))
+    if sys.argv[1] == '--batch':
+        from bincache.batch import batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    if sys.argv[1] == '--show-stats':
+        sys.exit(show_stats(sys.argv[2:]))
+    if sys.argv[1] == '--export-stats':
+        sys.exit(export_stats(sys.argv[2:]))
+    cache_key, lock_fd, stdin = None, None, None
     try:
-        binary = shutil.which(sys.argv[1])
-        args = sys.argv[2:]
-        cache_key = generate_signature(binary, args)
-        cached_output = get(cache_key)
+        stdin_digest = None
+        if get_config().get('track_inputs', DEFAULT_TRACK_INPUTS):
+            from bincache.inputs import StdinInput, get_stdin_limit
+            with phase('stdin'):
+                stdin = StdinInput(get_stdin_limit(which(sys.argv[1])))
+            stdin_digest = stdin.digest
+        if stdin is None or stdin.cacheable:
+            # a running daemon has the memos in memory already, without one we look up ourselves
+            with phase('daemon'):
+                reply = query_daemon(sys.argv[1:], stdin_digest)
+            with phase('lookup'):
+                cache_key, cached_output = reply if reply is not None else lookup(sys.argv[1:], stdin_digest)
+        else:
+            cached_output = None
+        if cached_output is None and cache_key:
+            # concurrent misses of the same key wait for the first one and replay its result
+            with phase('lock'):
+                lock_fd, waited = acquire_key_lock(cache_key)
+                # look again even if we didn't wait, a run may have finished between our lookup and the lock;
+                # it stored its entry locally and the secondary tier was asked by the lookup already
+                cached_output = open_entry(cache_key, fetch=False)
+                if waited or cached_output is not None:
+                    # if the first run wasn't cached, don't serialize the rest behind each other
+                    release_key_lock(cache_key, lock_fd)
+                    lock_fd = None
         if cached_output is not None:
-            stdout, stderr = cached_output['stdout'], cached_output['stderr']
-            print(stdout, end="")
-            print(stderr, end="", file=sys.stderr)
-            sys.exit(0)
+            annotate(outcome='hit', key=cache_key)
+            with phase('replay'):
+                served = replay_hit(cached_output, cache_key)
+            if served is None:
+                sys.exit(1)
+            with phase('stats'):
+                record_stats('hit', cache_key, served, cached_output.get('runtime', 0))
+            sys.exit(cached_output['returncode'])
     except Exception as e:
         pass
     
-    returncode, stdout, stderr = execute_command(sys.argv[1:])
-    if returncode == 0: # TODO and not stderr:
-        try:
-            output = {'stdout': stdout, 'stderr': stderr}
-            put(cache_key, output)
-        except Exception as e:
-            pass
-    print(stdout, end="")
-    print(stderr, end="", file=sys.stderr)
+    writer = None
+    try:
+        if cache_key:
+            writer = EntryWriter(cache_key)
+    except Exception:
+        pass
+    # the output has already been streamed through by the time the command exits
+    started = time.monotonic()
+    with phase('execute'):
+        returncode = execute_command(sys.argv[1:], writer, stdin=stdin)
+    runtime = time.monotonic() - started
+    cached = False
+    try:
+        with phase('commit'):
+            if writer is not None and returncode == 0: # TODO and not stderr:
+                cached = writer.commit(returncode, runtime)
+            elif writer is not None:
+                writer.discard()
+    except Exception:
+        pass
+    annotate(outcome='miss' if cached else 'uncacheable', key=cache_key)
+    with phase('stats'):
+        record_stats('miss' if cached else 'uncacheable', cache_key, 0, runtime)
+    try:
+        release_key_lock(cache_key, lock_fd)
+    except Exception:
+        pass
     sys.exit(returncode)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,96 @@
+import zlib
+
+# codec ids are stored in the flags of an entry header, never renumber them
+CODECS = {'zlib': 1, 'lzma': 2, 'zstd': 3}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODECS.items()}
+
+def _import_zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        pass
+    try:
+        # the standard library ships zstd from Python 3.14 on
+        from compression import zstd
+        return zstd
+    except ImportError:
+        return None
+
+_zstd = False
+
+def get_zstd():
+    global _zstd
+    if _zstd is False:
+        _zstd = _import_zstd()
+    return _zstd
+
+def is_available(name):
+    if name == 'zstd':
+        return get_zstd() is not None
+    return name in CODECS
+
+'''
+return an object with compress(data) and flush() like zlib.compressobj
+'''
+def compressor(name):
+    if name == 'zlib':
+        return zlib.compressobj()
+    if name == 'lzma':
+        import lzma
+        return lzma.LZMACompressor()
+    if name == 'zstd':
+        zstd = get_zstd()
+        if hasattr(zstd, 'ZstdCompressor') and hasattr(zstd.ZstdCompressor, 'compressobj'):
+            return zstd.ZstdCompressor().compressobj()
+        return zstd.ZstdCompressor()
+    raise ValueError(f"unknown codec {name}")
+
+'''
+return an object with decompress(data) like zlib.decompressobj
+'''
+def decompressor(name):
+    if name == 'zlib':
+        return zlib.decompressobj()
+    if name == 'lzma':
+        import lzma
+        return lzma.LZMADecompressor()
+    if name == 'zstd':
+        zstd = get_zstd()
+        if hasattr(zstd, 'ZstdDecompressor') and hasattr(zstd.ZstdDecompressor, 'decompressobj'):
+            return zstd.ZstdDecompressor().decompressobj()
+        return zstd.ZstdDecompressor()
+    raise ValueError(f"unknown codec {name}")
+
+'''
+yield what data decompresses to with a decompressor from decompressor(), in
+pieces of at most max_length bytes where the codec allows it: zlib keeps the
+input it didn't get to in unconsumed_tail, lzma and the standard library's
+zstd buffer it until needs_input; zstandard's decompressobj can't be bounded
+'''
+def decompress_chunks(decompressor, data, max_length):
+    if hasattr(decompressor, 'unconsumed_tail'):
+        while data:
+            chunk = decompressor.decompress(data, max_length)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+    elif hasattr(decompressor, 'needs_input'):
+        chunk = decompressor.decompress(data, max_length)
+        while True:
+            if chunk:
+                yield chunk
+            if decompressor.needs_input or decompressor.eof:
+                return
+            chunk = decompressor.decompress(b'', max_length)
+    else:
+        chunk = decompressor.decompress(data)
+        if chunk:
+            yield chunk
+
+def compress(name, data):
+    c = compressor(name)
+    return c.compress(data) + c.flush()
+
+def decompress(name, data):
+    return decompressor(name).decompress(data)
@@ -1,12 +1,45 @@
 import os
-from configparser import ConfigParser
+import time
+import _thread
+import marshal
 
 DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), '.cache', 'bincache')
 DEFAULT_MAX_SIZE = 5 * 1024 * 1024 * 1024  # 5G
 DEFAULT_LOG_FILE = ""
 DEFAULT_LOG_LEVEL = "INFO"
 DEFAULT_STATS = False
+DEFAULT_HASH_ALGORITHM = "blake2b"
+HASH_ALGORITHMS = ("blake2b", "sha256", "xxh3", "md5")
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_METADATA_INDEX = False
+DEFAULT_HIGH_WATERMARK = 1.0
+DEFAULT_LOW_WATERMARK = 0.9
+DEFAULT_BACKGROUND_GC = True
+DEFAULT_LOCK_TIMEOUT = 300
+DEFAULT_COMPRESSION = "none"
+COMPRESSION_CODECS = ("none", "zlib", "lzma", "zstd")
+DEFAULT_COMPRESSION_MIN_SIZE = 4 * 1024  # 4K
+DEFAULT_SPILL_THRESHOLD = 16 * 1024 * 1024  # 16M
+DEFAULT_MAX_ENTRY_SIZE = 1024 * 1024 * 1024  # 1G
+DEFAULT_MAX_STDIN_SIZE = 64 * 1024 * 1024  # 64M
+DEFAULT_BATCH_WORKERS = os.cpu_count() or 1
+DEFAULT_TRACK_INPUTS = False
+DEFAULT_SECONDARY = ""
+DEFAULT_SECONDARY_TIMEOUT = 5
+DEFAULT_BACKGROUND_PUSH = True
+DEFAULT_DEDUPLICATE = False
+DEFAULT_PROFILE = "off"
+PROFILE_MODES = ("off", "timings", "cprofile")
+DEFAULT_PROFILE_FILE = "profile.jsonl"
 CONFIG_FILE = 'bincache.conf'
+# The parsed configuration is cached next to bincache.conf, so a call doesn't
+# need configparser as long as the file is unchanged.
+CONFIG_CACHE_FILE = 'config.cache'
+# bump whenever an option is added, the cache holds the defaults too
+CONFIG_CACHE_VERSION = 9
+# bincache.conf changed less than this long ago is parsed but not cached, an
+# edit landing in the same timestamp tick would otherwise go unnoticed
+CONFIG_CACHE_RACY_WINDOW_NS = 2 * 10**9
 
 _config = None
 
@@ -18,6 +51,139 @@ def parse_size(size_str):
             return int(size_str[:-1]) * units[unit]
     return int(size_str)
 
+def parse_ratio(ratio_str):
+    """parse a fraction of max_size, either '90%' or '0.9'."""
+    ratio_str = ratio_str.strip()
+    if ratio_str.endswith('%'):
+        return float(ratio_str[:-1]) / 100
+    return float(ratio_str)
+
+def parse_rewrite_rules(rules_str):
+    """parse one `pattern => replacement` rule per line into a list of (pattern, replacement)."""
+    import re
+    rules = []
+    for line in rules_str.splitlines():
+        if not line.strip():
+            continue
+        pattern, separator, replacement = line.strip().partition(' => ')
+        if not separator:
+            raise ValueError(f"rewrite rule without ' => ': {line.strip()}")
+        re.compile(pattern)
+        rules.append((pattern, replacement))
+    return rules
+
+def parse_key_policy(config, section):
+    """the options of a [key] or [key:<binary>] section that are set."""
+    policy = {}
+    if config.has_option(section, 'env') and config.get(section, 'env') is not None:
+        policy['env'] = config.get(section, 'env').replace(',', ' ').split()
+    if config.has_option(section, 'cwd') and config.get(section, 'cwd') is not None:
+        policy['cwd'] = config.getboolean(section, 'cwd')
+    if config.has_option(section, 'rewrite') and config.get(section, 'rewrite') is not None:
+        policy['rewrite'] = parse_rewrite_rules(config.get(section, 'rewrite'))
+    if config.has_option(section, 'stdin') and config.get(section, 'stdin') is not None:
+        policy['stdin'] = config.getboolean(section, 'stdin')
+    return policy
+
+def load_cached_config(cache_path, identity):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(cached, tuple) or len(cached) != 2 or cached[0] != identity:
+        return None
+    return cached[1]
+
+def save_cached_config(cache_path, identity, config_params):
+    temp_path = f"{cache_path}.{os.getpid()}.{_thread.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            marshal.dump((identity, config_params), f)
+        os.replace(temp_path, cache_path)
+    except (OSError, ValueError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def read_config_file(config_file, config_params, cache_dir):
+    """update config_params with the options set in config_file."""
+    from configparser import ConfigParser
+    with open(config_file, 'r') as f:
+        config_string = f"[DEFAULT]\n" + f.read()
+    config = ConfigParser(allow_no_value=True, interpolation=None)
+    config.read_string(config_string)
+    if config.has_option('DEFAULT', 'max_size') and config.get('DEFAULT', 'max_size') is not None:
+        config_params['max_size'] = parse_size(config.get('DEFAULT', 'max_size'))
+    if config.has_option('DEFAULT', 'log_file') and config.get('DEFAULT', 'log_file') is not None:
+        log_file = config.get('DEFAULT', 'log_file')
+        if not os.path.isabs(log_file) and not log_file.startswith('.' + os.sep):
+            log_file = os.path.join(cache_dir, log_file)
+        config_params['log_file'] = log_file
+    if config.has_option('DEFAULT', 'log_level') and config.get('DEFAULT', 'log_level') is not None:
+        config_params['log_level'] = config.get('DEFAULT', 'log_level').upper()
+    if config.has_option('DEFAULT', 'stats') and config.get('DEFAULT', 'stats') is not None:
+        config_params['stats'] = config.getboolean('DEFAULT', 'stats')
+    if config.has_option('DEFAULT', 'profile') and config.get('DEFAULT', 'profile') is not None:
+        profile = config.get('DEFAULT', 'profile').strip().lower()
+        if profile in PROFILE_MODES:
+            config_params['profile'] = profile
+        elif profile:
+            config_params['profile'] = 'timings' if config.getboolean('DEFAULT', 'profile') else 'off'
+    if config.has_option('DEFAULT', 'profile_file') and config.get('DEFAULT', 'profile_file') is not None:
+        profile_file = config.get('DEFAULT', 'profile_file')
+        if profile_file and not os.path.isabs(profile_file) and not profile_file.startswith('.' + os.sep):
+            profile_file = os.path.join(cache_dir, profile_file)
+        config_params['profile_file'] = profile_file
+    if config.has_option('DEFAULT', 'hash_algorithm') and config.get('DEFAULT', 'hash_algorithm') is not None:
+        hash_algorithm = config.get('DEFAULT', 'hash_algorithm').lower()
+        if hash_algorithm in HASH_ALGORITHMS:
+            config_params['hash_algorithm'] = hash_algorithm
+    if config.has_option('DEFAULT', 'hash_workers') and config.get('DEFAULT', 'hash_workers') is not None:
+        config_params['hash_workers'] = max(1, config.getint('DEFAULT', 'hash_workers'))
+    if config.has_option('DEFAULT', 'metadata_index') and config.get('DEFAULT', 'metadata_index') is not None:
+        config_params['metadata_index'] = config.getboolean('DEFAULT', 'metadata_index')
+    if config.has_option('DEFAULT', 'high_watermark') and config.get('DEFAULT', 'high_watermark') is not None:
+        config_params['high_watermark'] = parse_ratio(config.get('DEFAULT', 'high_watermark'))
+    if config.has_option('DEFAULT', 'low_watermark') and config.get('DEFAULT', 'low_watermark') is not None:
+        config_params['low_watermark'] = parse_ratio(config.get('DEFAULT', 'low_watermark'))
+    if config.has_option('DEFAULT', 'background_gc') and config.get('DEFAULT', 'background_gc') is not None:
+        config_params['background_gc'] = config.getboolean('DEFAULT', 'background_gc')
+    if config.has_option('DEFAULT', 'lock_timeout') and config.get('DEFAULT', 'lock_timeout') is not None:
+        config_params['lock_timeout'] = config.getfloat('DEFAULT', 'lock_timeout')
+    if config.has_option('DEFAULT', 'compression') and config.get('DEFAULT', 'compression') is not None:
+        compression = config.get('DEFAULT', 'compression').lower()
+        if compression in COMPRESSION_CODECS:
+            config_params['compression'] = compression
+    if config.has_option('DEFAULT', 'compression_min_size') and config.get('DEFAULT', 'compression_min_size') is not None:
+        config_params['compression_min_size'] = parse_size(config.get('DEFAULT', 'compression_min_size'))
+    if config.has_option('DEFAULT', 'spill_threshold') and config.get('DEFAULT', 'spill_threshold') is not None:
+        config_params['spill_threshold'] = parse_size(config.get('DEFAULT', 'spill_threshold'))
+    if config.has_option('DEFAULT', 'max_entry_size') and config.get('DEFAULT', 'max_entry_size') is not None:
+        config_params['max_entry_size'] = parse_size(config.get('DEFAULT', 'max_entry_size'))
+    if config.has_option('DEFAULT', 'max_stdin_size') and config.get('DEFAULT', 'max_stdin_size') is not None:
+        config_params['max_stdin_size'] = parse_size(config.get('DEFAULT', 'max_stdin_size'))
+    if config.has_option('DEFAULT', 'batch_workers') and config.get('DEFAULT', 'batch_workers') is not None:
+        config_params['batch_workers'] = max(1, config.getint('DEFAULT', 'batch_workers'))
+    if config.has_option('DEFAULT', 'track_inputs') and config.get('DEFAULT', 'track_inputs') is not None:
+        config_params['track_inputs'] = config.getboolean('DEFAULT', 'track_inputs')
+    if config.has_option('DEFAULT', 'secondary') and config.get('DEFAULT', 'secondary') is not None:
+        config_params['secondary'] = config.get('DEFAULT', 'secondary')
+    if config.has_option('DEFAULT', 'secondary_timeout') and config.get('DEFAULT', 'secondary_timeout') is not None:
+        config_params['secondary_timeout'] = config.getfloat('DEFAULT', 'secondary_timeout')
+    if config.has_option('DEFAULT', 'background_push') and config.get('DEFAULT', 'background_push') is not None:
+        config_params['background_push'] = config.getboolean('DEFAULT', 'background_push')
+    if config.has_option('DEFAULT', 'deduplicate') and config.get('DEFAULT', 'deduplicate') is not None:
+        config_params['deduplicate'] = config.getboolean('DEFAULT', 'deduplicate')
+    if config.has_option('DEFAULT', 'temporary_dir') and config.get('DEFAULT', 'temporary_dir') is not None:
+        config_params['temporary_dir'] = config.get('DEFAULT', 'temporary_dir')
+    for section in config.sections():
+        if section == 'key':
+            config_params['key_policy'] = parse_key_policy(config, section)
+        elif section.startswith('key:'):
+            config_params['key_policies'][section[len('key:'):]] = parse_key_policy(config, section)
+
 def get_config():
     global _config
     if not _config:
@@ -28,26 +194,46 @@ def get_config():
             'log_file': DEFAULT_LOG_FILE,
             'log_level': DEFAULT_LOG_LEVEL,
             'stats': DEFAULT_STATS,
+            'hash_algorithm': DEFAULT_HASH_ALGORITHM,
+            'hash_workers': DEFAULT_HASH_WORKERS,
+            'metadata_index': DEFAULT_METADATA_INDEX,
+            'high_watermark': DEFAULT_HIGH_WATERMARK,
+            'low_watermark': DEFAULT_LOW_WATERMARK,
+            'background_gc': DEFAULT_BACKGROUND_GC,
+            'lock_timeout': DEFAULT_LOCK_TIMEOUT,
+            'compression': DEFAULT_COMPRESSION,
+            'compression_min_size': DEFAULT_COMPRESSION_MIN_SIZE,
+            'spill_threshold': DEFAULT_SPILL_THRESHOLD,
+            'max_entry_size': DEFAULT_MAX_ENTRY_SIZE,
+            'max_stdin_size': DEFAULT_MAX_STDIN_SIZE,
+            'batch_workers': DEFAULT_BATCH_WORKERS,
+            'track_inputs': DEFAULT_TRACK_INPUTS,
+            'secondary': DEFAULT_SECONDARY,
+            'secondary_timeout': DEFAULT_SECONDARY_TIMEOUT,
+            'background_push': DEFAULT_BACKGROUND_PUSH,
+            'deduplicate': DEFAULT_DEDUPLICATE,
+            'profile': DEFAULT_PROFILE,
+            'profile_file': os.path.join(cache_dir, DEFAULT_PROFILE_FILE),
+            'key_policy': {},
+            'key_policies': {},
             'temporary_dir': os.path.join(cache_dir, 'tmp'),
             'cache_dir': cache_dir
         }
-        if os.path.exists(config_file):
-            with open(config_file, 'r') as f:
-                config_string = f"[DEFAULT]\n" + f.read()
-            config = ConfigParser(allow_no_value=True)
-            config.read_string(config_string)
-            if config.has_option('DEFAULT', 'max_size') and config.get('DEFAULT', 'max_size') is not None:
-                config_params['max_size'] = parse_size(config.get('DEFAULT', 'max_size'))
-            if config.has_option('DEFAULT', 'log_file') and config.get('DEFAULT', 'log_file') is not None:
-                log_file = config.get('DEFAULT', 'log_file')
-                if not os.path.isabs(log_file) and not log_file.startswith('.' + os.sep):
-                    log_file = os.path.join(cache_dir, log_file)
-                config_params['log_file'] = log_file
-            if config.has_option('DEFAULT', 'log_level') and config.get('DEFAULT', 'log_level') is not None:
-                config_params['log_level'] = config.get('DEFAULT', 'log_level').upper()
-            if config.has_option('DEFAULT', 'stats') and config.get('DEFAULT', 'stats') is not None:
-                config_params['stats'] = config.getboolean('DEFAULT', 'stats')
-            if config.has_option('DEFAULT', 'temporary_dir') and config.get('DEFAULT', 'temporary_dir') is not None:
-                config_params['temporary_dir'] = config.get('DEFAULT', 'temporary_dir')
+        try:
+            st = os.stat(config_file)
+        except OSError:
+            st = None
+        if st is not None:
+            identity = (CONFIG_CACHE_VERSION, config_file, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+            cache_path = os.path.join(cache_dir, CONFIG_CACHE_FILE)
+            cached = load_cached_config(cache_path, identity)
+            if cached is not None:
+                config_params = cached
+            else:
+                read_config_file(config_file, config_params, cache_dir)
+                config_params['low_watermark'] = min(config_params['low_watermark'], config_params['high_watermark'])
+                if time.time_ns() - st.st_mtime_ns > CONFIG_CACHE_RACY_WINDOW_NS:
+                    save_cached_config(cache_path, identity, config_params)
+        config_params['low_watermark'] = min(config_params['low_watermark'], config_params['high_watermark'])
         _config = config_params
     return _config
\ No newline at end of file
@@ -0,0 +1,188 @@
+import os
+import sys
+import struct
+import marshal
+
+from bincache.config import get_config
+from bincache import logger
+
+SOCKET_FILE = 'daemon.sock'
+DAEMON_LOCK_FILE = 'daemon.lock'
+# a client that doesn't hear back within this many seconds computes the key itself
+CLIENT_TIMEOUT = 5
+MESSAGE_HEADER = struct.Struct('<I')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+FD_SIZE = struct.calcsize('i')
+
+def get_socket_path(cache_dir=None):
+    return os.path.join(cache_dir or get_config()['cache_dir'], SOCKET_FILE)
+
+def encode_message(value):
+    data = marshal.dumps(value)
+    return MESSAGE_HEADER.pack(len(data)) + data
+
+def recv_message(sock, with_fds=False):
+    """return (message, fds) read from sock, fds are only received with with_fds."""
+    import _socket
+    data, fds = b'', []
+    while len(data) < MESSAGE_HEADER.size or len(data) < MESSAGE_HEADER.size + MESSAGE_HEADER.unpack_from(data)[0]:
+        if with_fds and not data:
+            chunk, ancdata, _, _ = sock.recvmsg(RECV_SIZE, _socket.CMSG_SPACE(FD_SIZE))
+            for level, kind, fd_data in ancdata:
+                if level == _socket.SOL_SOCKET and kind == _socket.SCM_RIGHTS:
+                    fds += [fd for fd, in struct.iter_unpack('i', fd_data[:len(fd_data) - len(fd_data) % FD_SIZE])]
+        else:
+            chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            raise ConnectionError("connection closed in the middle of a message")
+        data += chunk
+        if len(data) >= MESSAGE_HEADER.size and MESSAGE_HEADER.unpack_from(data)[0] > MAX_MESSAGE_SIZE:
+            raise ValueError("message too large")
+    return marshal.loads(data[MESSAGE_HEADER.size:]), fds
+
+def send_message(sock, message, fd=None):
+    """send message, passing fd along with its first byte."""
+    import _socket
+    data = encode_message(message)
+    if fd is not None:
+        sock.sendmsg([data[:1]], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, struct.pack('i', fd))])
+        data = data[1:]
+    sock.sendall(data)
+
+'''
+ask a running daemon for the cache key of argv and the entry to replay,
+return (key, entry) like cli.lookup, None if no daemon answers
+'''
+def query(argv, stdin_digest=None):
+    socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    # the socket module pulls in enum and selectors, more than the whole lookup
+    # costs; the client only needs what _socket has
+    import _socket
+    fds = []
+    try:
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            send_message(sock, {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ), 'stdin': stdin_digest})
+            reply, fds = recv_message(sock, with_fds=True)
+        finally:
+            sock.close()
+        if 'error' in reply:
+            logger.warning(f"bincache daemon failed: {reply['error']}")
+            return None
+        entry = reply['entry']
+        if entry is not None:
+            if len(fds) != 1:
+                raise ValueError("entry without file descriptor")
+            entry['file'] = os.fdopen(fds.pop(), 'rb', buffering=0)
+        return reply['key'], entry
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        return None
+
+def lock_daemon(cache_dir):
+    """return a file descriptor holding the daemon lock, None if a daemon already runs."""
+    import fcntl
+    fd = os.open(os.path.join(cache_dir, DAEMON_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def is_same_user(conn):
+    import socket
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+def has_relative_dirs(path_list):
+    # empty entries mean the current directory
+    return any(not os.path.isabs(directory) for directory in path_list.split(':')) if path_list else False
+
+def handle_request(request, lookup):
+    """compute the key of a client's argv for its cwd and environment, which are passed along, never switched to."""
+    environ = request['env']
+    if has_relative_dirs(environ.get('LD_LIBRARY_PATH', '')):
+        # libraries are searched there relative to the process' own directory, the client's isn't ours
+        raise ValueError("LD_LIBRARY_PATH has relative directories")
+    key, entry = lookup(request['argv'], request.get('stdin'), environ, request['cwd'])
+    if entry is None:
+        return {'key': key, 'entry': None}, None
+    f = entry.pop('file')
+    return {'key': key, 'entry': entry}, f
+
+def handle_connection(conn, lookup):
+    f = None
+    try:
+        if not is_same_user(conn):
+            return
+        request, _ = recv_message(conn)
+        try:
+            reply, f = handle_request(request, lookup)
+        except Exception as e:
+            logger.warning(f"bincache daemon failed on {request.get('argv')}: {e}")
+            reply = {'error': str(e)}
+        send_message(conn, reply, None if f is None else f.fileno())
+    except Exception as e:
+        logger.warning(f"bincache daemon dropped a connection: {e}")
+    finally:
+        if f is not None:
+            f.close()
+
+def serve_connection(conn, lookup):
+    with conn:
+        conn.settimeout(CLIENT_TIMEOUT)
+        handle_connection(conn, lookup)
+
+'''
+serve key lookups on cache_dir/daemon.sock until killed; every connection is
+served on a thread of its own, so a cold lookup doesn't hold up the others
+'''
+def serve():
+    import socket
+    import signal
+    import threading
+    from bincache import config
+    from bincache.cli import lookup
+    cache_dir = get_config()['cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+    lock_fd = lock_daemon(cache_dir)
+    if lock_fd is None:
+        return False
+    socket_path = get_socket_path(cache_dir)
+    # SIGTERM should remove the socket like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            old_umask = os.umask(0o177)
+            try:
+                server.bind(socket_path)
+            finally:
+                os.umask(old_umask)
+            server.listen(64)
+            logger.info(f"bincache daemon listening on {socket_path}")
+            while True:
+                conn, _ = server.accept()
+                # pick up bincache.conf changes, a no-op while config.cache is current
+                config._config = None
+                threading.Thread(target=serve_connection, args=(conn, lookup), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        os.close(lock_fd)
+    return True
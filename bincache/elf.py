@@ -0,0 +1,303 @@
+import os
+import struct
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+MAX_PHNUM = 4096
+
+LD_SO_CACHE = '/etc/ld.so.cache'
+LD_SO_PRELOAD = '/etc/ld.so.preload'
+LD_SO_CACHE_OLD_MAGIC = b'ld.so-1.7.0'
+LD_SO_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+DEFAULT_LIB_DIRS = {
+    ELFCLASS32: ['/lib', '/usr/lib'],
+    ELFCLASS64: ['/lib64', '/usr/lib64', '/lib', '/usr/lib'],
+}
+
+class ELFError(Exception):
+    pass
+
+def _unpack(fmt, data, offset=0):
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error as e:
+        raise ELFError(f"truncated ELF data: {e}")
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise ELFError("truncated ELF file")
+    return data
+
+def _vaddr_to_offset(loads, vaddr):
+    for p_offset, p_vaddr, p_filesz in loads:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+    raise ELFError(f"address {vaddr:#x} is not in a PT_LOAD segment")
+
+def _split_path_list(value):
+    return [path for path in value.split(':') if path] if value else []
+
+'''
+return dict of ELF class, machine, interp, needed, soname, rpath and runpath,
+None if path is not an ELF file
+'''
+def read_elf(path):
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(16)
+            if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+                return None
+            elf_class, elf_data = ident[4], ident[5]
+            if elf_class not in (ELFCLASS32, ELFCLASS64) or elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+                raise ELFError(f"unsupported ELF class or data encoding: {path}")
+            endian = '<' if elf_data == ELFDATA2LSB else '>'
+            if elf_class == ELFCLASS64:
+                header_fmt, phdr_fmt, dyn_fmt = endian + 'HHIQQQIHHHHHH', endian + 'IIQQQQQQ', endian + 'qQ'
+            else:
+                header_fmt, phdr_fmt, dyn_fmt = endian + 'HHIIIIIHHHHHH', endian + 'IIIIIIII', endian + 'iI'
+            header = _unpack(header_fmt, _read_at(f, 16, struct.calcsize(header_fmt)))
+            machine, phoff, phentsize, phnum = header[1], header[4], header[8], header[9]
+            if phnum > MAX_PHNUM or (phnum and phentsize < struct.calcsize(phdr_fmt)):
+                raise ELFError(f"unsupported program header table: {path}")
+            phdrs = _read_at(f, phoff, phentsize * phnum)
+            loads, dynamic, interp_segment = [], None, None
+            for i in range(phnum):
+                fields = _unpack(phdr_fmt, phdrs, i * phentsize)
+                if elf_class == ELFCLASS64:
+                    p_type, p_offset, p_vaddr, p_filesz = fields[0], fields[2], fields[3], fields[5]
+                else:
+                    p_type, p_offset, p_vaddr, p_filesz = fields[0], fields[1], fields[2], fields[4]
+                if p_type == PT_LOAD:
+                    loads.append((p_offset, p_vaddr, p_filesz))
+                elif p_type == PT_DYNAMIC:
+                    dynamic = (p_offset, p_filesz)
+                elif p_type == PT_INTERP:
+                    interp_segment = (p_offset, p_filesz)
+
+            info = {'class': elf_class, 'machine': machine, 'interp': None, 'needed': [],
+                    'soname': None, 'rpath': [], 'runpath': []}
+            if interp_segment:
+                interp = _read_at(f, *interp_segment).split(b'\0', 1)[0]
+                info['interp'] = os.fsdecode(interp)
+            if dynamic is None:
+                return info
+
+            dyn_size = struct.calcsize(dyn_fmt)
+            data = _read_at(f, *dynamic)
+            entries = []
+            for tag, value in struct.iter_unpack(dyn_fmt, data[:len(data) - len(data) % dyn_size]):
+                if tag == DT_NULL:
+                    break
+                entries.append((tag, value))
+            tags = dict(entries)
+            string_tags = (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH)
+            if not any(tag in string_tags for tag, _ in entries):
+                return info
+            if DT_STRTAB not in tags or DT_STRSZ not in tags:
+                raise ELFError(f"dynamic section without string table: {path}")
+            strtab = _read_at(f, _vaddr_to_offset(loads, tags[DT_STRTAB]), tags[DT_STRSZ])
+    except OSError as e:
+        raise ELFError(str(e))
+
+    def string_at(offset):
+        end = strtab.find(b'\0', offset)
+        if offset >= len(strtab) or end < 0:
+            raise ELFError(f"string offset {offset} out of range: {path}")
+        return os.fsdecode(strtab[offset:end])
+
+    for tag, value in entries:
+        if tag == DT_NEEDED:
+            info['needed'].append(string_at(value))
+        elif tag == DT_SONAME:
+            info['soname'] = string_at(value)
+        elif tag == DT_RPATH:
+            info['rpath'].extend(_split_path_list(string_at(value)))
+        elif tag == DT_RUNPATH:
+            info['runpath'].extend(_split_path_list(string_at(value)))
+    return info
+
+'''
+return dict of soname -> list of (path, hwcap) from ld.so.cache
+'''
+def parse_ld_so_cache(data):
+    offset = 0
+    if data.startswith(LD_SO_CACHE_OLD_MAGIC):
+        nlibs, = _unpack('=I', data, 12)
+        offset = (16 + nlibs * 12 + 7) & ~7
+    if data[offset:offset + len(LD_SO_CACHE_MAGIC)] != LD_SO_CACHE_MAGIC:
+        raise ELFError("unsupported ld.so.cache format")
+    nlibs, = _unpack('=I', data, offset + 20)
+    table = data[offset + 48:offset + 48 + nlibs * 24]
+    if len(table) != nlibs * 24:
+        raise ELFError("truncated ld.so.cache")
+    libraries = {}
+    for _, key, value, _, hwcap in struct.iter_unpack('=iIIIQ', table):
+        key_end = data.find(b'\0', offset + key)
+        value_end = data.find(b'\0', offset + value)
+        if key_end < 0 or value_end < 0:
+            raise ELFError("truncated ld.so.cache")
+        soname = data[offset + key:key_end].decode('utf-8', 'surrogateescape')
+        path = data[offset + value:value_end].decode('utf-8', 'surrogateescape')
+        libraries.setdefault(soname, []).append((path, hwcap))
+    return libraries
+
+_ld_so_caches = {}
+
+def load_ld_so_cache(cache_path=None):
+    """parse_ld_so_cache of the file, kept in memory until the file changes."""
+    cache_path = cache_path or LD_SO_CACHE
+    try:
+        with open(cache_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            cached = _ld_so_caches.get(cache_path)
+            if cached is not None and cached[0] == identity:
+                return cached[1]
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    except OSError as e:
+        raise ELFError(str(e))
+    libraries = parse_ld_so_cache(data)
+    _ld_so_caches[cache_path] = (identity, libraries)
+    return libraries
+
+def _expand_origin(paths, origin):
+    expanded = []
+    for path in paths:
+        path = path.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+        if '$' in path:
+            # $LIB and $PLATFORM depend on the running loader, leave them to ldd
+            raise ELFError(f"unsupported dynamic string token in {path}")
+        expanded.append(path)
+    return expanded
+
+'''
+return list of ('libname', 'libpath', 'address') in load order like ldd reports it,
+or None if binary is not an ELF file. Raises ELFError whenever the result could
+differ from what the dynamic loader would do, so callers can fall back to ldd.
+'''
+def get_dynamic_libs(binary, ld_library_path=None, ld_so_cache=None, ld_preload=None):
+    main = read_elf(binary)
+    if main is None:
+        return None
+    if main['interp'] is None and not main['needed']:
+        return []
+    if ld_preload is None:
+        ld_preload = os.environ.get('LD_PRELOAD', '')
+    if ld_preload:
+        raise ELFError("LD_PRELOAD is set")
+    try:
+        if os.path.getsize(LD_SO_PRELOAD):
+            raise ELFError(f"{LD_SO_PRELOAD} is not empty")
+    except OSError:
+        pass
+    if ld_library_path is None:
+        ld_library_path = os.environ.get('LD_LIBRARY_PATH', '')
+    # empty LD_LIBRARY_PATH entries mean the current directory
+    env_dirs = [path or '.' for path in ld_library_path.split(':')] if ld_library_path else []
+    cache = None
+    infos = {}
+
+    def is_compatible(path):
+        if path not in infos:
+            try:
+                info = read_elf(path)
+            except ELFError:
+                info = None
+            if info is not None and (info['class'], info['machine']) != (main['class'], main['machine']):
+                info = None
+            infos[path] = info
+        return infos[path] is not None
+
+    def search(name, dirs):
+        for directory in dirs:
+            path = os.path.join(directory, name)
+            if is_compatible(path):
+                return path
+        return None
+
+    def resolve(name, obj):
+        nonlocal cache
+        if '/' in name:
+            return name if is_compatible(name) else None
+        if not obj['info']['runpath']:
+            path = search(name, [d for o in obj['chain'] for d in o['rpath']])
+            if path:
+                return path
+        path = search(name, env_dirs) or search(name, obj['runpath'])
+        if path:
+            return path
+        if cache is None:
+            cache = load_ld_so_cache(ld_so_cache)
+        candidates = cache.get(name, [])
+        if any(hwcap for _, hwcap in candidates):
+            raise ELFError(f"hwcap specific libraries for {name}")
+        for path, _ in candidates:
+            if is_compatible(path):
+                return path
+        return search(name, DEFAULT_LIB_DIRS[main['class']])
+
+    def make_object(path, info, loader):
+        # like the loader: the executable's origin comes from /proc/self/exe,
+        # a library's origin is the directory of the path it was found at
+        if loader is None:
+            origin = os.path.dirname(os.path.realpath(path))
+        else:
+            origin = os.path.dirname(os.path.join(os.getcwd(), path))
+        obj = {'info': info,
+               'rpath': [] if info['runpath'] else _expand_origin(info['rpath'], origin),
+               'runpath': _expand_origin(info['runpath'], origin)}
+        # DT_RPATH of the loader chain up to the executable is searched first
+        obj['chain'] = [obj] + (loader['chain'] if loader else [])
+        return obj
+
+    libs = []
+    loaded = {}
+    interp = main['interp']
+    if interp:
+        interp_info = read_elf(interp)
+        if interp_info is None:
+            raise ELFError(f"interpreter {interp} is not an ELF file")
+        loaded[interp_info['soname'] or os.path.basename(interp)] = interp
+        loaded[os.path.realpath(interp)] = interp
+    queue = [make_object(binary, main, None)]
+    while queue:
+        obj = queue.pop(0)
+        for name in obj['info']['needed']:
+            if name in loaded:
+                continue
+            path = resolve(name, obj)
+            if path is None:
+                raise ELFError(f"{name} not found")
+            realpath = os.path.realpath(path)
+            if realpath in loaded:
+                loaded[name] = loaded[realpath]
+                continue
+            info = infos[path]
+            loaded[name] = loaded[realpath] = path
+            if info['soname']:
+                loaded.setdefault(info['soname'], path)
+            libs.append((name, path, ''))
+            queue.append(make_object(path, info, obj))
+    if interp:
+        libs.append(('', interp, ''))
+    return libs
@@ -0,0 +1,99 @@
+import os
+import time
+
+INDEX_FILE = 'index.sqlite'
+INDEX_VERSION = 1
+BUSY_TIMEOUT = 10
+# A hit records its access with this probability and counts 1/TOUCH_PROBABILITY
+# hits, so hot entries stay fresh without a write transaction on every hit.
+TOUCH_PROBABILITY = 0.125
+EVICTION_BATCH = 256
+
+_connections = {}
+
+def get_connection(cache_dir):
+    connection = _connections.get(cache_dir)
+    if connection is None:
+        import sqlite3
+        connection = sqlite3.connect(os.path.join(cache_dir, INDEX_FILE), timeout=BUSY_TIMEOUT,
+                                     isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        if connection.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            initialize(connection, cache_dir)
+        _connections[cache_dir] = connection
+    return connection
+
+def initialize(connection, cache_dir):
+    """create the schema and import the entries already on disk."""
+    from bincache.cache import scan_cache_dir
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if connection.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            connection.execute('DROP TABLE IF EXISTS entries')
+            connection.execute('CREATE TABLE entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                               'created REAL NOT NULL, last_access REAL NOT NULL, hit_count INTEGER NOT NULL DEFAULT 0)')
+            connection.execute('CREATE INDEX entries_last_access ON entries (last_access)')
+            connection.executemany('INSERT OR REPLACE INTO entries (key, size, created, last_access) VALUES (?, ?, ?, ?)',
+                                   [(path_to_key(path), size, mtime, mtime) for path, mtime, size in scan_cache_dir(cache_dir)])
+            connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+def close():
+    for connection in _connections.values():
+        connection.close()
+    _connections.clear()
+
+def path_to_key(path):
+    prefix, filename = os.path.split(path)
+    return os.path.basename(prefix) + filename
+
+def record_put(cache_dir, key, size):
+    now = time.time()
+    get_connection(cache_dir).execute(
+        'INSERT OR REPLACE INTO entries (key, size, created, last_access, hit_count) VALUES (?, ?, ?, ?, 0)',
+        (key, size, now, now))
+
+def record_hit(cache_dir, key):
+    if TOUCH_PROBABILITY < 1 and int.from_bytes(os.urandom(4), 'little') >= TOUCH_PROBABILITY * 2**32:
+        return
+    get_connection(cache_dir).execute(
+        'UPDATE entries SET last_access = ?, hit_count = hit_count + ? WHERE key = ?',
+        (time.time(), round(1 / TOUCH_PROBABILITY), key))
+
+def record_delete(cache_dir, keys):
+    connection = get_connection(cache_dir)
+    connection.execute('BEGIN')
+    connection.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+    connection.execute('COMMIT')
+
+'''
+yield (key, size) from least to most recently used
+'''
+def iter_lru(cache_dir):
+    cursor = get_connection(cache_dir).execute('SELECT key, size FROM entries ORDER BY last_access')
+    while True:
+        rows = cursor.fetchmany(EVICTION_BATCH)
+        if not rows:
+            break
+        yield from rows
+
+def sync(cache_dir, entries):
+    """make the index match a full scan of the cache directory, keeping access times of known keys."""
+    connection = get_connection(cache_dir)
+    on_disk = {path_to_key(path): (size, mtime) for path, mtime, size in entries}
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        indexed = dict(connection.execute('SELECT key, size FROM entries'))
+        connection.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in indexed if key not in on_disk])
+        connection.executemany('INSERT INTO entries (key, size, created, last_access) VALUES (?, ?, ?, ?)',
+                               [(key, size, mtime, mtime) for key, (size, mtime) in on_disk.items() if key not in indexed])
+        connection.executemany('UPDATE entries SET size = ? WHERE key = ?',
+                               [(size, key) for key, (size, _) in on_disk.items() if key in indexed and indexed[key] != size])
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
@@ -0,0 +1,158 @@
+import os
+import stat
+
+from bincache.config import get_config, DEFAULT_MAX_STDIN_SIZE
+from bincache.signature import get_file_hash, get_file_hashes, new_hash, get_hash_algorithm, HASH_BUFFER_SIZE
+
+STDIN_FD = 0
+
+def get_arg_files(args, cwd=None):
+    """return (arg, path) of the args naming existing regular files, relative ones resolved against cwd."""
+    files = []
+    for arg in args:
+        if not arg:
+            continue
+        path = os.path.join(cwd or os.getcwd(), arg)
+        try:
+            if stat.S_ISREG(os.stat(path).st_mode):
+                files.append((arg, path))
+        except (OSError, ValueError):
+            pass
+    return files
+
+'''
+return [('file', arg, digest)] for the args naming existing regular files, the
+digests come from the same stat-keyed memos as the binary's
+'''
+def hash_arg_files(args, cwd=None):
+    files = get_arg_files(args, cwd)
+    digests = get_file_hashes([path for _, path in files])
+    return [('file', arg, digest) for (arg, _), digest in zip(files, digests)]
+
+def get_stdin_limit(binary):
+    """how much of a piped stdin is read for binary's key, None unless its key policy has `stdin = true`."""
+    from bincache.signature import get_key_policy
+    if binary is None or not get_key_policy(binary).get('stdin'):
+        return None
+    return get_config().get('max_stdin_size', DEFAULT_MAX_STDIN_SIZE)
+
+def is_dev_null(st):
+    if not stat.S_ISCHR(st.st_mode):
+        return False
+    try:
+        return os.stat(os.devnull).st_rdev == st.st_rdev
+    except OSError:
+        return False
+
+class StdinInput:
+    """our stdin, hashed for the cache key before the command runs.
+
+    A regular file is hashed in place and inherited by the command. With a
+    limit, anything else but a terminal or /dev/null is read into a temporary
+    file, which the command then reads instead; without one it is inherited
+    untouched and the run isn't cached, the output may depend on it. digest
+    is None for a terminal or /dev/null, which aren't part of the key;
+    cacheable is also False when stdin went on for more than limit bytes, the
+    command then gets what was read followed by the rest of our stdin.
+    """
+
+    def __init__(self, limit, fd=STDIN_FD):
+        self.fd = fd
+        self.digest = None
+        self.file = None
+        self.cacheable = True
+        try:
+            st = os.fstat(fd)
+        except OSError:
+            return
+        if os.isatty(fd):
+            return
+        if stat.S_ISREG(st.st_mode):
+            self.digest = self.hash_file(st)
+        elif is_dev_null(st):
+            return
+        elif limit is not None:
+            self.spill(limit)
+        else:
+            self.cacheable = False
+
+    def hash_file(self, st):
+        offset = os.lseek(self.fd, 0, os.SEEK_CUR)
+        if offset == 0:
+            # `cmd < file` is memoized like any other file as long as we can name it
+            try:
+                path = os.readlink(f'/proc/self/fd/{self.fd}')
+                path_st = os.stat(path)
+                if (path_st.st_dev, path_st.st_ino) == (st.st_dev, st.st_ino):
+                    digest = get_file_hash(path)
+                    if digest is not None:
+                        return digest
+            except OSError:
+                pass
+        # pread leaves the offset alone for the command that inherits the file
+        file_hash = new_hash(get_hash_algorithm())
+        while True:
+            data = os.pread(self.fd, HASH_BUFFER_SIZE, offset)
+            if not data:
+                return file_hash.hexdigest()
+            file_hash.update(data)
+            offset += len(data)
+
+    def spill(self, limit):
+        import tempfile
+        temporary_dir = get_config()['temporary_dir']
+        os.makedirs(temporary_dir, exist_ok=True)
+        self.file = tempfile.TemporaryFile(dir=temporary_dir)
+        file_hash = new_hash(get_hash_algorithm())
+        size = 0
+        while True:
+            data = os.read(self.fd, HASH_BUFFER_SIZE)
+            if not data:
+                break
+            self.file.write(data)
+            file_hash.update(data)
+            size += len(data)
+            if limit and size > limit:
+                self.cacheable = False
+                break
+        self.file.seek(0)
+        if self.cacheable:
+            self.digest = file_hash.hexdigest()
+
+    def popen_stdin(self):
+        """the stdin argument for subprocess.Popen."""
+        import subprocess
+        if self.file is None:
+            return None
+        return self.file if self.cacheable else subprocess.PIPE
+
+    def feed(self, process):
+        """copy what was read and the rest of our stdin to a process started with popen_stdin."""
+        if self.cacheable or self.file is None:
+            return
+        import threading
+
+        def copy():
+            try:
+                for source in (self.file.fileno(), self.fd):
+                    while True:
+                        data = os.read(source, HASH_BUFFER_SIZE)
+                        if not data:
+                            break
+                        process.stdin.write(data)
+                        process.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except (BrokenPipeError, OSError):
+                    pass
+
+        thread = threading.Thread(target=copy, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -1,4 +1,3 @@
-import logging
 from bincache.config import get_config
 
 _logger = None
@@ -6,6 +5,8 @@ _logger = None
 def get_logger():
     global _logger
     if _logger is None:
+        # logging costs several milliseconds to import, a cache hit usually never logs
+        import logging
         config = get_config()
         _logger = logging.getLogger('bincache')
         log_level = getattr(logging, config['log_level'], logging.INFO)
@@ -15,6 +16,10 @@ def get_logger():
             log_formatter = logging.Formatter('%(asctime)s - PID: %(process)d - PWD: %(pathname)s - %(message)s')
             log_handler.setFormatter(log_formatter)
             _logger.addHandler(log_handler)
+        else:
+            # without a handler logging's last resort prints warnings to stderr, mixed into the command's own
+            _logger.addHandler(logging.NullHandler())
+            _logger.propagate = False
     return _logger
 
 def debug(msg):
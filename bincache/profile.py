@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+
+from bincache.config import get_config, DEFAULT_PROFILE
+
+PROFILE_ENV = 'BINCACHE_PROFILE'
+PROFILE_DIR = 'profiles'
+
+# phase name -> [seconds, count] of the run being profiled, None when profiling is off
+_timings = None
+_fields = {}
+
+class Phase:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = _timings
+        if timings is None:
+            return False
+        timing = timings.setdefault(self.name, [0.0, 0])
+        timing[0] += time.monotonic() - self.started
+        timing[1] += 1
+        return False
+
+class NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PHASE = NoPhase()
+
+def phase(name):
+    """a context manager adding its time to phase name of the run being profiled, free when profiling is off."""
+    return NO_PHASE if _timings is None else Phase(name)
+
+def annotate(**fields):
+    """add fields, like the outcome of the run, to its trace record."""
+    if _timings is not None:
+        _fields.update(fields)
+
+def get_profile_mode():
+    """'timings', 'cprofile' or None; BINCACHE_PROFILE takes precedence over the profile setting."""
+    value = os.environ.get(PROFILE_ENV)
+    if value is None:
+        value = get_config().get('profile', DEFAULT_PROFILE)
+    value = str(value).strip().lower()
+    if value in ('', '0', 'off', 'false', 'no', 'none'):
+        return None
+    return 'cprofile' if value == 'cprofile' else 'timings'
+
+def format_trace(started_at, total, timings, fields):
+    import json
+    record = {'time': round(started_at, 6), 'pid': os.getpid(), 'argv': sys.argv[1:]}
+    record.update(fields)
+    record['total_ms'] = round(total * 1000, 3)
+    record['phases'] = {name: {'ms': round(seconds * 1000, 3), 'count': count}
+                        for name, (seconds, count) in timings.items()}
+    return json.dumps(record)
+
+def write_trace(line):
+    """append a trace line to profile_file with a single write, or log it if there is no profile_file."""
+    profile_file = get_config().get('profile_file')
+    if not profile_file:
+        from bincache import logger
+        logger.info(line)
+        return
+    fd = os.open(profile_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def dump_profile(profiler):
+    """write the cProfile stats of the run to the profiles directory of the cache, return the path."""
+    profile_dir = os.path.join(get_config()['cache_dir'], PROFILE_DIR)
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{time.time_ns()}-{os.getpid()}.prof")
+    profiler.dump_stats(path)
+    return path
+
+'''
+call function, the body of a bincache command, with its phases timed when
+profiling is on, and write a trace record of the run when it returns or
+exits; in cprofile mode the whole run also goes through cProfile
+'''
+def profile_run(function):
+    global _timings, _fields
+    mode = get_profile_mode()
+    if mode is None:
+        return function()
+    _timings, _fields = {}, {}
+    profiler = None
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+    started_at = time.time()
+    started = time.monotonic()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return function()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except SystemExit as e:
+        _fields['exit'] = e.code
+        raise
+    finally:
+        total = time.monotonic() - started
+        timings, fields = _timings, _fields
+        _timings, _fields = None, {}
+        try:
+            if profiler is not None:
+                fields['cprofile'] = dump_profile(profiler)
+            write_trace(format_trace(started_at, total, timings, fields))
+        except Exception as e:
+            from bincache import logger
+            logger.warning(f"failed to write profile: {e}")
@@ -0,0 +1,222 @@
+import os
+import shutil
+
+from bincache.config import get_config, DEFAULT_SECONDARY_TIMEOUT, DEFAULT_BACKGROUND_PUSH
+from bincache.cache import get_cache_file_path, new_temp_file, install_entry, parse_entry_header, spawn_bincache
+from bincache.cache import ENTRY_HEADER, ENTRY_READ_SIZE, OUTBOX_DIR
+from bincache import logger
+
+PUSH_LOCK_FILE = 'push.lock'
+# touched when the secondary tier fails, local misses don't ask it again for a while
+DOWN_FILE = 'secondary.down'
+DOWN_SECONDS = 60
+
+class DirectoryStore:
+    """a secondary tier in a directory shared between machines, laid out like the cache directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def fetch(self, key, f):
+        """copy the entry of key into the binary file f, return False if there is none."""
+        try:
+            source = open(self.get_path(key), 'rb')
+        except FileNotFoundError:
+            return False
+        with source:
+            shutil.copyfileobj(source, f, ENTRY_READ_SIZE)
+        return True
+
+    def store(self, key, path):
+        """upload the entry file at path as key, readers never see a partial entry."""
+        target = self.get_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.tmp"
+        try:
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, target)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+class HttpStore:
+    """a secondary tier behind an HTTP key/value endpoint: GET and PUT <url>/<key>, 404 for a miss."""
+
+    def __init__(self, url, timeout):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, key, f):
+        import urllib.request
+        import urllib.error
+        try:
+            with urllib.request.urlopen(f"{self.url}/{key}", timeout=self.timeout) as response:
+                shutil.copyfileobj(response, f, ENTRY_READ_SIZE)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def store(self, key, path):
+        import urllib.request
+        with open(path, 'rb') as f:
+            request = urllib.request.Request(f"{self.url}/{key}", data=f, method='PUT', headers={
+                'Content-Length': str(os.fstat(f.fileno()).st_size),
+                'Content-Type': 'application/octet-stream'})
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+
+_stores = {}
+
+def get_store():
+    """the configured secondary store, None if there is none."""
+    config = get_config()
+    location = config.get('secondary')
+    if not location:
+        return None
+    store = _stores.get(location)
+    if store is None:
+        if location.startswith(('http://', 'https://')):
+            store = HttpStore(location, config.get('secondary_timeout', DEFAULT_SECONDARY_TIMEOUT))
+        else:
+            store = DirectoryStore(location[len('file://'):] if location.startswith('file://') else location)
+        _stores[location] = store
+    return store
+
+def is_down(cache_dir):
+    """whether the secondary tier failed in the last DOWN_SECONDS."""
+    import time
+    try:
+        return time.time() - os.stat(os.path.join(cache_dir, DOWN_FILE)).st_mtime < DOWN_SECONDS
+    except FileNotFoundError:
+        return False
+
+def mark_down(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, DOWN_FILE), 'w'):
+            pass
+    except OSError as e:
+        logger.warning(f"failed to mark the secondary cache as down: {e}")
+
+def mark_up(cache_dir):
+    try:
+        os.remove(os.path.join(cache_dir, DOWN_FILE))
+    except FileNotFoundError:
+        pass
+
+'''
+copy the entry of key from the secondary tier into the local cache, return True
+if it was there; entries without a valid header are never installed, so nothing
+from the shared tier is ever unpickled. While the tier is marked down after a
+failure it isn't asked at all, so an unreachable endpoint costs one timeout
+every DOWN_SECONDS instead of one per miss
+'''
+def fetch_entry(key):
+    store = get_store()
+    if store is None:
+        return False
+    config = get_config()
+    if is_down(config['cache_dir']):
+        return False
+    cache_file_path = get_cache_file_path(key)
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+    found = valid = False
+    with new_temp_file(config, cache_file_path) as temp_file:
+        temp_path = temp_file.name
+        try:
+            found = store.fetch(key, temp_file)
+            size = temp_file.tell()
+            temp_file.seek(0)
+            valid = found and parse_entry_header(temp_file.read(ENTRY_HEADER.size), size) is not None
+        except Exception as e:
+            logger.warning(f"failed to fetch {key} from the secondary cache: {e}")
+            mark_down(config['cache_dir'])
+    if not valid:
+        os.remove(temp_path)
+        if found:
+            logger.warning(f"ignoring an invalid entry {key} in the secondary cache")
+        return False
+    install_entry(key, temp_path, size, push=False)
+    return True
+
+def get_outbox_dir(cache_dir):
+    return os.path.join(cache_dir, OUTBOX_DIR)
+
+def lock_push(cache_dir):
+    """return a file descriptor holding the push lock, None if another push holds it."""
+    import fcntl
+    fd = os.open(os.path.join(cache_dir, PUSH_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+'''
+queue the local entry of key for upload and make sure a push runs, in a
+detached `bincache --push` unless background_push is off; a push already
+running picks the entry up itself
+'''
+def queue_push(key):
+    config = get_config()
+    cache_dir = config['cache_dir']
+    outbox_dir = get_outbox_dir(cache_dir)
+    os.makedirs(outbox_dir, exist_ok=True)
+    # a hard link costs no copy and outlives the entry being evicted locally
+    temp_path = os.path.join(outbox_dir, f".{key}.{os.getpid()}.tmp")
+    os.link(get_cache_file_path(key), temp_path)
+    os.replace(temp_path, os.path.join(outbox_dir, key))
+    if not config.get('background_push', DEFAULT_BACKGROUND_PUSH):
+        push_outbox()
+        return
+    fd = lock_push(cache_dir)
+    if fd is None:
+        return
+    os.close(fd)
+    spawn_bincache(cache_dir, '--push')
+
+def push_queued(store, cache_dir):
+    """upload and remove every queued entry, return False once an upload fails."""
+    outbox_dir = get_outbox_dir(cache_dir)
+    for name in os.listdir(outbox_dir):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(outbox_dir, name)
+        try:
+            store.store(name, path)
+        except Exception as e:
+            # the rest would most likely fail the same way, they are retried with the next push
+            logger.warning(f"failed to push {name} to the secondary cache: {e}")
+            mark_down(cache_dir)
+            return False
+        mark_up(cache_dir)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return True
+
+def push_outbox():
+    """upload the queued entries, return False if another push is already running."""
+    store = get_store()
+    if store is None:
+        return True
+    cache_dir = get_config()['cache_dir']
+    outbox_dir = get_outbox_dir(cache_dir)
+    os.makedirs(outbox_dir, exist_ok=True)
+    while True:
+        fd = lock_push(cache_dir)
+        if fd is None:
+            return False
+        try:
+            pushed = push_queued(store, cache_dir)
+        finally:
+            os.close(fd)
+        # an entry queued while we held the lock didn't start a push of its own
+        if not pushed or not [name for name in os.listdir(outbox_dir) if not name.startswith('.')]:
+            return True
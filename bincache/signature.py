@@ -1,22 +1,184 @@
-import hashlib
-import subprocess
+import os
+import time
+import _thread
 
-def hash_file_md5(file_path):
-    md5 = hashlib.md5()
-    with open(file_path, 'rb') as f:
+try:
+    # hashlib loads OpenSSL when it is imported; blake2b, the default digest, is built in
+    from _blake2 import blake2b
+except ImportError:
+    from hashlib import blake2b
+
+from bincache import elf
+from bincache.profile import phase
+from bincache.config import get_config, DEFAULT_HASH_ALGORITHM, DEFAULT_HASH_WORKERS
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Bump whenever the data fed into the cache key changes shape
+KEY_FORMAT_VERSION = 2
+HASH_BUFFER_SIZE = 1024 * 1024
+MEMO_DIR = 'memo'
+HASH_MEMO_MAX_ENTRIES = 16384
+LIBS_MEMO_MAX_ENTRIES = 4096
+# Files changed less than this long ago are not memoized: a second write landing
+# in the same timestamp tick would otherwise go unnoticed (racy-git problem).
+RACY_WINDOW_NS = 2 * 10**9
+MEMORY_MEMO_MAX_ENTRIES = HASH_MEMO_MAX_ENTRIES + LIBS_MEMO_MAX_ENTRIES
+
+_memos = {}
+
+def new_hash(algorithm):
+    if algorithm == 'xxh3' and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algorithm == 'sha256':
+        import hashlib
+        return hashlib.sha256()
+    if algorithm == 'md5':
+        import hashlib
+        return hashlib.md5()
+    return blake2b(digest_size=16)
+
+def get_hash_algorithm():
+    algorithm = get_config().get('hash_algorithm', DEFAULT_HASH_ALGORITHM)
+    if algorithm == 'xxh3' and xxhash is None:
+        return DEFAULT_HASH_ALGORITHM
+    return algorithm
+
+def hash_file(file_path, algorithm=DEFAULT_HASH_ALGORITHM):
+    # readinto a reused 1 MiB buffer: large reads without per-chunk allocations,
+    # and unlike mmap a file truncated while it is hashed can't SIGBUS us
+    file_hash = new_hash(algorithm)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
         while True:
-            chunk = f.read(8192)
-            if not chunk:
+            size = f.readinto(buffer)
+            if not size:
                 break
-            md5.update(chunk)
-    return md5.hexdigest()
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+def hash_file_md5(file_path):
+    return hash_file(file_path, 'md5')
+
+def get_memo_path(kind, name):
+    config = get_config()
+    filename = blake2b(name.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    return os.path.join(config['cache_dir'], MEMO_DIR, kind, filename)
+
+def read_memo(memo_path):
+    # a long running process (bincache --daemon) serves repeated lookups from memory
+    memo = _memos.get(memo_path)
+    if memo is not None:
+        return memo
+    try:
+        with open(memo_path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            memo = f.read().split('\n')
+    except OSError:
+        return None
+    remember_memo(memo_path, memo)
+    return memo
+
+def remember_memo(memo_path, lines):
+    if len(_memos) >= MEMORY_MEMO_MAX_ENTRIES:
+        _memos.clear()
+    _memos[memo_path] = lines
+
+def prune_memo_dir(memo_dir, max_entries):
+    """removing the oldest memo files if the directory holds more than max_entries."""
+    entries = []
+    with os.scandir(memo_dir) as it:
+        for entry in it:
+            try:
+                entries.append((entry.stat().st_mtime_ns, entry.path))
+            except FileNotFoundError:
+                pass
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def write_memo(memo_path, lines, max_entries):
+    """atomically replace memo_path, concurrent readers see either the old or the new content."""
+    remember_memo(memo_path, list(lines))
+    memo_dir = os.path.dirname(memo_path)
+    # the daemon serves lookups from several threads of one process
+    temp_path = f"{memo_path}.{os.getpid()}.{_thread.get_ident()}.tmp"
+    try:
+        os.makedirs(memo_dir, exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write('\n'.join(lines))
+        os.replace(temp_path, memo_path)
+        # Prune on roughly one write in 64 so the directory stays bounded
+        # without listing it on every write.
+        if os.urandom(1)[0] < 4:
+            prune_memo_dir(memo_dir, max_entries)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def stat_identity(st):
+    return f"{st.st_dev} {st.st_ino} {st.st_size} {st.st_mtime_ns} {st.st_ctime_ns}"
+
+def is_racy(st):
+    return time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) <= RACY_WINDOW_NS
+
+def get_file_hash(file_path, memo_only=False):
+    """hash_file with the configured algorithm, memoized on disk by the file's stat identity.
+
+    With memo_only a memo miss returns None instead of hashing the file."""
+    algorithm = get_hash_algorithm()
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None if memo_only else hash_file(file_path, algorithm)
+    if '\n' in file_path:
+        return None if memo_only else hash_file(file_path, algorithm)
+    memo_path = get_memo_path('hash', file_path)
+    identity = stat_identity(st)
+    memo = read_memo(memo_path)
+    if memo and len(memo) == 4 and memo[:3] == [file_path, identity, algorithm]:
+        return memo[3]
+    if memo_only:
+        return None
+    digest = hash_file(file_path, algorithm)
+    if not is_racy(st):
+        write_memo(memo_path, [file_path, identity, algorithm, digest], HASH_MEMO_MAX_ENTRIES)
+    return digest
+
+def get_file_hashes(file_paths):
+    """get_file_hash for every path, in order; memo misses are hashed in a bounded thread pool."""
+    digests = [get_file_hash(file_path, memo_only=True) for file_path in file_paths]
+    missing = [i for i, digest in enumerate(digests) if digest is None]
+    workers = min(get_config().get('hash_workers', DEFAULT_HASH_WORKERS), len(missing))
+    if workers <= 1:
+        for i in missing:
+            digests[i] = get_file_hash(file_paths[i])
+        return digests
+    # hashlib releases the GIL on large updates, so threads overlap both I/O and hashing
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, digest in zip(missing, executor.map(get_file_hash, [file_paths[i] for i in missing])):
+            digests[i] = digest
+    return digests
 
 '''
 return list of ('libname, 'libpath', 'address') or None
 '''
-def get_dynamic_libs(binary):
-    result = subprocess.Popen(['ldd', binary], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = result.communicate()
+def get_dynamic_libs_ldd(binary, environ=None):
+    import subprocess
+    with phase('ldd'):
+        result = subprocess.Popen(['ldd', binary], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ)
+        stdout, stderr = result.communicate()
     if result.returncode != 0:
         print(f"Failed to get dynamic libraries for {binary}")
         return None
@@ -42,13 +204,127 @@ def get_dynamic_libs(binary):
         libs.append((name, path, address))
     return libs
 
-def generate_signature(binary, args):
+'''
+return list of ('libname, 'libpath', 'address') or None, ldd is only run
+when the built-in ELF reader can't resolve the binary on its own; environ
+defaults to our own environment
+'''
+def resolve_dynamic_libs(binary, environ=None):
+    if environ is None:
+        environ = os.environ
+    try:
+        return elf.get_dynamic_libs(binary, ld_library_path=environ.get('LD_LIBRARY_PATH', ''),
+                                    ld_preload=environ.get('LD_PRELOAD', ''))
+    except elf.ELFError:
+        return get_dynamic_libs_ldd(binary, environ)
+
+def get_libs_index_key(binary, st, environ=None):
+    if environ is None:
+        environ = os.environ
+    try:
+        ld_so_cache = stat_identity(os.stat(elf.LD_SO_CACHE))
+    except OSError:
+        ld_so_cache = '-'
+    return [binary, stat_identity(st), environ.get('LD_LIBRARY_PATH', ''), environ.get('LD_PRELOAD', ''), ld_so_cache]
+
+'''
+resolve_dynamic_libs with the result kept in an on-disk index until the binary,
+LD_LIBRARY_PATH, LD_PRELOAD or /etc/ld.so.cache change, a hit costs a few stat calls
+'''
+def get_dynamic_libs(binary, environ=None):
+    try:
+        st = os.stat(binary)
+    except OSError:
+        return resolve_dynamic_libs(binary, environ)
+    key = get_libs_index_key(binary, st, environ)
+    if any('\n' in part for part in key):
+        return resolve_dynamic_libs(binary, environ)
+    memo_path = get_memo_path('libs', binary)
+    memo = read_memo(memo_path)
+    if memo and len(memo) > len(key) and memo[:len(key)] == key:
+        if memo[len(key)] == 'none':
+            return None
+        libs = [tuple(line.split('\t')) for line in memo[len(key) + 1:]]
+        if all(len(lib) == 3 for lib in libs):
+            return libs
+    libs = resolve_dynamic_libs(binary, environ)
+    lines = ['none'] if libs is None else ['libs'] + ['\t'.join(lib) for lib in libs]
+    valid = libs is None or all(len(lib) == 3 and not any(c in field for field in lib for c in '\t\n') for lib in libs)
+    if valid and not is_racy(st):
+        write_memo(memo_path, key + lines, LIBS_MEMO_MAX_ENTRIES)
+    return libs
+
+def get_key_policy(binary):
+    """the [key] policy of bincache.conf with the overrides for binary's name, then its path, applied."""
+    config = get_config()
+    policy = dict(config.get('key_policy') or {})
+    overrides = config.get('key_policies') or {}
+    for name in (os.path.basename(binary), binary):
+        policy.update(overrides.get(name, {}))
+    return policy
+
+def rewrite_args(args, rules):
+    """apply the (pattern, replacement) rewrite rules to every argument, in order."""
+    if not rules:
+        return list(args)
+    import re
+    compiled = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+    rewritten = []
+    for arg in args:
+        for pattern, replacement in compiled:
+            arg = pattern.sub(replacement, arg)
+        rewritten.append(arg)
+    return rewritten
+
+'''
+return dict of everything the cache key of running binary with args is made
+of, None if it can't be cached; inputs is a list of tuples describing what
+else the output depends on, like the digests of input files, environ and cwd
+default to ours and only count as far as the key policy says
+'''
+def get_key_components(binary, args, environ=None, inputs=None, cwd=None):
     if not binary:
         return None
-    binary_info = hash_file_md5(binary) 
-    libs = get_dynamic_libs(binary)
+    algorithm = get_hash_algorithm()
+    with phase('libs'):
+        libs = get_dynamic_libs(binary, environ)
     if libs is None:
         return None
-    libs_info = [(libpath, hash_file_md5(libpath)) for libname, libpath, address in libs if libpath]
-    hash_data = str(binary_info) + str(libs_info) + " ".join(args)
-    return hashlib.md5(hash_data.encode('utf-8')).hexdigest()
\ No newline at end of file
+    lib_paths = [libpath for libname, libpath, address in libs if libpath]
+    with phase('hash'):
+        binary_info, *lib_hashes = get_file_hashes([binary] + lib_paths)
+    policy = get_key_policy(binary)
+    if environ is None:
+        environ = os.environ
+    return {
+        'algorithm': algorithm,
+        'binary': (binary, binary_info),
+        'libs': list(zip(lib_paths, lib_hashes)),
+        'args': rewrite_args(args, policy.get('rewrite')),
+        # an unset variable (None) is not the same as an empty one
+        'env': [(name, environ.get(name)) for name in policy.get('env', [])],
+        'cwd': (cwd or os.getcwd()) if policy.get('cwd') else None,
+        'inputs': inputs or [],
+    }
+
+def hash_key_components(components):
+    algorithm = components['algorithm']
+    # the version and algorithm prefix keeps keys of different formats apart;
+    # parts that are empty are left out, so keys only change when they're used
+    hash_data = (f"bincache-v{KEY_FORMAT_VERSION}-{algorithm}:" + str(components['binary'][1]) +
+                 str(components['libs']) + " ".join(components['args']))
+    if components['inputs']:
+        hash_data += "\ninputs:" + str(components['inputs'])
+    if components['env']:
+        hash_data += "\nenv:" + str(components['env'])
+    if components['cwd'] is not None:
+        hash_data += "\ncwd:" + components['cwd']
+    key_hash = new_hash(algorithm)
+    key_hash.update(hash_data.encode('utf-8', 'surrogateescape'))
+    return key_hash.hexdigest()
+
+def generate_signature(binary, args, environ=None, inputs=None, cwd=None):
+    components = get_key_components(binary, args, environ, inputs, cwd)
+    if components is None:
+        return None
+    return hash_key_components(components)
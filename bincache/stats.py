@@ -0,0 +1,217 @@
+import os
+import time
+import struct
+
+from bincache.config import get_config
+from bincache import logger
+
+# Every bincache process appends one fixed-size record per command to one of a
+# few journals with a single O_APPEND write, so concurrent processes never lock
+# or rewrite anything. Full journals are rotated and later folded into the
+# summary; reports add up the summary and the journals not folded in yet.
+STATS_DIR = 'stats'
+SUMMARY_FILE = 'summary.json'
+STATS_LOCK_FILE = 'stats.lock'
+JOURNAL_PREFIX = 'journal.'
+JOURNAL_SHARDS = 16
+JOURNAL_ROTATE_SIZE = 1024 * 1024
+# a rotated journal is folded in once nobody can be about to append to it
+JOURNAL_SETTLE_SECONDS = 10
+# the summary keeps per-key counts of this many of the most hit keys
+HOT_KEYS_KEPT = 1000
+
+# kind, milliseconds (the original runtime a hit saved, the runtime of a run), bytes served, key
+RECORD = struct.Struct('<BxxxIQ64s')
+KINDS = {'hit': 1, 'miss': 2, 'uncacheable': 3}
+COUNTERS = {1: 'hits', 2: 'misses', 3: 'uncacheable'}
+MS_MAX = 2**32 - 1
+
+def get_stats_dir(cache_dir):
+    return os.path.join(cache_dir, STATS_DIR)
+
+'''
+append one event: a 'hit' serving size bytes of an entry whose command took
+runtime seconds, a 'miss' that ran for runtime seconds and got cached, or an
+'uncacheable' run; errors are logged, never raised
+'''
+def record(kind, key=None, size=0, runtime=0):
+    try:
+        stats_dir = get_stats_dir(get_config()['cache_dir'])
+        data = RECORD.pack(KINDS[kind], min(round(runtime * 1000), MS_MAX), size, (key or '').encode('ascii'))
+        path = os.path.join(stats_dir, f"{JOURNAL_PREFIX}{os.getpid() % JOURNAL_SHARDS}")
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.makedirs(stats_dir, exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+        if end >= JOURNAL_ROTATE_SIZE:
+            compact(stats_dir)
+    except Exception as e:
+        logger.warning(f"failed to record stats: {e}")
+
+def lock_stats(stats_dir, wait=False):
+    """return a file descriptor holding the stats lock, None if another process holds it and wait is False."""
+    import fcntl
+    os.makedirs(stats_dir, exist_ok=True)
+    fd = os.open(os.path.join(stats_dir, STATS_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def new_summary():
+    return {'hits': 0, 'misses': 0, 'uncacheable': 0, 'bytes_served': 0, 'saved_ms': 0, 'run_ms': 0, 'keys': {}}
+
+def fold(summary, data):
+    """add the records in journal data to summary."""
+    # a record is written with a single write, a torn tail can only come from a crash
+    for kind, ms, size, key in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+        name = COUNTERS.get(kind)
+        if name is None:
+            continue
+        summary[name] += 1
+        if name != 'hits':
+            summary['run_ms'] += ms
+            continue
+        summary['bytes_served'] += size
+        summary['saved_ms'] += ms
+        counts = summary['keys'].setdefault(key.rstrip(b'\0').decode('ascii', 'replace'), [0, 0])
+        counts[0] += 1
+        counts[1] += ms
+    return summary
+
+def read_summary(stats_dir):
+    import json
+    try:
+        with open(os.path.join(stats_dir, SUMMARY_FILE)) as f:
+            summary = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return new_summary()
+    return dict(new_summary(), **summary)
+
+def write_summary(stats_dir, summary):
+    import json
+    keys = summary['keys']
+    if len(keys) > HOT_KEYS_KEPT:
+        summary['keys'] = dict(sorted(keys.items(), key=lambda item: item[1][0], reverse=True)[:HOT_KEYS_KEPT])
+    path = os.path.join(stats_dir, SUMMARY_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(summary, f)
+    os.replace(temp_path, path)
+
+def list_journals(stats_dir):
+    """return (live, rotated) journal paths."""
+    live, rotated = [], []
+    for name in os.listdir(stats_dir):
+        if name.startswith(JOURNAL_PREFIX):
+            (rotated if name.count('.') > 1 else live).append(os.path.join(stats_dir, name))
+    return live, rotated
+
+def read_journal(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+'''
+fold settled rotated journals into the summary and rotate the full live ones,
+unless another process is at it already
+'''
+def compact(stats_dir, wait=False):
+    fd = lock_stats(stats_dir, wait)
+    if fd is None:
+        return
+    try:
+        live, rotated = list_journals(stats_dir)
+        settled = [path for path in rotated if os.stat(path).st_mtime < time.time() - JOURNAL_SETTLE_SECONDS]
+        if settled:
+            summary = read_summary(stats_dir)
+            for path in settled:
+                fold(summary, read_journal(path))
+            write_summary(stats_dir, summary)
+            for path in settled:
+                os.remove(path)
+        for path in live:
+            if os.stat(path).st_size >= JOURNAL_ROTATE_SIZE:
+                os.rename(path, f"{path}.{time.time_ns()}")
+    finally:
+        os.close(fd)
+
+def read_stats(cache_dir):
+    """return the summary with every journal folded in."""
+    stats_dir = get_stats_dir(cache_dir)
+    if not os.path.isdir(stats_dir):
+        return new_summary()
+    fd = lock_stats(stats_dir, wait=True)
+    try:
+        summary = read_summary(stats_dir)
+        live, rotated = list_journals(stats_dir)
+        for path in rotated + live:
+            fold(summary, read_journal(path))
+    finally:
+        os.close(fd)
+    return summary
+
+def hot_keys(summary, count):
+    """return the count most hit keys as (key, hits, saved seconds)."""
+    keys = sorted(summary['keys'].items(), key=lambda item: item[1][0], reverse=True)[:count]
+    return [(key, hits, saved_ms / 1000) for key, (hits, saved_ms) in keys]
+
+def format_report(summary, count=10):
+    lookups = summary['hits'] + summary['misses'] + summary['uncacheable']
+    hit_rate = summary['hits'] / lookups * 100 if lookups else 0
+    lines = [
+        f"hits:              {summary['hits']} ({hit_rate:.1f}%)",
+        f"misses:            {summary['misses']}",
+        f"uncacheable runs:  {summary['uncacheable']}",
+        f"bytes served:      {summary['bytes_served']}",
+        f"time saved:        {summary['saved_ms'] / 1000:.3f}s",
+        f"time running:      {summary['run_ms'] / 1000:.3f}s",
+    ]
+    keys = hot_keys(summary, count)
+    if keys:
+        lines.append("hottest keys:")
+        lines.extend(f"  {key}  {hits} hits, {saved:.3f}s saved" for key, hits, saved in keys)
+    return '\n'.join(lines) + '\n'
+
+METRICS = [
+    ('bincache_hits', 'hits', 1, None, "Commands answered from the cache."),
+    ('bincache_misses', 'misses', 1, None, "Commands run and cached."),
+    ('bincache_uncacheable', 'uncacheable', 1, None, "Commands run without caching their result."),
+    ('bincache_served_bytes', 'bytes_served', 1, 'bytes', "Output bytes replayed from the cache."),
+    ('bincache_saved_seconds', 'saved_ms', 1000, 'seconds', "Original runtime of the commands answered from the cache."),
+    ('bincache_run_seconds', 'run_ms', 1000, 'seconds', "Runtime of the commands run."),
+]
+
+def format_openmetrics(summary):
+    """the counters in the OpenMetrics text format, as read by the node exporter's textfile collector."""
+    lines = []
+    for name, field, scale, unit, help_text in METRICS:
+        lines.append(f"# TYPE {name} counter")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {help_text}")
+        value = summary[field] / scale if scale != 1 else summary[field]
+        lines.append(f"{name}_total {value}")
+    lines.append("# EOF")
+    return '\n'.join(lines) + '\n'
+
+def export_openmetrics(summary, path):
+    """write the counters to path atomically, so a collector never reads a partial file."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(format_openmetrics(summary))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,159 @@
+import os
+import shutil
+import asyncio
+import pytest
+import bincache
+from bincache import config
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/bin/sh') or not os.path.exists('/bin/echo'),
+                                reason="needs /bin/sh and /bin/echo")
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.setenv('BINCACHE_DIR', cache_dir)
+    monkeypatch.setattr(config, '_config', None)
+    yield cache_dir
+    config._config = None
+
+def test_run_caches_output(tmpdir):
+    log = tmpdir.join('runs.log')
+    argv = ['sh', '-c', f'echo run >> {log}; echo out; echo err >&2']
+    first = bincache.run(argv)
+    second = bincache.run(argv)
+    assert (first.returncode, first.stdout, first.stderr, first.cached) == (0, b'out\n', b'err\n', False)
+    assert (second.returncode, second.stdout, second.stderr, second.cached) == (0, b'out\n', b'err\n', True)
+    assert log.read() == 'run\n'
+
+def test_run_does_not_cache_failures():
+    argv = ['sh', '-c', 'echo failed >&2; exit 2']
+    for _ in range(2):
+        result = bincache.run(argv)
+        assert (result.returncode, result.stderr, result.cached) == (2, b'failed\n', False)
+
+def test_run_uses_env_and_cwd(tmpdir):
+    workdir = tmpdir.mkdir('work')
+    result = bincache.run(['sh', '-c', 'echo $GREETING; pwd'], env=dict(os.environ, GREETING='hi'), cwd=str(workdir))
+    assert result.stdout == f'hi\n{workdir}\n'.encode()
+    # case: 相对路径的可执行文件按 cwd 查找
+    shutil.copy('/bin/echo', str(workdir.join('my_echo')))
+    assert bincache.run(['./my_echo', 'hello'], cwd=str(workdir)).stdout == b'hello\n'
+    assert bincache.run(['./my_echo', 'hello'], cwd=str(workdir)).cached
+
+def test_run_command_not_found():
+    result = bincache.run(['bincache-no-such-command'])
+    assert result.returncode == 127
+    assert b'command not found' in result.stderr
+
+def test_run_rejects_empty_argv():
+    with pytest.raises(ValueError):
+        bincache.run([])
+
+def test_arun_runs_commands_concurrently(tmpdir):
+    async def run_all():
+        return await asyncio.gather(*[bincache.arun(['sh', '-c', f'sleep 0.2; echo {i}']) for i in range(20)])
+    results = asyncio.run(run_all())
+    assert [result.stdout for result in results] == [f'{i}\n'.encode() for i in range(20)]
+    assert not any(result.cached for result in results)
+    # case: 同步和异步接口共享同一份缓存
+    assert bincache.run(['sh', '-c', 'sleep 0.2; echo 3']).cached
+
+def test_arun_waits_for_identical_commands(tmpdir):
+    log = tmpdir.join('runs.log')
+    argv = ['sh', '-c', f'sleep 0.2; echo run >> {log}; echo out']
+    async def run_all():
+        return await asyncio.gather(*[bincache.arun(argv) for _ in range(3)])
+    results = asyncio.run(run_all())
+    assert [result.stdout for result in results] == [b'out\n'] * 3
+    assert log.read() == 'run\n'
+    assert sum(result.cached for result in results) == 2
+
+def test_arun_command_not_found():
+    result = asyncio.run(bincache.arun(['bincache-no-such-command']))
+    assert result.returncode == 127
+
+def test_arun_keeps_file_io_off_the_loop(monkeypatch, tmpdir):
+    import threading
+    from bincache import api
+    threads = {}
+    for name in ('try_open_entry', 'entry_result', 'store_output', 'record_stats'):
+        def recorded(*args, name=name, function=getattr(api, name), **kwargs):
+            threads.setdefault(name, set()).add(threading.current_thread())
+            return function(*args, **kwargs)
+        monkeypatch.setattr(api, name, recorded)
+    argv = ['sh', '-c', 'echo out']
+    assert not asyncio.run(bincache.arun(argv)).cached
+    assert asyncio.run(bincache.arun(argv)).cached
+    # case: 读条目、回放命中、写入条目和记录统计都不在事件循环的线程里
+    assert len(threads) == 4
+    assert not any(threading.main_thread() in called for called in threads.values())
+
+def test_arun_reaps_cancelled_commands(monkeypatch):
+    processes = []
+    create = asyncio.create_subprocess_exec
+
+    async def recorded(*args, **kwargs):
+        processes.append(await create(*args, **kwargs))
+        return processes[-1]
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', recorded)
+
+    async def cancel():
+        task = asyncio.ensure_future(bincache.arun(['sleep', '10']))
+        while not processes:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # case: 取消时子进程被杀掉并回收，不留下僵尸进程
+        assert processes[0].returncode is not None
+    asyncio.run(cancel())
+
+def test_miss_rechecks_after_taking_the_lock(monkeypatch, tmpdir):
+    from bincache import api
+    log = tmpdir.join('runs.log')
+    argv = ['sh', '-c', f'echo run >> {log}; echo out']
+    assert not bincache.run(argv).cached
+
+    # case: 查找时还没有、拿锁前另一个进程刚写好的条目不会被重新执行
+    def stale_lookup(function):
+        calls = []
+        def lookup(key, **kwargs):
+            calls.append(key)
+            return None if len(calls) == 1 else function(key, **kwargs)
+        return lookup
+    try_open_entry = api.try_open_entry
+    monkeypatch.setattr(api, 'try_open_entry', stale_lookup(try_open_entry))
+    assert bincache.run(argv).cached
+    monkeypatch.setattr(api, 'try_open_entry', stale_lookup(try_open_entry))
+    assert asyncio.run(bincache.arun(argv)).cached
+    assert log.read() == 'run\n'
+
+def test_arun_releases_the_lock_when_cancelled_while_waiting(monkeypatch):
+    import time
+    import threading
+    from bincache import api
+    from bincache.cache import acquire_key_lock, release_key_lock
+    taken = threading.Event()
+
+    def slow_wait_for_key(key):
+        time.sleep(0.2)
+        result = wait_for_key(key)
+        taken.set()
+        return result
+    wait_for_key = api.wait_for_key
+    monkeypatch.setattr(api, 'wait_for_key', slow_wait_for_key)
+    argv = ['sh', '-c', 'echo out']
+
+    async def cancel():
+        task = asyncio.ensure_future(bincache.arun(argv))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # case: 取消之后等锁的线程拿到的锁会被释放，不会一直占着
+        await asyncio.get_running_loop().run_in_executor(None, taken.wait, 5)
+        await asyncio.sleep(0.05)
+    asyncio.run(cancel())
+    fd, waited = acquire_key_lock(api.compute_key(argv), timeout=0.1)
+    assert fd is not None and not waited
+    release_key_lock(api.compute_key(argv), fd)
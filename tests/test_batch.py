@@ -0,0 +1,60 @@
+import os
+import sys
+import subprocess
+import pytest
+from bincache.batch import parse_batch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_parse_batch():
+    text = '''
+    # 注释和空行会被跳过
+    echo hello 'a b'
+
+    ["printf", "%s\\n", "c d"]
+    '''
+    assert parse_batch(text) == [['echo', 'hello', 'a b'], ['printf', '%s\n', 'c d']]
+
+@pytest.mark.parametrize('line', ['echo "unterminated', '["echo", 1]', '[]'])
+def test_parse_batch_rejects_bad_lines(line):
+    with pytest.raises(ValueError, match='line 2'):
+        parse_batch('echo ok\n' + line)
+
+def run_batch_file(tmpdir, text):
+    batch_file = tmpdir.join('commands.txt')
+    batch_file.write(text)
+    env = dict(os.environ, BINCACHE_DIR=str(tmpdir.join('cache')), PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-m', 'bincache.cli', '--batch', str(batch_file)], env=env,
+                          cwd=str(tmpdir), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_batch_keeps_input_order_and_caches_misses(tmpdir):
+    text = '''
+    sh -c 'sleep 0.3; echo run >> slow.log; echo slow'
+    echo fast
+    sh -c 'echo failed >&2; exit 3'
+    echo fast
+    '''
+    for _ in range(2):
+        result = run_batch_file(tmpdir, text)
+        assert result.stdout == b'slow\nfast\nfast\n'
+        assert result.stderr.startswith(b'failed\n')
+        assert b"command 3 exited with 3: sh -c 'echo failed >&2; exit 3'" in result.stderr
+        assert result.returncode == 3
+    # case: 第二次运行命中缓存，慢命令只执行过一次
+    assert tmpdir.join('slow.log').read() == 'run\n'
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_batch_runs_misses_in_parallel(tmpdir):
+    tmpdir.join('cache').mkdir().join('bincache.conf').write("batch_workers = 4\n")
+    text = ''.join(f'sh -c "sleep 0.5; echo {i}"\n' for i in range(4))
+    result = run_batch_file(tmpdir, text)
+    assert result.stdout == b'0\n1\n2\n3\n'
+    assert result.returncode == 0
+
+def test_batch_reports_unreadable_files(tmpdir):
+    env = dict(os.environ, BINCACHE_DIR=str(tmpdir.join('cache')), PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-m', 'bincache.cli', '--batch', str(tmpdir.join('missing'))], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    assert b'bincache:' in result.stderr
@@ -4,7 +4,9 @@ import pickle
 import pytest
 import tempfile
 from unittest import mock
-from bincache.cache import get_cache_file_path, put, get, trim_cache_dir_to_limit
+from bincache import cache
+from bincache import compress
+from bincache.cache import get_cache_file_path, put, get, trim_cache_dir_to_limit, read_ledger, write_ledger
 
 @pytest.fixture
 def setup_cache_config(monkeypatch, tmpdir):
@@ -14,6 +16,9 @@ def setup_cache_config(monkeypatch, tmpdir):
     monkeypatch.setattr('bincache.cache.get_config', lambda: mock_config)
     return mock_config
 
+def entry(stdout, stderr=b'', returncode=0):
+    return {'stdout': stdout, 'stderr': stderr, 'returncode': returncode}
+
 def test_get_cache_file_path(setup_cache_config):
     key = 'ab1234'
     expected_path = os.path.join(setup_cache_config['cache_dir'], 'ab', '1234')
@@ -22,7 +27,7 @@ def test_get_cache_file_path(setup_cache_config):
 
 def test_put_get(setup_cache_config):
     key = 'ab1234'
-    value = {'key': 'value'}
+    value = entry(b'out', b'err')
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
@@ -39,44 +44,196 @@ def test_get_non_existent_key(setup_cache_config):
 
 def test_put_get_small_string(setup_cache_config):
     key = 'small123'
-    value = 'a' * 10  # small string
+    value = entry(b'a' * 10)  # small output
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
 
 def test_put_get_large_string(setup_cache_config):
     key = 'large123'
-    value = 'a' * 10**6  # large string
+    value = entry(b'a' * 10**6)  # large output
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
 
 def test_put_get_binary_content(setup_cache_config):
     key = 'binary123'
-    value = b'\x00\xFF\x11\x33\x44'  # binary content
+    value = entry(b'\x00\xFF\x11\x33\x44', b'\xfe')  # binary content, not utf-8
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
 
 def test_put_get_empty_content(setup_cache_config):
     key = 'empty123'
-    value = b''  # empty content
+    value = entry(b'', b'')  # empty content
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
 
 def test_put_get_very_large_content(setup_cache_config):
     key = 'verylarge123'
-    value = b'a' * 10**7  # very large binary content
+    value = entry(b'a' * 10**7)  # very large binary content
     put(key, value)
     retrieved_value = get(key)
     assert value == retrieved_value
 
+def test_entry_format(setup_cache_config):
+    put('ab1234', entry(b'out', b'error', 3))
+    with open(get_cache_file_path('ab1234'), 'rb') as f:
+        data = f.read()
+    assert data == cache.ENTRY_HEADER.pack(cache.ENTRY_MAGIC, cache.ENTRY_VERSION, 0, 3, 3, 5, 0) + b'outerror'
+    assert get('ab1234') == entry(b'out', b'error', 3)
+
+def test_get_legacy_pickle_entry(setup_cache_config):
+    path = get_cache_file_path('ab1234')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        pickle.dump({'stdout': 'hello', 'stderr': 'wörld'}, f)
+    assert get('ab1234') == entry(b'hello', 'wörld'.encode('utf-8'))
+
+codecs = ['zlib', 'lzma', pytest.param('zstd', marks=pytest.mark.skipif(
+    not compress.is_available('zstd'), reason="needs zstandard"))]
+
+@pytest.mark.parametrize('codec', codecs)
+def test_put_get_compressed(setup_cache_config, codec):
+    setup_cache_config.update({'compression': codec, 'compression_min_size': 1024})
+    value = entry(b'warning: unused variable\n' * 1000, b'\xff' * 2000, 1)
+    put('ab1234', value)
+    size = os.path.getsize(get_cache_file_path('ab1234'))
+    assert size < len(value['stdout']) // 10
+    assert get('ab1234') == value
+    opened = cache.open_entry('ab1234')
+    with opened['file'] as f:
+        assert opened['codec'] == codec
+        assert b''.join(cache.iter_entry_range(f, *opened['stdout'], opened['codec'])) == value['stdout']
+        assert b''.join(cache.iter_entry_range(f, *opened['stderr'], opened['codec'])) == value['stderr']
+
+@pytest.mark.parametrize('codec', codecs)
+def test_compressed_output_is_replayed_in_bounded_pieces(setup_cache_config, monkeypatch, codec):
+    setup_cache_config.update({'compression': codec})
+    monkeypatch.setattr(cache, 'ENTRY_READ_SIZE', 4096)
+    value = entry(b'\0' * 1000000)
+    put('ab1234', value)
+    opened = cache.open_entry('ab1234')
+    with opened['file'] as f:
+        # case: 压缩率很高的输出也按 ENTRY_READ_SIZE 分块解压，不会一次展开
+        pieces = list(cache.iter_entry_range(f, *opened['stdout'], opened['codec']))
+    assert b''.join(pieces) == value['stdout']
+    # zstandard 的 decompressobj 不支持限制输出长度
+    if codec != 'zstd' or hasattr(compress.decompressor('zstd'), 'needs_input'):
+        assert max(len(piece) for piece in pieces) <= 4096
+
+def test_small_or_incompressible_output_is_stored_raw(setup_cache_config):
+    setup_cache_config.update({'compression': 'zlib', 'compression_min_size': 1024})
+    put('small', entry(b'a' * 1000))
+    put('random', entry(os.urandom(4096)))
+    for key in ('small', 'random'):
+        opened = cache.open_entry(key)
+        opened['file'].close()
+        assert opened['codec'] is None
+
+def test_ledger_counts_compressed_size(setup_cache_config):
+    setup_cache_config.update({'compression': 'zlib'})
+    cache_dir = setup_cache_config['cache_dir']
+    write_ledger(cache_dir, 0, 0)
+    put('key1', entry(b'a' * 10**6))
+    assert read_ledger(cache_dir)[0] == entry_sizes(cache_dir) < 10**5
+
+def test_get_version_1_entry(setup_cache_config):
+    path = get_cache_file_path('ab1234')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(cache.ENTRY_HEADER.pack(cache.ENTRY_MAGIC, 1, 0, 0, 3, 0, 0) + b'out')
+    assert get('ab1234') == entry(b'out')
+
+def write_interleaved(writer):
+    for i in range(100):
+        writer.write('stdout', b'out %d\n' % i)
+        if i % 10 == 0:
+            writer.write('stderr', b'err %d\n' % i)
+
+def expected_interleaved(returncode=0):
+    return entry(b''.join(b'out %d\n' % i for i in range(100)),
+                 b''.join(b'err %d\n' % i for i in range(0, 100, 10)), returncode)
+
+def test_entry_writer_in_memory(setup_cache_config):
+    writer = cache.EntryWriter('ab1234')
+    write_interleaved(writer)
+    assert writer.files is None
+    assert writer.commit(0)
+    assert get('ab1234') == expected_interleaved()
+    assert os.listdir(setup_cache_config['temporary_dir']) == []
+
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_entry_writer_spills_to_disk(setup_cache_config, compression):
+    setup_cache_config.update({'spill_threshold': 100, 'compression': compression})
+    cache_dir = setup_cache_config['cache_dir']
+    write_ledger(cache_dir, 0, 0)
+    writer = cache.EntryWriter('ab1234')
+    write_interleaved(writer)
+    assert writer.files is not None
+    assert len(os.listdir(setup_cache_config['temporary_dir'])) == 1
+    assert writer.commit(7)
+    assert get('ab1234') == expected_interleaved(7)
+    assert os.listdir(setup_cache_config['temporary_dir']) == []
+    assert read_ledger(cache_dir)[:2] == (entry_sizes(cache_dir), 1)
+    opened = cache.open_entry('ab1234')
+    opened['file'].close()
+    assert opened['codec'] == (None if compression == 'none' else compression)
+
+@pytest.mark.parametrize('spill_threshold', [10**6, 100])
+def test_entry_writer_skips_entries_over_max_entry_size(setup_cache_config, spill_threshold):
+    setup_cache_config.update({'spill_threshold': spill_threshold, 'max_entry_size': 500})
+    writer = cache.EntryWriter('ab1234')
+    write_interleaved(writer)
+    assert writer.commit(0) is False
+    assert get('ab1234') is None
+    assert os.listdir(setup_cache_config['temporary_dir']) == []
+
+def test_open_entry_addresses_stdout_and_stderr(setup_cache_config):
+    put('ab1234', entry(b'out', b'error', 3))
+    opened = cache.open_entry('ab1234')
+    with opened['file'] as f:
+        f.seek(0)
+        data = f.read()
+    offset, size = opened['stdout']
+    assert data[offset:offset + size] == b'out'
+    offset, size = opened['stderr']
+    assert data[offset:offset + size] == b'error'
+    assert opened['returncode'] == 3
+    assert cache.open_entry('cd5678') is None
+
+def test_open_entry_migrates_legacy_entry(setup_cache_config):
+    path = get_cache_file_path('ab1234')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        pickle.dump({'stdout': 'hello', 'stderr': ''}, f)
+    opened = cache.open_entry('ab1234')
+    opened['file'].close()
+    assert opened['stdout'] == (cache.ENTRY_HEADER.size, 5)
+    with open(path, 'rb') as f:
+        assert f.read(len(cache.ENTRY_MAGIC)) == cache.ENTRY_MAGIC
+
+@pytest.mark.parametrize('damage', ['truncate', 'version', 'garbage'])
+def test_get_unreadable_entry_is_a_miss(setup_cache_config, damage):
+    put('ab1234', entry(b'out', b'err'))
+    path = get_cache_file_path('ab1234')
+    with open(path, 'r+b') as f:
+        if damage == 'truncate':
+            f.truncate(cache.ENTRY_HEADER.size + 2)
+        elif damage == 'version':
+            f.seek(len(cache.ENTRY_MAGIC))
+            f.write(b'\xff\xff')
+        else:
+            f.write(b'garbage')
+    assert get('ab1234') is None
+    assert cache.open_entry('ab1234') is None
+
 def test_trim_cache_dir_to_limit_no_trim(setup_cache_config):
     key1 = 'key1'
-    value1 = 'a' * 100
+    value1 = entry(b'a' * 100)
     key2 = 'key2'
-    value2 = 'b' * 100
+    value2 = entry(b'b' * 100)
   
     put(key1, value1)
     put(key2, value2)
@@ -88,11 +245,11 @@ def test_trim_cache_dir_to_limit_no_trim(setup_cache_config):
 
 def test_trim_cache_dir_to_limit_with_trim(setup_cache_config):
     key1 = 'key1'
-    value1 = 'a' * 100
+    value1 = entry(b'a' * 100)
     key2 = 'key2'
-    value2 = 'b' * 100
+    value2 = entry(b'b' * 100)
     key3 = 'key3'
-    value3 = 'c' * 100
+    value3 = entry(b'c' * 100)
 
     put(key1, value1)
     put(key2, value2)
@@ -110,11 +267,11 @@ def test_trim_cache_dir_to_limit_with_trim(setup_cache_config):
 
 def test_trim_cache_dir_to_limit_with_exact_limit(setup_cache_config):
     key1 = 'key1'
-    value1 = 'a' * 100
-    size1 = len(pickle.dumps(value1))
+    value1 = entry(b'a' * 100)
+    size1 = cache.ENTRY_HEADER.size + 100
     key2 = 'key2'
-    value2 = 'b' * 100
-    size2 = len(pickle.dumps(value2))
+    value2 = entry(b'b' * 100)
+    size2 = cache.ENTRY_HEADER.size + 100
     total_size = size1 + size2
 
     put(key1, value1)
@@ -123,4 +280,207 @@ def test_trim_cache_dir_to_limit_with_exact_limit(setup_cache_config):
     trim_cache_dir_to_limit(setup_cache_config['cache_dir'], total_size)
 
     assert get(key1) == value1
-    assert get(key2) == value2
\ No newline at end of file
+    assert get(key2) == value2
+def test_trim_cache_dir_to_limit_ignores_non_entry_dirs(setup_cache_config):
+    memo_dir = os.path.join(setup_cache_config['cache_dir'], 'memo', 'hash')
+    os.makedirs(memo_dir)
+    with open(os.path.join(memo_dir, 'abc'), 'w') as f:
+        f.write('m' * 1000)
+    key1 = 'key1'
+    value1 = entry(b'a' * 100)
+    put(key1, value1)
+
+    trim_cache_dir_to_limit(setup_cache_config['cache_dir'], 500)
+
+    assert get(key1) == value1
+    assert os.path.exists(os.path.join(memo_dir, 'abc'))
+
+def entry_sizes(cache_dir):
+    return sum(size for _, _, size in cache.scan_cache_dir(cache_dir))
+
+def test_ledger_tracks_put_and_trim(setup_cache_config):
+    cache_dir = setup_cache_config['cache_dir']
+    write_ledger(cache_dir, 0, 0)
+    put('key1', entry(b'a' * 100))
+    put('key2', entry(b'b' * 100))
+    put('key2', entry(b'b' * 200))
+    total_size, entry_count, updates, _ = read_ledger(cache_dir)
+    assert total_size == entry_sizes(cache_dir)
+    assert entry_count == 2
+    assert updates == 3
+
+    os.utime(get_cache_file_path('key1'), (time.time() - 3, time.time() - 3))
+    trim_cache_dir_to_limit(cache_dir, total_size - 1)
+    assert get('key1') is None
+    assert read_ledger(cache_dir)[:2] == (entry_sizes(cache_dir), 1)
+
+def test_trim_uses_ledger_instead_of_scanning(setup_cache_config, monkeypatch):
+    cache_dir = setup_cache_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    write_ledger(cache_dir, entry_sizes(cache_dir), 1)
+    def no_scan(cache_dir):
+        raise AssertionError("cache dir scanned")
+    monkeypatch.setattr(cache, 'scan_cache_dir', no_scan)
+    trim_cache_dir_to_limit(cache_dir, 10**6)
+
+def test_missing_or_damaged_ledger_is_rebuilt(setup_cache_config):
+    cache_dir = setup_cache_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    assert read_ledger(cache_dir) is None
+    trim_cache_dir_to_limit(cache_dir, 10**6)
+    assert read_ledger(cache_dir)[:2] == (entry_sizes(cache_dir), 1)
+
+    with open(os.path.join(cache_dir, cache.LEDGER_FILE), 'r+b') as f:
+        f.write(b'9')
+    assert read_ledger(cache_dir) is None
+    assert cache.get_cache_size(cache_dir) == entry_sizes(cache_dir)
+
+def test_ledger_is_reconciled_periodically(setup_cache_config, monkeypatch):
+    cache_dir = setup_cache_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    write_ledger(cache_dir, 12345, 7)
+    assert cache.get_cache_size(cache_dir) == 12345
+    monkeypatch.setattr(cache, 'LEDGER_RECONCILE_UPDATES', 1)
+    cache.update_ledger(cache_dir, 1, 0)
+    assert cache.get_cache_size(cache_dir) == entry_sizes(cache_dir)
+
+def test_put_below_high_watermark_does_not_trim(setup_cache_config):
+    setup_cache_config.update({'max_size': 1000, 'high_watermark': 1.0, 'low_watermark': 0.5, 'background_gc': False})
+    for i in range(6):
+        put(f'key{i}', entry(b'a' * 100))
+    assert entry_sizes(setup_cache_config['cache_dir']) > 500
+    assert all(get(f'key{i}') == entry(b'a' * 100) for i in range(6))
+
+def test_put_over_high_watermark_trims_to_low_watermark(setup_cache_config):
+    setup_cache_config.update({'max_size': 1000, 'high_watermark': 1.0, 'low_watermark': 0.5, 'background_gc': False})
+    for i in range(8):
+        put(f'key{i}', entry(b'a' * 100))
+        os.utime(get_cache_file_path(f'key{i}'), (time.time() - 100 + i, time.time() - 100 + i))
+    assert get('key7') == entry(b'a' * 100)
+    assert entry_sizes(setup_cache_config['cache_dir']) <= 500
+    assert get('key0') is None
+
+def test_put_over_high_watermark_spawns_background_gc(setup_cache_config, monkeypatch):
+    setup_cache_config.update({'max_size': 100, 'high_watermark': 1.0, 'low_watermark': 0.5})
+    spawned = []
+    monkeypatch.setattr(cache, 'spawn_gc', spawned.append)
+    put('key1', entry(b'a' * 100))
+    assert spawned == [setup_cache_config['cache_dir']]
+    assert get('key1') == entry(b'a' * 100)
+
+def test_background_gc_is_skipped_while_gc_runs(setup_cache_config, monkeypatch):
+    setup_cache_config.update({'max_size': 100, 'high_watermark': 1.0, 'low_watermark': 0.5})
+    spawned = []
+    monkeypatch.setattr(cache, 'spawn_gc', spawned.append)
+    fd = cache.lock_gc(setup_cache_config['cache_dir'])
+    try:
+        put('key1', entry(b'a' * 100))
+        assert cache.collect_garbage() is False
+    finally:
+        os.close(fd)
+    assert spawned == []
+
+def test_spawn_gc_runs_detached(tmpdir):
+    cache_dir = str(tmpdir.mkdir("cache"))
+    with open(os.path.join(cache_dir, 'bincache.conf'), 'w') as f:
+        f.write("max_size=1K\nlow_watermark=50%\n")
+    os.makedirs(os.path.join(cache_dir, 'ab'))
+    for i in range(3):
+        with open(os.path.join(cache_dir, 'ab', str(i)), 'wb') as f:
+            f.write(b'x' * 1000)
+    cache.spawn_gc(cache_dir)
+    deadline = time.time() + 30
+    while entry_sizes(cache_dir) > 512 and time.time() < deadline:
+        time.sleep(0.05)
+    assert entry_sizes(cache_dir) <= 512
+
+def test_key_lock_excludes_and_times_out(setup_cache_config):
+    fd, waited = cache.acquire_key_lock('ab1234', timeout=1)
+    assert fd is not None and not waited
+    other_fd, waited = cache.acquire_key_lock('ab1234', timeout=0.05)
+    assert other_fd is None and waited
+    cache.release_key_lock('ab1234', fd)
+    assert not os.path.exists(cache.get_key_lock_path('ab1234'))
+    fd, waited = cache.acquire_key_lock('ab1234', timeout=0.05)
+    assert fd is not None
+    cache.release_key_lock('ab1234', fd)
+
+def test_key_lock_waits_for_holder(setup_cache_config):
+    import threading
+    fd, _ = cache.acquire_key_lock('ab1234', timeout=1)
+    timer = threading.Timer(0.1, cache.release_key_lock, args=('ab1234', fd))
+    timer.start()
+    other_fd, waited = cache.acquire_key_lock('ab1234', timeout=5)
+    timer.join()
+    assert other_fd is not None and waited
+    cache.release_key_lock('ab1234', other_fd)
+
+def test_key_lock_of_crashed_holder_is_recovered(setup_cache_config):
+    fd, _ = cache.acquire_key_lock('ab1234', timeout=1)
+    # a crashed holder leaves its lock file behind, but the kernel drops the lock
+    os.close(fd)
+    assert os.path.exists(cache.get_key_lock_path('ab1234'))
+    fd, waited = cache.acquire_key_lock('ab1234', timeout=0.05)
+    assert fd is not None and not waited
+    cache.release_key_lock('ab1234', fd)
+
+@pytest.mark.parametrize('metadata_index', [False, True])
+def test_identical_outputs_share_a_blob(setup_cache_config, metadata_index):
+    setup_cache_config.update({'deduplicate': True, 'metadata_index': metadata_index})
+    cache_dir = setup_cache_config['cache_dir']
+    write_ledger(cache_dir, 0, 0)
+    put('key1', entry(b'a' * 1000))
+    size = entry_sizes(cache_dir)
+    put('key2', entry(b'a' * 1000))
+    put('key3', entry(b'b' * 1000))
+    # case: 相同的输出只存一份，账本只记一次
+    assert os.path.samefile(get_cache_file_path('key1'), get_cache_file_path('key2'))
+    assert not os.path.samefile(get_cache_file_path('key1'), get_cache_file_path('key3'))
+    assert read_ledger(cache_dir)[:2] == (2 * size, 3)
+    assert cache.get_disk_usage(cache_dir, cache.scan_cache_dir(cache_dir)) == 2 * size
+
+    # key1 and key2 share their mtime, both are older than key3
+    os.utime(get_cache_file_path('key1'), (time.time() - 10, time.time() - 10))
+    trim_cache_dir_to_limit(cache_dir, size)
+    # case: 最后一个引用被淘汰后 blob 一并删除
+    assert get('key1') is None and get('key2') is None
+    assert get('key3') == entry(b'b' * 1000)
+    assert len(cache.scan_blobs(cache_dir)) == 1
+    assert read_ledger(cache_dir)[:2] == (size, 1)
+
+def test_shared_blob_survives_evicting_one_entry(setup_cache_config):
+    setup_cache_config['deduplicate'] = True
+    cache_dir = setup_cache_config['cache_dir']
+    write_ledger(cache_dir, 0, 0)
+    put('key1', entry(b'a' * 1000))
+    put('key2', entry(b'a' * 1000))
+    # case: 覆盖为相同内容不改变大小
+    size = read_ledger(cache_dir)[0]
+    put('key2', entry(b'a' * 1000))
+    assert read_ledger(cache_dir)[:2] == (size, 2)
+    os.remove(get_cache_file_path('key1'))
+    cache.sweep_blobs(cache_dir)
+    assert get('key2') == entry(b'a' * 1000)
+    assert len(cache.scan_blobs(cache_dir)) == 1
+    os.remove(get_cache_file_path('key2'))
+    cache.sweep_blobs(cache_dir)
+    assert cache.scan_blobs(cache_dir) == []
+
+def test_without_deduplicate_no_blobs_are_kept(setup_cache_config):
+    put('key1', entry(b'a' * 1000))
+    put('key2', entry(b'a' * 1000))
+    assert not os.path.samefile(get_cache_file_path('key1'), get_cache_file_path('key2'))
+    assert not os.path.exists(os.path.join(setup_cache_config['cache_dir'], cache.BLOB_DIR))
+
+def test_entry_records_runtime(setup_cache_config):
+    writer = cache.EntryWriter('ab1234')
+    writer.write('stdout', b'out')
+    writer.commit(0, 1.25)
+    opened = cache.open_entry('ab1234')
+    opened['file'].close()
+    assert opened['runtime'] == 1.25
+    # case: 只有耗时不同的条目仍然共享 blob
+    setup_cache_config['deduplicate'] = True
+    put('key1', dict(entry(b'a' * 1000), runtime=1))
+    put('key2', dict(entry(b'a' * 1000), runtime=2))
+    assert os.path.samefile(get_cache_file_path('key1'), get_cache_file_path('key2'))
@@ -6,7 +6,10 @@ import pytest
 from unittest import mock
 from io import StringIO
 
-from bincache.cli import main
+import time
+import tempfile
+from bincache import cache
+from bincache.cli import main, execute_command
 from bincache.cache import get, put
 from bincache.config import get_config
 
@@ -18,6 +21,25 @@ def mock_config(monkeypatch, tmpdir):
     monkeypatch.setattr('bincache.config.get_config', lambda: mock_config)
     return mock_config
 
+real_popen = subprocess.Popen
+
+def pipe_with(data):
+    """the read end of a pipe that yields data and then EOF, like a finished child's stdout"""
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    return os.fdopen(read_fd, 'rb')
+
+def open_entry_with(stdout, stderr=b'', returncode=0, compression=None):
+    """an entry like cache.open_entry returns it, backed by a temporary file"""
+    f = tempfile.TemporaryFile(buffering=0)
+    header, stored_stdout, stored_stderr = cache.encode_entry(
+        {'stdout': stdout, 'stderr': stderr, 'returncode': returncode}, compression)
+    f.write(header + stored_stdout + stored_stderr)
+    codec = cache.parse_entry_header(header, len(header) + len(stored_stdout) + len(stored_stderr))[3]
+    return {'file': f, 'returncode': returncode, 'codec': codec, 'stdout': (len(header), len(stored_stdout)),
+            'stderr': (len(header) + len(stored_stdout), len(stored_stderr))}
+
 @pytest.fixture
 def mock_binary(monkeypatch):
     alias_map = {
@@ -86,19 +108,19 @@ def mock_binary(monkeypatch):
         }
     }
 
-    def which(cmd):
+    def which(cmd, path=None, cwd=None):
         return alias_map.get(cmd)
 
-    def generate_signature(binary, args):
+    def generate_signature(binary, args, environ=None, inputs=None, cwd=None):
         details = cache_map.get((binary,) + tuple(args))
         return details.get('signature') if details else None
 
-    def cache_get(key):
+    def cache_get(key, **kwargs):
         if key is None:
             return None
         for binary, details in cache_map.items():
             if key == details.get('signature') and 'cached_output' in details:
-                return {'stdout': details.get('cached_output'), 'stderr': ''}
+                return open_entry_with(details.get('cached_output').encode('utf-8'))
         return None
 
     def popen_mock(*popen_args, **kwargs):
@@ -108,13 +130,17 @@ def mock_binary(monkeypatch):
             if 'raise_error' in details:
                 raise details['raise_error']
             mock_proc = mock.Mock()
-            mock_proc.communicate.return_value = (details['stdout'].encode('utf-8'), details['stderr'].encode('utf-8'))
+            mock_proc.stdout = pipe_with(details['stdout'].encode('utf-8'))
+            mock_proc.stderr = pipe_with(details['stderr'].encode('utf-8'))
             mock_proc.returncode = details.get('returncode')
             return mock_proc
         raise ValueError(f"Unexpected command: {cmd}")
-    monkeypatch.setattr('bincache.cli.shutil.which', which)
+    monkeypatch.setattr('bincache.cli.which', which)
     monkeypatch.setattr('bincache.cli.generate_signature', generate_signature)
-    monkeypatch.setattr('bincache.cli.get', cache_get)
+    monkeypatch.setattr('bincache.cli.open_entry', cache_get)
+    monkeypatch.setattr('bincache.cli.query_daemon', lambda argv, stdin_digest=None: None)
+    monkeypatch.setattr('bincache.cli.acquire_key_lock', lambda key: (None, False))
+    monkeypatch.setattr('bincache.cli.release_key_lock', lambda key, fd: None)
     monkeypatch.setattr(subprocess, 'Popen', popen_mock)
 
 # case: 没有提供命令行参数
@@ -128,6 +154,16 @@ def test_no_arguments(monkeypatch, capsys):
     captured = capsys.readouterr()
     assert "Usage: bincache <binary_or_command> <arg1> [arg2 ... argN]" in captured.out
 
+# case: --gc 回收缓存
+def test_gc_command(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['bincache', '--gc'])
+    gc_mock = mock.Mock()
+    monkeypatch.setattr('bincache.cli.collect_garbage', gc_mock)
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    gc_mock.assert_called_once_with()
+
 # case: 命中缓存
 def test_cached_output(monkeypatch, mock_binary, capsys):
     monkeypatch.setattr(sys, 'argv', ['bincache', 'dummy_command_cache'])
@@ -143,7 +179,7 @@ def test_exec_command_and_cache(monkeypatch, mock_config, capsys, mock_binary):
     monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
 
     put_mock = mock.Mock()
-    monkeypatch.setattr('bincache.cli.put', put_mock)
+    monkeypatch.setattr('bincache.cache.put', put_mock)
     
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         main()
@@ -154,14 +190,14 @@ def test_exec_command_and_cache(monkeypatch, mock_config, capsys, mock_binary):
     assert captured.out.strip() == "Hello"
     
     # Verify that the command output was cached
-    put_mock.assert_called_once_with('echo_signature', {'stdout': 'Hello', 'stderr': ''})
+    put_mock.assert_called_once_with('echo_signature', {'stdout': b'Hello', 'stderr': b'', 'returncode': 0, 'runtime': mock.ANY})
 
 # case: 未命中缓存且执行失败，并验证结果不会被缓存
 def test_exec_command_with_error(monkeypatch, mock_config, capsys, mock_binary):
     monkeypatch.setattr(sys, 'argv', ['bincache', './error'])
 
     put_mock = mock.Mock()
-    monkeypatch.setattr('bincache.cli.put', put_mock)
+    monkeypatch.setattr('bincache.cache.put', put_mock)
 
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         main()
@@ -190,7 +226,7 @@ def test_exec_command_with_error(monkeypatch, mock_config, capsys, mock_binary):
     monkeypatch.setattr(sys, 'argv', ['bincache', './command_with_stderr'])
 
     put_mock = mock.Mock()
-    monkeypatch.setattr('bincache.cli.put', put_mock)
+    monkeypatch.setattr('bincache.cache.put', put_mock)
 
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         main()
@@ -202,7 +238,96 @@ def test_exec_command_with_error(monkeypatch, mock_config, capsys, mock_binary):
     assert captured.err.strip() == 'error_stderr'
 
     # Verify that the command output was cached
-    put_mock.assert_called_once_with('command_with_stderr_signature', {'stdout': 'error_stdout', 'stderr': 'error_stderr'})
+    put_mock.assert_called_once_with('command_with_stderr_signature', {'stdout': b'error_stdout', 'stderr': b'error_stderr', 'returncode': 0, 'runtime': mock.ANY})
+
+# case: 命中缓存时用 sendfile 把输出直接写到 fd 1 和 2
+def test_cached_output_uses_sendfile(monkeypatch, mock_binary, capfdbinary):
+    stdout = os.urandom(3 * 1024 * 1024)
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    monkeypatch.setattr('bincache.cli.open_entry', lambda key: open_entry_with(stdout, b'warning', 0))
+    real_sendfile = os.sendfile
+    targets = []
+    def sendfile(out_fd, in_fd, offset, count):
+        targets.append({sys.stdout.fileno(): 'stdout', sys.stderr.fileno(): 'stderr'}[out_fd])
+        return real_sendfile(out_fd, in_fd, offset, count)
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    captured = capfdbinary.readouterr()
+    assert captured.out == stdout
+    assert captured.err == b'warning'
+    assert targets[0] == 'stdout' and targets[-1] == 'stderr'
+
+# case: sendfile 不可用时回退到 mmap
+def test_cached_output_falls_back_to_mmap(monkeypatch, mock_binary, capfdbinary):
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    monkeypatch.setattr('bincache.cli.open_entry', lambda key: open_entry_with(b'\xffout', b'err', 0))
+    monkeypatch.setattr(os, 'sendfile', mock.Mock(side_effect=OSError(22, 'Invalid argument')))
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    captured = capfdbinary.readouterr()
+    assert captured.out == b'\xffout'
+    assert captured.err == b'err'
+
+# case: 压缩过的缓存解压后输出
+def test_cached_output_compressed(monkeypatch, mock_binary, capsysbinary):
+    stdout = b'line of a compiler listing\n' * 10000
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    monkeypatch.setattr('bincache.cli.open_entry', lambda key: open_entry_with(stdout, b'err' * 1000, 0, 'zlib'))
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    captured = capsysbinary.readouterr()
+    assert captured.out == stdout
+    assert captured.err == b'err' * 1000
+
+# case: 并发未命中时等待锁，然后回放第一个进程缓存的结果
+def test_concurrent_miss_replays_result(monkeypatch, capsys, mock_binary):
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    results = [None, open_entry_with(b'cached Hello')]
+    monkeypatch.setattr('bincache.cli.open_entry', lambda key, **kwargs: results.pop(0))
+    monkeypatch.setattr('bincache.cli.acquire_key_lock', lambda key: (99, True))
+    release_mock = mock.Mock()
+    monkeypatch.setattr('bincache.cli.release_key_lock', release_mock)
+    monkeypatch.setattr('bincache.cli.execute_command', mock.Mock(side_effect=AssertionError("command executed")))
+
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    assert capsys.readouterr().out == 'cached Hello'
+    release_mock.assert_called_once_with('echo_signature', 99)
+
+# case: 查找之后、拿锁之前另一个进程已经写好了结果，没有等待也会重新查一次
+def test_miss_rechecks_after_uncontended_lock(monkeypatch, capsys, mock_binary):
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    results = [None, open_entry_with(b'cached Hello')]
+    monkeypatch.setattr('bincache.cli.open_entry', lambda key, **kwargs: results.pop(0))
+    monkeypatch.setattr('bincache.cli.acquire_key_lock', lambda key: (99, False))
+    release_mock = mock.Mock()
+    monkeypatch.setattr('bincache.cli.release_key_lock', release_mock)
+    monkeypatch.setattr('bincache.cli.execute_command', mock.Mock(side_effect=AssertionError("command executed")))
+
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    assert capsys.readouterr().out == 'cached Hello'
+    release_mock.assert_called_once_with('echo_signature', 99)
+
+# case: 第一个进程没有缓存结果时，等待者各自执行命令且不持有锁
+def test_concurrent_miss_runs_unlocked_when_first_run_failed(monkeypatch, capsys, mock_binary):
+    monkeypatch.setattr(sys, 'argv', ['bincache', 'echo', 'Hello'])
+    monkeypatch.setattr('bincache.cli.acquire_key_lock', lambda key: (99, True))
+    released = []
+    monkeypatch.setattr('bincache.cli.release_key_lock', lambda key, fd: released.append(fd))
+    monkeypatch.setattr('bincache.cache.put', mock.Mock())
+
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    assert capsys.readouterr().out.strip() == 'Hello'
+    assert released == [99, None]
 
 # case: 命令不存在
 def test_exec_not_found(monkeypatch, mock_binary, mock_config, capsys):
@@ -263,10 +388,10 @@ def test_exec_command_with_bincache_error(monkeypatch, mock_config, capsys, mock
     def raise_error(*args, **kwargs):
         raise Exception('bincache error')
 
-    monkeypatch.setattr('bincache.cli.shutil.which', raise_error)
+    monkeypatch.setattr('bincache.cli.which', raise_error)
     monkeypatch.setattr('bincache.cli.generate_signature', raise_error)
-    monkeypatch.setattr('bincache.cli.put', raise_error)
-    monkeypatch.setattr('bincache.cli.get', raise_error)
+    monkeypatch.setattr('bincache.cache.put', raise_error)
+    monkeypatch.setattr('bincache.cli.open_entry', raise_error)
 
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         main()
@@ -283,10 +408,10 @@ def test_exec_command_with_bincache_error(monkeypatch, mock_config, capsys, mock
     def return_None(*args, **kwargs):
         return None
 
-    monkeypatch.setattr('bincache.cli.shutil.which', return_None)
+    monkeypatch.setattr('bincache.cli.which', return_None)
     monkeypatch.setattr('bincache.cli.generate_signature', return_None)
-    monkeypatch.setattr('bincache.cli.put', return_None)
-    monkeypatch.setattr('bincache.cli.get', return_None)
+    monkeypatch.setattr('bincache.cache.put', return_None)
+    monkeypatch.setattr('bincache.cli.open_entry', return_None)
 
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         main()
@@ -294,4 +419,119 @@ def test_exec_command_with_bincache_error(monkeypatch, mock_config, capsys, mock
     assert pytest_wrapped_e.value.code == 0
 
     captured = capsys.readouterr()
-    assert captured.out.strip() == "Hello"
\ No newline at end of file
+    assert captured.out.strip() == "Hello"
+class RecordingStream:
+    def __init__(self):
+        self.writes = []
+    def write(self, data):
+        self.writes.append((time.monotonic(), data))
+    def flush(self):
+        pass
+
+class RecordingWriter:
+    def __init__(self):
+        self.captured = {'stdout': b'', 'stderr': b''}
+    def write(self, name, data):
+        self.captured[name] += data
+    def discard(self):
+        pass
+
+# case: 输出边产生边转发，而不是等命令结束
+def test_execute_command_streams_output(monkeypatch):
+    stdout, stderr = RecordingStream(), RecordingStream()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    monkeypatch.setattr(sys, 'stderr', stderr)
+    writer = RecordingWriter()
+    start = time.monotonic()
+    returncode = execute_command(['/bin/sh', '-c', 'echo first; echo warn >&2; sleep 0.5; echo second'], writer)
+    end = time.monotonic()
+    assert returncode == 0
+    out, err = writer.captured['stdout'], writer.captured['stderr']
+    assert out == b'first\nsecond\n'
+    assert err == b'warn\n'
+    assert b''.join(data for _, data in stdout.writes) == out
+    assert b''.join(data for _, data in stderr.writes) == err
+    assert stdout.writes[0][0] - start < end - stdout.writes[0][0]
+
+# case: 写缓存失败时只放弃缓存，输出照常转发
+def test_execute_command_survives_writer_errors(capsysbinary):
+    class FailingWriter:
+        discarded = False
+        def write(self, name, data):
+            raise OSError(28, 'No space left on device')
+        def discard(self):
+            self.discarded = True
+    writer = FailingWriter()
+    assert execute_command(['/bin/sh', '-c', 'echo one; echo two'], writer) == 0
+    assert capsysbinary.readouterr().out == b'one\ntwo\n'
+    assert writer.discarded
+
+# case: 非 UTF-8 输出照常转发，并且原样缓存
+def test_non_utf8_output_is_cached(monkeypatch, mock_binary, capsysbinary):
+    monkeypatch.setattr(sys, 'argv', ['bincache', '/bin/sh', '-c', 'printf "\\377\\376"'])
+    monkeypatch.setattr('bincache.cli.which', lambda cmd, path=None, cwd=None: cmd)
+    monkeypatch.setattr('bincache.cli.generate_signature', lambda binary, args, environ=None, inputs=None, cwd=None: 'sh_signature')
+    monkeypatch.setattr(subprocess, 'Popen', real_popen)
+    put_mock = mock.Mock()
+    monkeypatch.setattr('bincache.cache.put', put_mock)
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    assert capsysbinary.readouterr().out == b'\xff\xfe'
+    put_mock.assert_called_once_with('sh_signature', {'stdout': b'\xff\xfe', 'stderr': b'', 'returncode': 0, 'runtime': mock.ANY})
+
+# case: 多个进程同时执行同一个命令，只有一个真正执行
+def test_concurrent_processes_run_command_once(tmpdir):
+    cache_dir = str(tmpdir.mkdir("cache"))
+    counter = str(tmpdir.join("counter"))
+    env = dict(os.environ, BINCACHE_DIR=cache_dir)
+    script = f"echo run >> {counter}; sleep 0.5; echo done"
+    processes = [subprocess.Popen([sys.executable, '-m', 'bincache.cli', '/bin/sh', '-c', script],
+                                  stdout=subprocess.PIPE, env=env) for _ in range(6)]
+    outputs = [p.communicate()[0] for p in processes]
+    assert outputs == [b'done\n'] * 6
+    with open(counter) as f:
+        assert f.read() == 'run\n'
+
+# case: --explain-key 列出缓存键的组成
+@pytest.mark.skipif(not os.path.exists('/bin/echo'), reason="needs /bin/echo")
+def test_explain_key(monkeypatch, capsys, tmpdir):
+    from bincache import config as bincache_config
+    from bincache.cli import get_cache_key
+    monkeypatch.setenv('BINCACHE_DIR', str(tmpdir))
+    monkeypatch.setenv('LANG', 'C')
+    monkeypatch.setattr(bincache_config, '_config', None)
+    tmpdir.join('bincache.conf').write("[key]\nenv = LANG NO_SUCH_VARIABLE\n")
+    monkeypatch.setattr(sys, 'argv', ['bincache', '--explain-key', 'echo', 'hi'])
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        main()
+    assert pytest_wrapped_e.value.code == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == f"key: {get_cache_key(['echo', 'hi'])}"
+    assert "args: ['hi']" in lines
+    assert "env: LANG=C" in lines
+    assert "env: NO_SUCH_VARIABLE (unset)" in lines
+    assert any(line.startswith('binary: ') and 'echo' in line for line in lines)
+
+@pytest.mark.skipif(not os.path.exists('/usr/bin/seq') and not os.path.exists('/bin/seq'), reason="needs seq")
+def test_damaged_compressed_hit_is_not_run_again(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    cache_dir.join('bincache.conf').write("compression = zlib\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, BINCACHE_DIR=str(cache_dir), PYTHONPATH=root)
+    argv = [sys.executable, '-m', 'bincache.cli', 'seq', '1', '3000000']
+    expected = subprocess.run(argv, env=env, stdout=subprocess.PIPE, check=True).stdout
+    entries = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(str(cache_dir))
+               if os.path.basename(dirpath) not in ('memo', 'tmp') for name in names
+               if len(os.path.basename(dirpath)) == 2]
+    entry_path, = entries
+    with open(entry_path, 'r+b') as f:
+        f.seek(os.path.getsize(entry_path) // 2)
+        f.write(b'\xff' * 64)
+    damaged = subprocess.run(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # case: 回放到一半发现条目损坏时不再重新执行命令，而是报错退出
+    assert damaged.returncode == 1
+    assert b'bincache: the cached output is damaged' in damaged.stderr
+    assert expected.startswith(damaged.stdout) and len(damaged.stdout) < len(expected)
+    assert not os.path.exists(entry_path)
+    assert subprocess.run(argv, env=env, stdout=subprocess.PIPE, check=True).stdout == expected
@@ -1,9 +1,10 @@
 # tests/config_test.py
 import os
+import time
 import tempfile
 import pytest
 from configparser import ConfigParser
-from bincache.config import get_config, parse_size, DEFAULT_CACHE_DIR, CONFIG_FILE
+from bincache.config import get_config, parse_size, parse_ratio, DEFAULT_CACHE_DIR, CONFIG_FILE
 
 from bincache import config as bincache_config
 
@@ -28,6 +29,22 @@ def test_get_config_defaults():
     assert config['log_level'] == "INFO"
     assert config['stats'] == False
     assert config['temporary_dir'] == os.path.join(DEFAULT_CACHE_DIR, "tmp")
+    assert config['hash_algorithm'] == "blake2b"
+    assert config['hash_workers'] == 4
+    assert config['metadata_index'] == False
+    assert config['high_watermark'] == 1.0
+    assert config['low_watermark'] == 0.9
+    assert config['background_gc'] == True
+    assert config['lock_timeout'] == 300
+    assert config['compression'] == "none"
+    assert config['compression_min_size'] == 4 * 1024
+    assert config['spill_threshold'] == 16 * 1024**2
+    assert config['max_entry_size'] == 1024**3
+    assert config['max_stdin_size'] == 64 * 1024**2
+    assert config['batch_workers'] == (os.cpu_count() or 1)
+    assert config['track_inputs'] == False
+    assert config['key_policy'] == {}
+    assert config['key_policies'] == {}
 
 
 def test_get_config_with_file():
@@ -44,12 +61,40 @@ def test_get_config_with_file():
             log_level=DEBUG
             stats=True
             temporary_dir=/tmp/test_tmp
+            hash_algorithm=SHA256
+            hash_workers=8
+            metadata_index=true
+            high_watermark=95%
+            low_watermark=0.8
+            background_gc=false
+            lock_timeout=2.5
+            compression=LZMA
+            compression_min_size=1M
+            spill_threshold=64K
+            max_entry_size=2G
+            max_stdin_size=1M
+            batch_workers=3
+            track_inputs=yes
             """)
         
         os.environ['BINCACHE_DIR'] = cache_dir
         
         config = get_config()
         
+        assert config['hash_algorithm'] == "sha256"
+        assert config['hash_workers'] == 8
+        assert config['metadata_index'] == True
+        assert config['high_watermark'] == 0.95
+        assert config['low_watermark'] == 0.8
+        assert config['background_gc'] == False
+        assert config['lock_timeout'] == 2.5
+        assert config['compression'] == "lzma"
+        assert config['compression_min_size'] == 1024**2
+        assert config['spill_threshold'] == 64 * 1024
+        assert config['max_entry_size'] == 2 * 1024**3
+        assert config['max_stdin_size'] == 1024**2
+        assert config['batch_workers'] == 3
+        assert config['track_inputs'] == True
         assert config['max_size'] == 10 * 1024**2  # 10M
         assert config['log_file'] == os.path.join(cache_dir, 'test.log')
         assert config['log_level'] == "DEBUG"
@@ -70,18 +115,73 @@ def test_get_config_with_invalid_data():
             log_level
             stats=True
             temporary_dir=/tmp/test_tmp
+            hash_algorithm=crc32
+            compression=brotli
             """)
         
         os.environ['BINCACHE_DIR'] = cache_dir
         
         config = get_config()
         
+        assert config['hash_algorithm'] == "blake2b" # default
+        assert config['compression'] == "none" # default
         assert config['max_size'] == 5 * 1024 * 1024 * 1024 # default
         assert config['log_file'] == os.path.join(cache_dir, 'test.log')
         assert config['log_level'] == "INFO" # default
         assert config['stats'] == True
         assert config['temporary_dir'] == "/tmp/test_tmp"
 
+def test_get_config_is_cached_until_the_file_changes(monkeypatch):
+    """测试解析结果缓存在 config.cache 中，配置文件修改后重新解析"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = os.path.join(tmpdir, CONFIG_FILE)
+        with open(config_file, 'w') as f:
+            f.write("max_size=10M\n")
+        old = time.time() - 60
+        os.utime(config_file, (old, old))
+        monkeypatch.setenv('BINCACHE_DIR', tmpdir)
+
+        assert get_config()['max_size'] == 10 * 1024**2
+        assert os.path.exists(os.path.join(tmpdir, bincache_config.CONFIG_CACHE_FILE))
+
+        def no_parse(*args):
+            raise AssertionError("bincache.conf parsed")
+        bincache_config._config = None
+        with monkeypatch.context() as m:
+            m.setattr(bincache_config, 'read_config_file', no_parse)
+            assert get_config()['max_size'] == 10 * 1024**2
+
+        with open(config_file, 'w') as f:
+            f.write("max_size=20M\n")
+        bincache_config._config = None
+        assert get_config()['max_size'] == 20 * 1024**2
+
+def test_get_config_with_key_policy(monkeypatch, tmpdir):
+    """测试 [key] 和 [key:<binary>] 段的解析"""
+    tmpdir.join(CONFIG_FILE).write(
+        "max_size = 1G\n"
+        "[key]\n"
+        "env = LANG, LC_ALL\n"
+        "rewrite =\n"
+        "    ^/tmp/tmp[a-z0-9_]+ => /tmp/TMP\n"
+        "    \\.o$ => .obj\n"
+        "[key:gcc]\n"
+        "cwd = true\n"
+        "stdin = true\n")
+    monkeypatch.setenv('BINCACHE_DIR', str(tmpdir))
+    config = get_config()
+    assert config['max_size'] == 1024**3
+    assert config['key_policy'] == {'env': ['LANG', 'LC_ALL'],
+                                    'rewrite': [('^/tmp/tmp[a-z0-9_]+', '/tmp/TMP'), ('\\.o$', '.obj')]}
+    assert config['key_policies'] == {'gcc': {'cwd': True, 'stdin': True}}
+
+@pytest.mark.parametrize('rule', ['no separator', '([ => x'])
+def test_get_config_with_invalid_rewrite_rule(monkeypatch, tmpdir, rule):
+    tmpdir.join(CONFIG_FILE).write(f"[key]\nrewrite = {rule}\n")
+    monkeypatch.setenv('BINCACHE_DIR', str(tmpdir))
+    with pytest.raises(Exception):
+        get_config()
+
 def test_get_config_with_relative_log_file():
     """测试 get_config 函数，确保在 log_file 配置为相对路径时能正确解析为绝对路径"""
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -101,6 +201,22 @@ def test_get_config_with_relative_log_file():
         assert config['log_file'] == os.path.join(cache_dir, 'relative', 'test.log')
 
 
+@pytest.mark.parametrize('value, mode', [('cprofile', 'cprofile'), ('true', 'timings'), ('no', 'off')])
+def test_get_config_with_profile(monkeypatch, tmpdir, value, mode):
+    """测试 profile 与 profile_file 的解析"""
+    cache_dir = tmpdir.mkdir('cache')
+    cache_dir.join(CONFIG_FILE).write(f"profile = {value}\nprofile_file =\n")
+    monkeypatch.setenv('BINCACHE_DIR', str(cache_dir))
+    config = get_config()
+    assert config['profile'] == mode
+    # case: 空的 profile_file 表示写到日志
+    assert config['profile_file'] == ''
+
+
+def test_parse_ratio():
+    assert parse_ratio("90%") == 0.9
+    assert parse_ratio("0.75") == 0.75
+
 def test_parse_non_standard_size():
     """测试 parse_size 函数，确保在输入非标准格式时能友好地处理"""
     
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import subprocess
+import pytest
+from bincache import config
+from bincache import daemon
+from bincache.cli import lookup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/bin/echo'), reason="needs /bin/echo")
+
+def bincache_env(cache_dir):
+    return dict(os.environ, BINCACHE_DIR=cache_dir, PYTHONPATH=ROOT)
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmpdir):
+    cache_dir = str(tmpdir.mkdir('cache'))
+    monkeypatch.setenv('BINCACHE_DIR', cache_dir)
+    monkeypatch.setattr(config, '_config', None)
+    yield cache_dir
+    config._config = None
+
+@pytest.fixture
+def running_daemon(cache_dir):
+    process = subprocess.Popen([sys.executable, '-m', 'bincache.cli', '--daemon'], env=bincache_env(cache_dir))
+    socket_path = daemon.get_socket_path(cache_dir)
+    deadline = time.time() + 30
+    while not os.path.exists(socket_path) and time.time() < deadline and process.poll() is None:
+        time.sleep(0.02)
+    assert os.path.exists(socket_path)
+    yield process
+    process.terminate()
+    assert process.wait(timeout=30) == 0
+    assert not os.path.exists(socket_path)
+
+def test_query_without_daemon(cache_dir):
+    assert daemon.query(['/bin/echo', 'hi']) is None
+    # a socket left behind by a killed daemon
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(daemon.get_socket_path(cache_dir))
+    assert daemon.query(['/bin/echo', 'hi']) is None
+
+def test_query_miss_then_hit(cache_dir, running_daemon):
+    key, entry = daemon.query(['echo', 'hi'])
+    assert entry is None
+    assert key == lookup(['echo', 'hi'])[0]
+
+    result = subprocess.run([sys.executable, '-m', 'bincache.cli', 'echo', 'hi'], env=bincache_env(cache_dir),
+                            stdout=subprocess.PIPE, check=True)
+    assert result.stdout == b'hi\n'
+
+    key, entry = daemon.query(['echo', 'hi'])
+    with entry['file'] as f:
+        offset, size = entry['stdout']
+        assert os.pread(f.fileno(), size, offset) == b'hi\n'
+    assert entry['returncode'] == 0
+
+    result = subprocess.run([sys.executable, '-m', 'bincache.cli', 'echo', 'hi'], env=bincache_env(cache_dir),
+                            stdout=subprocess.PIPE, check=True)
+    assert result.stdout == b'hi\n'
+
+def test_query_uses_client_cwd_and_env(cache_dir, running_daemon, tmpdir, monkeypatch):
+    workdir = tmpdir.mkdir('work')
+    shutil.copy('/bin/echo', str(workdir.join('echo')))
+    monkeypatch.chdir(str(workdir))
+    key, _ = daemon.query(['./echo', 'hi'])
+    assert key is not None
+    assert key == lookup(['./echo', 'hi'])[0]
+
+    monkeypatch.setenv('PATH', str(workdir))
+    key, _ = daemon.query(['echo', 'hi'])
+    assert key == lookup(['./echo', 'hi'])[0]
+
+def test_second_daemon_refuses_to_start(cache_dir, running_daemon):
+    result = subprocess.run([sys.executable, '-m', 'bincache.cli', '--daemon'], env=bincache_env(cache_dir),
+                            stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    assert b'already running' in result.stderr
+
+@pytest.fixture
+def served_lookups(cache_dir, monkeypatch):
+    """一个在本进程的线程里运行的 daemon，lookup 被替换成记录参数的假实现"""
+    import signal
+    import threading
+    from bincache import cli
+    requests = []
+
+    def fake_lookup(argv, stdin_digest=None, environ=None, cwd=None):
+        requests.append((argv, environ.get('BINCACHE_TEST'), cwd))
+        if argv == ['slow']:
+            time.sleep(2)
+        return argv[0], None
+    monkeypatch.setattr(cli, 'lookup', fake_lookup)
+    monkeypatch.setattr(signal, 'signal', lambda *args: None)
+    threading.Thread(target=daemon.serve, daemon=True).start()
+    deadline = time.time() + 30
+    while not os.path.exists(daemon.get_socket_path(cache_dir)) and time.time() < deadline:
+        time.sleep(0.02)
+    return requests
+
+def test_connections_are_served_concurrently(served_lookups, monkeypatch, tmpdir):
+    import threading
+    slow = threading.Thread(target=daemon.query, args=(['slow'],))
+    slow.start()
+    time.sleep(0.2)
+    monkeypatch.setenv('BINCACHE_TEST', 'client')
+    monkeypatch.chdir(str(tmpdir))
+    started = time.time()
+    # case: 慢的请求不会挡住其他客户端
+    assert daemon.query(['fast']) == ('fast', None)
+    assert time.time() - started < 1
+    slow.join()
+    # case: 客户端的环境和目录作为参数传下去
+    assert served_lookups[-1] == (['fast'], 'client', str(tmpdir))
+
+def test_relative_library_path_falls_back(served_lookups, monkeypatch):
+    monkeypatch.setenv('LD_LIBRARY_PATH', '/usr/lib:lib')
+    # case: 相对的 LD_LIBRARY_PATH 只能在客户端自己的目录里解析，交还给客户端
+    assert daemon.query(['fast']) is None
+    monkeypatch.setenv('LD_LIBRARY_PATH', '/usr/lib')
+    assert daemon.query(['fast']) == ('fast', None)
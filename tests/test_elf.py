@@ -0,0 +1,188 @@
+import os
+import shutil
+import struct
+import subprocess
+import pytest
+from bincache import elf
+from bincache.elf import ELFError, read_elf, parse_ld_so_cache, get_dynamic_libs
+
+BASE_ADDRESS = 0x400000
+
+def make_elf(path, needed=(), soname=None, rpath=None, runpath=None, interp=None, machine=62):
+    """write a minimal 64-bit little-endian ELF file with a PT_DYNAMIC segment"""
+    strtab = b'\0'
+    def add_string(s):
+        nonlocal strtab
+        offset = len(strtab)
+        strtab += s.encode() + b'\0'
+        return offset
+    dynamic = [(elf.DT_NEEDED, add_string(name)) for name in needed]
+    if soname:
+        dynamic.append((elf.DT_SONAME, add_string(soname)))
+    if rpath:
+        dynamic.append((elf.DT_RPATH, add_string(rpath)))
+    if runpath:
+        dynamic.append((elf.DT_RUNPATH, add_string(runpath)))
+    interp_data = interp.encode() + b'\0' if interp else b''
+    phnum = 3 if interp else 2
+    interp_offset = 64 + 56 * phnum
+    strtab_offset = interp_offset + len(interp_data)
+    dynamic_offset = strtab_offset + len(strtab)
+    dynamic += [(elf.DT_STRTAB, BASE_ADDRESS + strtab_offset), (elf.DT_STRSZ, len(strtab)), (elf.DT_NULL, 0)]
+    dynamic_data = b''.join(struct.pack('<qQ', tag, value) for tag, value in dynamic)
+    file_size = dynamic_offset + len(dynamic_data)
+
+    ident = elf.ELF_MAGIC + bytes([elf.ELFCLASS64, elf.ELFDATA2LSB, 1]) + b'\0' * 9
+    header = ident + struct.pack('<HHIQQQIHHHHHH', 3, machine, 1, 0, 64, 0, 0, 64, 56, phnum, 0, 0, 0)
+    phdrs = struct.pack('<IIQQQQQQ', elf.PT_LOAD, 5, 0, BASE_ADDRESS, BASE_ADDRESS, file_size, file_size, 0x1000)
+    phdrs += struct.pack('<IIQQQQQQ', elf.PT_DYNAMIC, 6, dynamic_offset, BASE_ADDRESS + dynamic_offset,
+                         BASE_ADDRESS + dynamic_offset, len(dynamic_data), len(dynamic_data), 8)
+    if interp:
+        phdrs += struct.pack('<IIQQQQQQ', elf.PT_INTERP, 4, interp_offset, BASE_ADDRESS + interp_offset,
+                             BASE_ADDRESS + interp_offset, len(interp_data), len(interp_data), 1)
+    with open(path, 'wb') as f:
+        f.write(header + phdrs + interp_data + strtab + dynamic_data)
+    return path
+
+def make_ld_so_cache(libraries):
+    """build a new format ld.so.cache from a list of (soname, path)"""
+    strings = b''
+    entries = b''
+    table_end = 48 + 24 * len(libraries)
+    for soname, path in libraries:
+        key = table_end + len(strings)
+        strings += soname.encode() + b'\0'
+        value = table_end + len(strings)
+        strings += path.encode() + b'\0'
+        entries += struct.pack('=iIIIQ', 0x0303, key, value, 0, 0)
+    header = elf.LD_SO_CACHE_MAGIC + struct.pack('=IIB3xI12x', len(libraries), len(strings), 2, 0)
+    return header + entries + strings
+
+@pytest.fixture
+def system(monkeypatch, tmpdir):
+    """an isolated loader view: no ld.so.cache and no default library directories"""
+    monkeypatch.setattr(elf, 'LD_SO_CACHE', str(tmpdir.join('ld.so.cache')))
+    monkeypatch.setattr(elf, 'LD_SO_PRELOAD', str(tmpdir.join('ld.so.preload')))
+    monkeypatch.setattr(elf, 'DEFAULT_LIB_DIRS', {elf.ELFCLASS64: [str(tmpdir.mkdir('default'))]})
+    monkeypatch.delenv('LD_LIBRARY_PATH', raising=False)
+    monkeypatch.delenv('LD_PRELOAD', raising=False)
+    return tmpdir
+
+def test_read_elf(tmpdir):
+    path = make_elf(str(tmpdir.join('a.out')), needed=['liba.so', 'libb.so'], runpath='$ORIGIN/lib',
+                    interp='/lib64/ld-linux-x86-64.so.2')
+    info = read_elf(path)
+    assert info['class'] == elf.ELFCLASS64
+    assert info['machine'] == 62
+    assert info['interp'] == '/lib64/ld-linux-x86-64.so.2'
+    assert info['needed'] == ['liba.so', 'libb.so']
+    assert info['runpath'] == ['$ORIGIN/lib']
+    assert info['rpath'] == []
+
+def test_read_elf_not_elf(tmpdir):
+    path = str(tmpdir.join('script.sh'))
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\necho hello\n')
+    assert read_elf(path) is None
+
+def test_read_elf_truncated(tmpdir):
+    path = make_elf(str(tmpdir.join('a.out')), needed=['liba.so'])
+    with open(path, 'r+b') as f:
+        f.truncate(80)
+    with pytest.raises(ELFError):
+        read_elf(path)
+
+def test_read_elf_missing_file(tmpdir):
+    with pytest.raises(ELFError):
+        read_elf(str(tmpdir.join('missing')))
+
+def test_parse_ld_so_cache():
+    data = make_ld_so_cache([('libc.so.6', '/lib64/libc.so.6'), ('libm.so.6', '/lib64/libm.so.6')])
+    assert parse_ld_so_cache(data) == {
+        'libc.so.6': [('/lib64/libc.so.6', 0)],
+        'libm.so.6': [('/lib64/libm.so.6', 0)],
+    }
+
+def test_parse_ld_so_cache_unknown_format():
+    with pytest.raises(ELFError):
+        parse_ld_so_cache(b'not a cache')
+
+def test_get_dynamic_libs_runpath_origin(system):
+    bindir = system.mkdir('bin')
+    libdir = system.mkdir('lib')
+    make_elf(str(libdir.join('libb.so')), soname='libb.so')
+    make_elf(str(libdir.join('liba.so')), needed=['libb.so'], soname='liba.so', runpath='$ORIGIN')
+    binary = make_elf(str(bindir.join('a.out')), needed=['liba.so'], runpath='$ORIGIN/../lib')
+    assert get_dynamic_libs(binary) == [
+        ('liba.so', os.path.join(str(bindir), '..', 'lib', 'liba.so'), ''),
+        ('libb.so', os.path.join(str(bindir), '..', 'lib', 'libb.so'), ''),
+    ]
+
+def test_get_dynamic_libs_rpath_is_inherited(system):
+    libdir = system.mkdir('lib')
+    make_elf(str(libdir.join('libb.so')))
+    make_elf(str(libdir.join('liba.so')), needed=['libb.so'])
+    binary = make_elf(str(system.join('a.out')), needed=['liba.so'], rpath=str(libdir))
+    assert [name for name, _, _ in get_dynamic_libs(binary)] == ['liba.so', 'libb.so']
+
+def test_get_dynamic_libs_runpath_is_not_inherited(system):
+    libdir = system.mkdir('lib')
+    make_elf(str(libdir.join('libb.so')))
+    make_elf(str(libdir.join('liba.so')), needed=['libb.so'])
+    binary = make_elf(str(system.join('a.out')), needed=['liba.so'], runpath=str(libdir))
+    with pytest.raises(ELFError):
+        get_dynamic_libs(binary)
+
+def test_get_dynamic_libs_ld_library_path_and_cache(system, monkeypatch):
+    envdir = system.mkdir('env')
+    cachedir = system.mkdir('cached')
+    make_elf(str(envdir.join('liba.so')))
+    make_elf(str(cachedir.join('libb.so')))
+    with open(elf.LD_SO_CACHE, 'wb') as f:
+        f.write(make_ld_so_cache([('libb.so', str(cachedir.join('libb.so')))]))
+    monkeypatch.setenv('LD_LIBRARY_PATH', str(envdir))
+    binary = make_elf(str(system.join('a.out')), needed=['liba.so', 'libb.so'])
+    assert get_dynamic_libs(binary) == [
+        ('liba.so', str(envdir.join('liba.so')), ''),
+        ('libb.so', str(cachedir.join('libb.so')), ''),
+    ]
+
+def test_get_dynamic_libs_skips_incompatible_machine(system):
+    wrongdir = system.mkdir('wrong')
+    rightdir = system.mkdir('right')
+    make_elf(str(wrongdir.join('liba.so')), machine=183)
+    make_elf(str(rightdir.join('liba.so')))
+    binary = make_elf(str(system.join('a.out')), needed=['liba.so'], rpath=f"{wrongdir}:{rightdir}")
+    assert get_dynamic_libs(binary) == [('liba.so', str(rightdir.join('liba.so')), '')]
+
+def test_get_dynamic_libs_interpreter(system):
+    interp = make_elf(str(system.join('ld.so')), soname='ld-linux-x86-64.so.2')
+    libdir = system.mkdir('lib')
+    make_elf(str(libdir.join('libc.so.6')), needed=['ld-linux-x86-64.so.2'])
+    binary = make_elf(str(system.join('a.out')), needed=['libc.so.6'], rpath=str(libdir), interp=interp)
+    assert get_dynamic_libs(binary) == [
+        ('libc.so.6', str(libdir.join('libc.so.6')), ''),
+        ('', interp, ''),
+    ]
+
+def test_get_dynamic_libs_static_and_not_elf(system):
+    binary = make_elf(str(system.join('static')))
+    assert get_dynamic_libs(binary) == []
+    script = str(system.join('script.sh'))
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\n')
+    assert get_dynamic_libs(script) is None
+
+def test_get_dynamic_libs_preload(system, monkeypatch):
+    binary = make_elf(str(system.join('a.out')), needed=['liba.so'])
+    monkeypatch.setenv('LD_PRELOAD', 'libfoo.so')
+    with pytest.raises(ELFError):
+        get_dynamic_libs(binary)
+
+@pytest.mark.skipif(not shutil.which('ldd') or not os.path.exists('/bin/ls'), reason="needs ldd")
+def test_get_dynamic_libs_matches_ldd():
+    libs = get_dynamic_libs('/bin/ls')
+    ldd_output = subprocess.run(['ldd', '/bin/ls'], stdout=subprocess.PIPE).stdout.decode()
+    ldd_paths = {line.split('=>')[-1].split('(')[0].strip() for line in ldd_output.splitlines()}
+    ldd_paths = {os.path.realpath(path) for path in ldd_paths if path.startswith('/')}
+    assert {os.path.realpath(path) for _, path, _ in libs} == ldd_paths
@@ -0,0 +1,81 @@
+import os
+import time
+import pytest
+from bincache import index
+from bincache import cache
+from bincache.cache import get_cache_file_path, put, get, trim_cache_dir_to_limit
+
+@pytest.fixture
+def setup_index_config(monkeypatch, tmpdir):
+    temp_cache_dir = str(tmpdir.mkdir("cache"))
+    temp_tempdir = str(tmpdir.mkdir("tempdir"))
+    mock_config = {'cache_dir': temp_cache_dir, 'temporary_dir': temp_tempdir, 'metadata_index': True}
+    monkeypatch.setattr('bincache.cache.get_config', lambda: mock_config)
+    monkeypatch.setattr(index, 'TOUCH_PROBABILITY', 1)
+    yield mock_config
+    index.close()
+
+def entry(stdout):
+    return {'stdout': stdout, 'stderr': b'', 'returncode': 0}
+
+def indexed(cache_dir):
+    connection = index.get_connection(cache_dir)
+    return {key: (size, hit_count) for key, size, hit_count in connection.execute('SELECT key, size, hit_count FROM entries')}
+
+def test_put_and_get_are_recorded(setup_index_config):
+    cache_dir = setup_index_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    get('key1')
+    get('key1')
+    size = os.path.getsize(get_cache_file_path('key1'))
+    assert indexed(cache_dir) == {'key1': (size, 2)}
+
+def test_eviction_is_least_recently_used(setup_index_config):
+    cache_dir = setup_index_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    time.sleep(0.01)
+    put('key2', entry(b'b' * 100))
+    time.sleep(0.01)
+    put('key3', entry(b'c' * 100))
+    time.sleep(0.01)
+    # key1 is the oldest write but the most recent read
+    assert get('key1') == entry(b'a' * 100)
+    size = os.path.getsize(get_cache_file_path('key1'))
+
+    trim_cache_dir_to_limit(cache_dir, 2 * size)
+
+    assert get('key1') == entry(b'a' * 100)
+    assert get('key2') is None
+    assert get('key3') == entry(b'c' * 100)
+    assert set(indexed(cache_dir)) == {'key1', 'key3'}
+
+def test_eviction_does_not_scan(setup_index_config, monkeypatch):
+    cache_dir = setup_index_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    put('key2', entry(b'b' * 100))
+    cache.get_cache_size(cache_dir)
+    def no_scan(cache_dir):
+        raise AssertionError("cache dir scanned")
+    monkeypatch.setattr(cache, 'scan_cache_dir', no_scan)
+    trim_cache_dir_to_limit(cache_dir, os.path.getsize(get_cache_file_path('key1')))
+    assert len(indexed(cache_dir)) == 1
+
+def test_index_imports_existing_entries(setup_index_config):
+    cache_dir = setup_index_config['cache_dir']
+    setup_index_config['metadata_index'] = False
+    put('key1', entry(b'a' * 100))
+    setup_index_config['metadata_index'] = True
+    assert set(indexed(cache_dir)) == {'key1'}
+
+def test_sync_with_scan(setup_index_config):
+    cache_dir = setup_index_config['cache_dir']
+    put('key1', entry(b'a' * 100))
+    put('key2', entry(b'b' * 100))
+    os.remove(get_cache_file_path('key1'))
+    setup_index_config['metadata_index'] = False
+    put('key3', entry(b'c' * 100))
+    setup_index_config['metadata_index'] = True
+
+    index.sync(cache_dir, cache.scan_cache_dir(cache_dir))
+
+    assert set(indexed(cache_dir)) == {'key2', 'key3'}
@@ -0,0 +1,151 @@
+import os
+import sys
+import subprocess
+import pytest
+from bincache import config
+from bincache import signature
+from bincache.cli import get_cache_key
+from bincache.inputs import hash_arg_files, StdinInput
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    monkeypatch.setenv('BINCACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(config, '_config', None)
+    monkeypatch.setattr(signature, '_memos', {})
+    yield cache_dir
+    config._config = None
+
+def test_hash_arg_files(cache_dir, tmpdir):
+    tmpdir.join('data.txt').write('data')
+    tmpdir.mkdir('subdir')
+    inputs = hash_arg_files(['-n', 'data.txt', 'subdir', 'missing.txt', ''], cwd=str(tmpdir))
+    assert inputs == [('file', 'data.txt', signature.hash_file(str(tmpdir.join('data.txt'))))]
+
+@pytest.mark.skipif(not os.path.exists('/bin/cat'), reason="needs /bin/cat")
+def test_cache_key_follows_argument_files(cache_dir, tmpdir, monkeypatch):
+    data = tmpdir.join('data.txt')
+    data.write('one')
+    untracked = get_cache_key(['cat', 'data.txt'], cwd=str(tmpdir))
+    cache_dir.join('bincache.conf').write("track_inputs = true\n")
+    monkeypatch.setattr(config, '_config', None)
+    tracked = get_cache_key(['cat', 'data.txt'], cwd=str(tmpdir))
+    assert tracked != untracked
+    data.write('two')
+    assert get_cache_key(['cat', 'data.txt'], cwd=str(tmpdir)) != tracked
+    # case: stdin 的摘要也进入缓存键
+    assert get_cache_key(['cat', 'data.txt'], cwd=str(tmpdir), stdin_digest='abc') != tracked
+
+def test_stdin_regular_file(cache_dir, tmpdir):
+    data = tmpdir.join('data.txt')
+    data.write('header\nbody\n')
+    with open(str(data), 'rb') as f:
+        stdin = StdinInput(0, f.fileno())
+        assert stdin.digest == signature.hash_file(str(data))
+        assert stdin.file is None and stdin.popen_stdin() is None
+        # case: 已经读过一部分的文件只对剩余部分计算摘要
+        f.seek(len('header\n'))
+        partial = StdinInput(0, f.fileno())
+        body_hash = signature.new_hash(signature.get_hash_algorithm())
+        body_hash.update(b'body\n')
+        assert partial.digest == body_hash.hexdigest()
+        assert f.tell() == len('header\n')
+
+def pipe_with(data):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    return read_fd
+
+def test_stdin_pipe_is_spilled(cache_dir):
+    fd = pipe_with(b'piped data')
+    try:
+        stdin = StdinInput(1024, fd)
+    finally:
+        os.close(fd)
+    assert stdin.cacheable
+    file_hash = signature.new_hash(signature.get_hash_algorithm())
+    file_hash.update(b'piped data')
+    assert stdin.digest == file_hash.hexdigest()
+    assert stdin.popen_stdin().read() == b'piped data'
+    stdin.close()
+
+def test_stdin_pipe_is_left_alone_without_limit(cache_dir):
+    fd = pipe_with(b'piped data')
+    try:
+        # case: 没有 stdin 策略时管道不被读取，命令照常继承，但这次运行不缓存
+        stdin = StdinInput(None, fd)
+        assert stdin.digest is None and not stdin.cacheable
+        assert stdin.popen_stdin() is None
+        assert os.read(fd, 1024) == b'piped data'
+    finally:
+        os.close(fd)
+
+@pytest.mark.skipif(not os.path.exists('/bin/cat'), reason="needs /bin/cat")
+def test_stdin_over_limit_is_fed_to_the_command(cache_dir):
+    fd = pipe_with(b'x' * 100)
+    try:
+        stdin = StdinInput(10, fd)
+        assert not stdin.cacheable and stdin.digest is None
+        process = subprocess.Popen(['cat'], stdin=stdin.popen_stdin(), stdout=subprocess.PIPE)
+        stdin.feed(process)
+        assert process.stdout.read() == b'x' * 100
+        process.wait()
+    finally:
+        os.close(fd)
+        stdin.close()
+
+def run_bincache(cache_dir, cwd, argv, **kwargs):
+    env = dict(os.environ, BINCACHE_DIR=str(cache_dir), PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-m', 'bincache.cli', *argv], env=env, cwd=str(cwd),
+                          stdout=subprocess.PIPE, check=True, **kwargs).stdout
+
+@pytest.mark.skipif(not os.path.exists('/bin/cat'), reason="needs /bin/cat")
+def test_tracked_commands_end_to_end(cache_dir, tmpdir):
+    cache_dir.join('bincache.conf').write("track_inputs = true\n[key:cat]\nstdin = true\n")
+    data = tmpdir.join('data.txt')
+    data.write('one\n')
+    with open(str(data), 'rb') as f:
+        assert run_bincache(cache_dir, tmpdir, ['cat'], stdin=f) == b'one\n'
+    data.write('two\n')
+    with open(str(data), 'rb') as f:
+        assert run_bincache(cache_dir, tmpdir, ['cat'], stdin=f) == b'two\n'
+    assert run_bincache(cache_dir, tmpdir, ['cat', 'data.txt']) == b'two\n'
+    data.write('three\n')
+    assert run_bincache(cache_dir, tmpdir, ['cat', 'data.txt']) == b'three\n'
+    for text in (b'a\n', b'b\n', b'a\n'):
+        assert run_bincache(cache_dir, tmpdir, ['cat'], input=text) == text
+
+@pytest.mark.skipif(not os.path.exists('/bin/echo'), reason="needs /bin/echo")
+def test_piped_stdin_is_not_waited_for(cache_dir, tmpdir):
+    cache_dir.join('bincache.conf').write("track_inputs = true\n")
+    # case: 默认不读管道，写端一直不关闭也不会卡住
+    read_fd, write_fd = os.pipe()
+    try:
+        assert run_bincache(cache_dir, tmpdir, ['echo', 'hi'], stdin=read_fd, timeout=30) == b'hi\n'
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def test_dev_null_stdin_is_not_part_of_the_key(cache_dir):
+    with open(os.devnull, 'rb') as f:
+        stdin = StdinInput(None, f.fileno())
+    assert stdin.digest is None and stdin.cacheable and stdin.popen_stdin() is None
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_unhashed_pipe_is_not_cached(cache_dir, tmpdir):
+    log = tmpdir.join('runs.log')
+    argv = ['sh', '-c', f'echo run >> {log}; cat']
+    cache_dir.join('bincache.conf').write("track_inputs = true\n")
+    # case: 没有 stdin 策略的管道输入不会命中旧的结果
+    for text in (b'one\n', b'two\n', b'two\n'):
+        assert run_bincache(cache_dir, tmpdir, argv, input=text) == text
+    assert log.read() == 'run\n' * 3
+    # case: 有 stdin 策略时超过 1M 的管道输入也会缓存，上限是 max_stdin_size
+    cache_dir.join('bincache.conf').write("track_inputs = true\n[key:sh]\nstdin = true\n")
+    big = b'x' * (2 * 1024 * 1024)
+    for _ in range(2):
+        assert run_bincache(cache_dir, tmpdir, argv, input=big) == big
+    assert log.read() == 'run\n' * 4
@@ -11,7 +11,15 @@ import bincache.logger as log_module
 # 重置 _logger
 @pytest.fixture(autouse=True)
 def reset_logger():
-    bincache_log._logger = None
+    def reset():
+        bincache_log._logger = None
+        logger = logging.getLogger('bincache')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = True
+    reset()
+    yield
+    reset()
 
 def test_get_logger_default_config():
     """测试 get_logger 函数在默认配置下的行为"""
@@ -24,8 +32,10 @@ def test_get_logger_default_config():
         # 检查日志级别
         assert logger.level == logging.INFO
         
-        # 检查日志处理程序
-        assert len(logger.handlers) == 0
+        # 检查日志处理程序：没有日志文件时什么都不输出，也不交给 root logger
+        assert len(logger.handlers) == 1
+        assert isinstance(logger.handlers[0], logging.NullHandler)
+        assert not logger.propagate
 
 
 def test_get_logger_with_file():
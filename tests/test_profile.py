@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import pstats
+import subprocess
+import pytest
+from bincache import config
+from bincache import profile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    monkeypatch.setenv('BINCACHE_DIR', str(cache_dir))
+    monkeypatch.delenv(profile.PROFILE_ENV, raising=False)
+    monkeypatch.setattr(config, '_config', None)
+    yield cache_dir
+    config._config = None
+
+def read_traces(cache_dir):
+    with open(str(cache_dir.join(config.DEFAULT_PROFILE_FILE))) as f:
+        return [json.loads(line) for line in f]
+
+def test_profile_mode(cache_dir, monkeypatch):
+    assert profile.get_profile_mode() is None
+    cache_dir.join('bincache.conf').write("profile = cprofile\n")
+    monkeypatch.setattr(config, '_config', None)
+    assert profile.get_profile_mode() == 'cprofile'
+    # case: 环境变量优先于配置
+    monkeypatch.setenv(profile.PROFILE_ENV, '0')
+    assert profile.get_profile_mode() is None
+    monkeypatch.setenv(profile.PROFILE_ENV, '1')
+    assert profile.get_profile_mode() == 'timings'
+
+def test_phases_are_free_when_off(cache_dir):
+    assert profile.phase('lookup') is profile.NO_PHASE
+    with profile.phase('lookup'):
+        pass
+    profile.annotate(outcome='hit')
+    assert profile.profile_run(lambda: 42) == 42
+    assert not cache_dir.join(config.DEFAULT_PROFILE_FILE).check()
+
+def test_profile_run_writes_a_trace(cache_dir, monkeypatch):
+    monkeypatch.setenv(profile.PROFILE_ENV, '1')
+    def run():
+        for _ in range(2):
+            with profile.phase('hash'):
+                pass
+        profile.annotate(outcome='hit')
+        sys.exit(3)
+    with pytest.raises(SystemExit):
+        profile.profile_run(run)
+    trace, = read_traces(cache_dir)
+    assert trace['outcome'] == 'hit' and trace['exit'] == 3
+    assert trace['phases']['hash']['count'] == 2
+    assert trace['total_ms'] >= trace['phases']['hash']['ms']
+    # case: 运行结束后计时关闭
+    assert profile.phase('hash') is profile.NO_PHASE
+
+def test_cprofile_mode_dumps_stats(cache_dir, monkeypatch):
+    monkeypatch.setenv(profile.PROFILE_ENV, 'cprofile')
+    profile.profile_run(lambda: sum(range(1000)))
+    trace, = read_traces(cache_dir)
+    assert os.path.dirname(trace['cprofile']) == str(cache_dir.join(profile.PROFILE_DIR))
+    assert pstats.Stats(trace['cprofile']).total_calls > 0
+
+@pytest.mark.skipif(not os.path.exists('/bin/echo'), reason="needs /bin/echo")
+def test_hit_path_phases(cache_dir):
+    env = dict(os.environ, BINCACHE_DIR=str(cache_dir), PYTHONPATH=ROOT, BINCACHE_PROFILE='1')
+    for _ in range(2):
+        subprocess.run([sys.executable, '-m', 'bincache.cli', 'echo', 'hi'], env=env,
+                       stdout=subprocess.PIPE, check=True)
+    miss, hit = read_traces(cache_dir)
+    assert miss['argv'] == ['echo', 'hi'] and miss['outcome'] == 'miss'
+    assert {'which', 'signature', 'libs', 'hash', 'lookup', 'execute', 'commit'} <= set(miss['phases'])
+    assert hit['outcome'] == 'hit' and hit['exit'] == 0 and hit['key'] == miss['key']
+    assert {'lookup', 'open', 'replay'} <= set(hit['phases']) and 'execute' not in hit['phases']
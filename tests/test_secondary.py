@@ -0,0 +1,196 @@
+import os
+import time
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from bincache import cache
+from bincache import config
+from bincache import secondary
+
+def entry(stdout, stderr=b'', returncode=0):
+    return {'stdout': stdout, 'stderr': stderr, 'returncode': returncode}
+
+class Runner:
+    """一个 CI runner：有自己的 BINCACHE_DIR，共享同一个 secondary"""
+
+    def __init__(self, monkeypatch, cache_dir, location, background_push=False):
+        self.monkeypatch = monkeypatch
+        self.cache_dir = cache_dir
+        cache_dir.join('bincache.conf').write(f"secondary = {location}\nbackground_push = {background_push}\n")
+
+    def activate(self):
+        self.monkeypatch.setenv('BINCACHE_DIR', str(self.cache_dir))
+        config._config = None
+
+    def read(self, key):
+        self.activate()
+        found = cache.open_entry(key)
+        if found is None:
+            return None
+        with found['file'] as f:
+            offset, size = found['stdout']
+            return os.pread(f.fileno(), size, offset)
+
+    def put(self, key, value):
+        self.activate()
+        cache.put(key, value)
+
+def queued(runner):
+    outbox_dir = secondary.get_outbox_dir(str(runner.cache_dir))
+    return sorted(os.listdir(outbox_dir)) if os.path.exists(outbox_dir) else []
+
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+    monkeypatch.setattr(config, '_config', None)
+    monkeypatch.setattr(secondary, '_stores', {})
+    yield
+    config._config = None
+
+class StandInHandler(BaseHTTPRequestHandler):
+    store = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        data = self.store.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        self.requests.append(('PUT', self.path))
+        self.store[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def http_store():
+    StandInHandler.store = {}
+    StandInHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/cache"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=['directory', 'http'])
+def location(request, tmpdir):
+    if request.param == 'directory':
+        return str(tmpdir.mkdir('shared'))
+    return request.getfixturevalue('http_store')
+
+def test_remote_hits_are_promoted(monkeypatch, tmpdir, location):
+    first = Runner(monkeypatch, tmpdir.mkdir('runner1'), location)
+    second = Runner(monkeypatch, tmpdir.mkdir('runner2'), location)
+    first.put('abcdef', entry(b'output'))
+    assert queued(first) == []
+
+    assert second.read('abcdef') == b'output'
+    assert os.path.exists(os.path.join(str(second.cache_dir), 'ab', 'cdef'))
+    # case: 提升到本地的条目不会再被推送回去
+    assert queued(second) == []
+    assert second.read('missing') is None
+
+def test_http_store_requests(monkeypatch, tmpdir, http_store):
+    runner = Runner(monkeypatch, tmpdir.mkdir('runner'), http_store)
+    runner.put('abcdef', entry(b'output'))
+    assert ('PUT', '/cache/abcdef') in StandInHandler.requests
+    os.remove(os.path.join(str(runner.cache_dir), 'ab', 'cdef'))
+    assert runner.read('abcdef') == b'output'
+    assert StandInHandler.requests[-1] == ('GET', '/cache/abcdef')
+
+def test_invalid_remote_entries_are_ignored(monkeypatch, tmpdir):
+    shared = tmpdir.mkdir('shared')
+    # case: 共享层里的旧格式（pickle）或损坏的条目不会被加载
+    shared.mkdir('ab').join('cdef').write_binary(b'\x80\x04not an entry')
+    runner = Runner(monkeypatch, tmpdir.mkdir('runner'), str(shared))
+    assert runner.read('abcdef') is None
+    assert not os.path.exists(os.path.join(str(runner.cache_dir), 'ab', 'cdef'))
+
+def test_failed_pushes_stay_queued(monkeypatch, tmpdir):
+    shared = tmpdir.join('shared')
+    shared.write('a file where the directory should be')
+    runner = Runner(monkeypatch, tmpdir.mkdir('runner'), str(shared))
+    runner.put('abcdef', entry(b'output'))
+    assert queued(runner) == ['abcdef']
+
+    shared.remove()
+    shared.mkdir()
+    runner.activate()
+    assert secondary.push_outbox()
+    assert queued(runner) == []
+    assert shared.join('ab', 'cdef').check()
+
+def test_background_push_is_detached(monkeypatch, tmpdir):
+    runner = Runner(monkeypatch, tmpdir.mkdir('runner'), str(tmpdir.mkdir('shared')), background_push=True)
+    spawned = []
+    monkeypatch.setattr(secondary, 'spawn_bincache', lambda cache_dir, *args: spawned.append(args))
+    runner.put('abcdef', entry(b'output'))
+    assert spawned == [('--push',)]
+    assert queued(runner) == ['abcdef']
+
+    # case: 已有推送进程在运行时不再启动新的
+    fd = secondary.lock_push(str(runner.cache_dir))
+    try:
+        runner.put('abcdeg', entry(b'output'))
+    finally:
+        os.close(fd)
+    assert spawned == [('--push',)]
+
+@pytest.mark.parametrize('deduplicate', [False, True])
+def test_queued_entries_are_evicted_by_size(monkeypatch, tmpdir, deduplicate):
+    cache_dir = tmpdir.mkdir('runner')
+    runner = Runner(monkeypatch, cache_dir, 'http://127.0.0.1:1/cache')
+    cache_dir.join('bincache.conf').write(f"deduplicate = {deduplicate}\n", mode='a')
+    for i in range(10):
+        runner.put(f'key{i:02}', entry(bytes([i]) * 1000))
+    # case: 推送失败，条目都留在 outbox 里
+    assert len(queued(runner)) == 10
+    entry_size = os.stat(cache.get_cache_file_path('key00')).st_size
+    cache.write_ledger(str(cache_dir), 10 * entry_size, 10)
+    now = time.time()
+    for i in range(10):
+        os.utime(cache.get_cache_file_path(f'key{i:02}'), (now - 100 + i, now - 100 + i))
+    cache.trim_cache_dir_to_limit(str(cache_dir), 8000)
+    # case: outbox 的链接不算引用，只淘汰到限额以内
+    remaining = [i for i in range(10) if os.path.exists(cache.get_cache_file_path(f'key{i:02}'))]
+    assert remaining == list(range(10 - 8000 // entry_size, 10))
+    assert cache.read_ledger(str(cache_dir))[:2] == (len(remaining) * entry_size, len(remaining))
+    assert len(queued(runner)) == 10
+
+def test_failing_secondary_is_backed_off(monkeypatch, tmpdir):
+    shared = tmpdir.mkdir('shared')
+    runner = Runner(monkeypatch, tmpdir.mkdir('runner'), str(shared))
+    fetches = []
+
+    def failing_fetch(self, key, f):
+        fetches.append(key)
+        raise OSError("unreachable")
+
+    monkeypatch.setattr(secondary.DirectoryStore, 'fetch', failing_fetch)
+    assert runner.read('abcdef') is None
+    # case: 失败之后的一段时间内本地未命中不再访问 secondary
+    assert runner.read('abcdeg') is None
+    assert fetches == ['abcdef']
+    down_file = runner.cache_dir.join(secondary.DOWN_FILE)
+    assert down_file.check()
+
+    # case: 过期之后重新尝试
+    past = time.time() - secondary.DOWN_SECONDS - 1
+    os.utime(str(down_file), (past, past))
+    assert runner.read('abcdeg') is None
+    assert fetches == ['abcdef', 'abcdeg']
+
+    # case: 推送成功说明 secondary 恢复了
+    runner.put('abcdeh', entry(b'output'))
+    assert not down_file.check()
+    assert shared.join('ab', 'cdeh').check()
@@ -1,10 +1,25 @@
 import os
 import tempfile
+import time
 import hashlib
 import pytest
 import subprocess
 from unittest import mock
-from bincache.signature import hash_file_md5, get_dynamic_libs, generate_signature
+from bincache import signature
+from bincache.signature import hash_file, hash_file_md5, get_file_hash, get_dynamic_libs, generate_signature
+
+@pytest.fixture(autouse=True)
+def memo_cache_dir(monkeypatch, tmpdir):
+    cache_dir = str(tmpdir.mkdir("cache"))
+    monkeypatch.setattr('bincache.signature.get_config', lambda: {'cache_dir': cache_dir})
+    monkeypatch.setattr(signature, '_memos', {})
+    return cache_dir
+
+def write_file(tmpdir, name, content):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
 
 def test_hash_file_md5():
     content = b"test content for hashing"
@@ -20,6 +35,95 @@ def test_hash_file_md5():
     finally:
         os.remove(tmpfile_path)
 
+@pytest.mark.parametrize('algorithm, expected', [
+    ('blake2b', hashlib.blake2b(b'x' * 3000000, digest_size=16).hexdigest()),
+    ('sha256', hashlib.sha256(b'x' * 3000000).hexdigest()),
+    ('md5', hashlib.md5(b'x' * 3000000).hexdigest()),
+])
+def test_hash_file(tmpdir, algorithm, expected):
+    path = write_file(tmpdir, 'big', b'x' * 3000000)
+    assert hash_file(path, algorithm) == expected
+
+def test_hash_algorithm_without_xxhash(monkeypatch):
+    monkeypatch.setattr('bincache.signature.xxhash', None)
+    monkeypatch.setattr('bincache.signature.get_config', lambda: {'hash_algorithm': 'xxh3'})
+    assert signature.get_hash_algorithm() == 'blake2b'
+
+def test_get_file_hash_memo_is_per_algorithm(monkeypatch, tmpdir, memo_cache_dir):
+    monkeypatch.setattr(signature, 'RACY_WINDOW_NS', 0)
+    path = write_file(tmpdir, 'lib.so', b'library content')
+    config = {'cache_dir': memo_cache_dir, 'hash_algorithm': 'sha256'}
+    monkeypatch.setattr('bincache.signature.get_config', lambda: config)
+    assert get_file_hash(path) == hashlib.sha256(b'library content').hexdigest()
+    config['hash_algorithm'] = 'md5'
+    assert get_file_hash(path) == hashlib.md5(b'library content').hexdigest()
+
+def test_generate_signature_depends_on_algorithm(monkeypatch, memo_cache_dir):
+    monkeypatch.setattr('bincache.signature.hash_file', lambda path, algorithm: 'digest')
+    monkeypatch.setattr('bincache.signature.get_dynamic_libs', lambda binary, environ=None: [])
+    config = {'cache_dir': memo_cache_dir, 'hash_algorithm': 'sha256'}
+    monkeypatch.setattr('bincache.signature.get_config', lambda: config)
+    sha256_key = generate_signature('dummy_binary', ['arg'])
+    config['hash_algorithm'] = 'md5'
+    assert generate_signature('dummy_binary', ['arg']) != sha256_key
+
+def test_get_file_hash_memo(monkeypatch, tmpdir):
+    monkeypatch.setattr(signature, 'RACY_WINDOW_NS', 0)
+    path = write_file(tmpdir, 'lib.so', b'library content')
+    calls = []
+    def counting_hash(file_path, algorithm):
+        calls.append(file_path)
+        return hashlib.md5(open(file_path, 'rb').read()).hexdigest()
+    monkeypatch.setattr('bincache.signature.hash_file', counting_hash)
+
+    assert get_file_hash(path) == hashlib.md5(b'library content').hexdigest()
+    assert get_file_hash(path) == hashlib.md5(b'library content').hexdigest()
+    assert calls == [path]
+
+    # any change of the stat identity invalidates the memo
+    with open(path, 'wb') as f:
+        f.write(b'new library content')
+    assert get_file_hash(path) == hashlib.md5(b'new library content').hexdigest()
+    assert len(calls) == 2
+
+def test_get_file_hash_skips_recently_changed_files(monkeypatch, tmpdir):
+    path = write_file(tmpdir, 'lib.so', b'library content')
+    calls = []
+    monkeypatch.setattr('bincache.signature.hash_file', lambda p, algorithm: calls.append(p) or 'digest')
+    get_file_hash(path)
+    get_file_hash(path)
+    assert len(calls) == 2
+
+def test_prune_memo_dir(tmpdir):
+    memo_dir = str(tmpdir.mkdir("memo"))
+    for i in range(5):
+        path = os.path.join(memo_dir, str(i))
+        with open(path, 'w') as f:
+            f.write('x')
+        os.utime(path, (1000 + i, 1000 + i))
+    signature.prune_memo_dir(memo_dir, 3)
+    assert sorted(os.listdir(memo_dir)) == ['2', '3', '4']
+
+def test_get_file_hashes_keeps_order(monkeypatch, tmpdir, memo_cache_dir):
+    paths = [write_file(tmpdir, f'lib{i}.so', b'lib%d' % i) for i in range(8)]
+    config = {'cache_dir': memo_cache_dir, 'hash_workers': 4}
+    monkeypatch.setattr('bincache.signature.get_config', lambda: config)
+    def slow_hash(file_path, algorithm):
+        # later files finish first
+        time.sleep(0.001 * (8 - paths.index(file_path)))
+        return os.path.basename(file_path)
+    monkeypatch.setattr('bincache.signature.hash_file', slow_hash)
+    assert signature.get_file_hashes(paths) == [f'lib{i}.so' for i in range(8)]
+
+def test_get_file_hashes_memo_hits_skip_the_pool(monkeypatch, tmpdir):
+    monkeypatch.setattr(signature, 'RACY_WINDOW_NS', 0)
+    paths = [write_file(tmpdir, f'lib{i}.so', b'lib%d' % i) for i in range(4)]
+    expected = signature.get_file_hashes(paths)
+    def no_pool(*args, **kwargs):
+        raise AssertionError("thread pool used on memo hits")
+    monkeypatch.setattr('concurrent.futures.ThreadPoolExecutor', no_pool)
+    assert signature.get_file_hashes(paths) == expected
+
 def test_get_dynamic_libs():
     example_output = b"""
     linux-vdso.so.1 =>  (0x00007fff6ab93000)
@@ -47,11 +151,64 @@ def test_get_dynamic_libs():
         ]
         
         assert libs == expected_libs
-@mock.patch('bincache.signature.hash_file_md5', autospec=True)
+def test_get_dynamic_libs_prefers_elf_reader(monkeypatch):
+    monkeypatch.setattr('bincache.signature.elf.get_dynamic_libs', lambda binary, **kwargs: [('libc.so.6', '/lib64/libc.so.6', '')])
+    with mock.patch('subprocess.Popen') as mock_popen:
+        assert get_dynamic_libs('dummy_binary') == [('libc.so.6', '/lib64/libc.so.6', '')]
+        mock_popen.assert_not_called()
+
+def test_get_dynamic_libs_falls_back_to_ldd(monkeypatch):
+    def raise_elf_error(binary, **kwargs):
+        raise signature.elf.ELFError('unsupported')
+    monkeypatch.setattr('bincache.signature.elf.get_dynamic_libs', raise_elf_error)
+    monkeypatch.setattr('bincache.signature.get_dynamic_libs_ldd', lambda binary, environ=None: [('libc.so.6', '/lib/libc.so.6', '0x1')])
+    assert get_dynamic_libs('dummy_binary') == [('libc.so.6', '/lib/libc.so.6', '0x1')]
+
+def test_get_dynamic_libs_index(monkeypatch, tmpdir):
+    monkeypatch.setattr(signature, 'RACY_WINDOW_NS', 0)
+    ld_so_cache = write_file(tmpdir, 'ld.so.cache', b'cache')
+    monkeypatch.setattr('bincache.signature.elf.LD_SO_CACHE', ld_so_cache)
+    monkeypatch.delenv('LD_LIBRARY_PATH', raising=False)
+    binary = write_file(tmpdir, 'a.out', b'binary')
+    calls = []
+    def resolve(path, environ=None):
+        calls.append(path)
+        return [('libc.so.6', '/lib64/libc.so.6', ''), ('', '/lib64/ld-linux-x86-64.so.2', '')]
+    monkeypatch.setattr('bincache.signature.resolve_dynamic_libs', resolve)
+
+    expected = [('libc.so.6', '/lib64/libc.so.6', ''), ('', '/lib64/ld-linux-x86-64.so.2', '')]
+    assert get_dynamic_libs(binary) == expected
+    assert get_dynamic_libs(binary) == expected
+    assert len(calls) == 1
+
+    monkeypatch.setenv('LD_LIBRARY_PATH', '/opt/lib')
+    assert get_dynamic_libs(binary) == expected
+    assert len(calls) == 2
+
+    with open(ld_so_cache, 'wb') as f:
+        f.write(b'new cache')
+    assert get_dynamic_libs(binary) == expected
+    assert len(calls) == 3
+
+    with open(binary, 'wb') as f:
+        f.write(b'new binary')
+    assert get_dynamic_libs(binary) == expected
+    assert len(calls) == 4
+
+def test_get_dynamic_libs_index_not_elf(monkeypatch, tmpdir):
+    monkeypatch.setattr(signature, 'RACY_WINDOW_NS', 0)
+    script = write_file(tmpdir, 'script.sh', b'#!/bin/sh\n')
+    calls = []
+    monkeypatch.setattr('bincache.signature.resolve_dynamic_libs', lambda path, environ=None: calls.append(path))
+    assert get_dynamic_libs(script) is None
+    assert get_dynamic_libs(script) is None
+    assert len(calls) == 1
+
+@mock.patch('bincache.signature.hash_file', autospec=True)
 @mock.patch('bincache.signature.get_dynamic_libs', autospec=True)
-def test_generate_signature(mock_get_dynamic_libs, mock_hash_file_md5):
+def test_generate_signature(mock_get_dynamic_libs, mock_hash_file):
     # 定义根据文件路径返回不同的哈希值的逻辑
-    def hash_side_effect(path):
+    def hash_side_effect(path, algorithm):
         hash_dict = {
             'dummy_binary': 'hash_of_dummy_binary',
             '/lib64/libstdc++.so.6': 'hash_of_libstdc++',
@@ -62,7 +219,7 @@ def test_generate_signature(mock_get_dynamic_libs, mock_hash_file_md5):
         }
         return hash_dict.get(path, 'hash_of_unknown_lib')
     
-    mock_hash_file_md5.side_effect = hash_side_effect
+    mock_hash_file.side_effect = hash_side_effect
     
     # 模拟 get_dynamic_libs 返回的动态库信息
     mock_get_dynamic_libs.return_value = [
@@ -86,11 +243,50 @@ def test_generate_signature(mock_get_dynamic_libs, mock_hash_file_md5):
         ('/lib64/libc.so.6', 'hash_of_libc'),
         ('/lib64/ld-linux-x86-64.so.2', 'hash_of_ld-linux-x86-64.so.2')
     ]
-    expected_signature_source = f"{expected_binary_hash}{expected_libs_info}arg1 arg2"
-    expected_signature = hashlib.md5(expected_signature_source.encode('utf-8')).hexdigest()
+    expected_signature_source = f"bincache-v2-blake2b:{expected_binary_hash}{expected_libs_info}arg1 arg2"
+    expected_signature = hashlib.blake2b(expected_signature_source.encode('utf-8'), digest_size=16).hexdigest()
     
     # 调用 generate_signature 函数生成签名
     signature = generate_signature(binary, args)
     
     # 验证生成的签名是否正确
-    assert signature == expected_signature
\ No newline at end of file
+    assert signature == expected_signature
+
+def test_memos_are_kept_in_memory(tmpdir, monkeypatch):
+    monkeypatch.setattr(signature, 'is_racy', lambda st: False)
+    path = write_file(tmpdir, 'libfoo.so', b'library content')
+    digest = get_file_hash(path)
+    memo_path = signature.get_memo_path('hash', path)
+    os.remove(memo_path)
+    with mock.patch('bincache.signature.hash_file', side_effect=AssertionError("hashed again")):
+        assert get_file_hash(path) == digest
+    # the file changing is still noticed
+    write_file(tmpdir, 'libfoo.so', b'other content')
+    assert get_file_hash(path) == hashlib.blake2b(b'other content', digest_size=16).hexdigest()
+
+def test_key_policy(monkeypatch, memo_cache_dir, tmpdir):
+    monkeypatch.setattr('bincache.signature.get_dynamic_libs', lambda binary, environ=None: [])
+    binary = write_file(tmpdir, 'gcc', b'binary')
+    config = {'cache_dir': memo_cache_dir, 'key_policy': {}, 'key_policies': {}}
+    monkeypatch.setattr('bincache.signature.get_config', lambda: config)
+    plain = generate_signature(binary, ['-o', '/tmp/tmpab12/out.o'])
+
+    # case: 环境变量进入缓存键，未设置和设置为空不同
+    config['key_policy'] = {'env': ['LANG']}
+    keys = {generate_signature(binary, ['-o', '/tmp/tmpab12/out.o'], environ=environ)
+            for environ in ({}, {'LANG': ''}, {'LANG': 'C'}, {'LANG': 'C', 'HOME': '/root'})}
+    assert len(keys) == 3
+    assert plain not in keys
+
+    # case: 参数按规则改写后再计算
+    config['key_policy'] = {'rewrite': [('^/tmp/tmp[a-z0-9]+/', '/tmp/TMP/')]}
+    assert generate_signature(binary, ['-o', '/tmp/tmpab12/out.o']) == generate_signature(binary, ['-o', '/tmp/tmpcd34/out.o'])
+    components = signature.get_key_components(binary, ['-o', '/tmp/tmpab12/out.o'])
+    assert components['args'] == ['-o', '/tmp/TMP/out.o']
+
+    # case: 按二进制名覆盖，cwd 进入缓存键
+    config['key_policies'] = {'gcc': {'cwd': True, 'rewrite': []}}
+    assert generate_signature(binary, ['x'], cwd='/a') != generate_signature(binary, ['x'], cwd='/b')
+    assert signature.get_key_components(binary, ['/tmp/tmpab12/'], cwd='/a')['args'] == ['/tmp/tmpab12/']
+    config['key_policies'] = {binary: {'cwd': False}, 'gcc': {'cwd': True}}
+    assert generate_signature(binary, ['x'], cwd='/a') == generate_signature(binary, ['x'], cwd='/b')
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# cumulative import time of bincache.cli on a cache hit, generous enough for slow CI machines
+IMPORT_BUDGET_US = 30000
+# modules a hit must not pay for, they are only needed on a miss or for maintenance
+MISS_ONLY_MODULES = ['subprocess', 'shutil', 'pickle', 'configparser', 'logging', 'tempfile',
+                     'selectors', 'sqlite3', 'hashlib', 'concurrent.futures']
+
+def parse_importtime(stderr):
+    """return dict of module -> (self us, cumulative us) from python -X importtime output"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+def run_bincache(tmpdir, *args):
+    env = dict(os.environ, BINCACHE_DIR=str(tmpdir.join('cache')), PYTHONPATH=ROOT,
+               PYTHONPYCACHEPREFIX=str(tmpdir.join('pycache')))
+    # measure imports from bytecode, like an installed bincache
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from bincache.cli import main; main()', *args],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=str(tmpdir), check=True)
+
+@pytest.mark.skipif(not os.path.exists('/bin/true'), reason="needs /bin/true")
+def test_cache_hit_imports_stay_small(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    config_file = cache_dir.join('bincache.conf')
+    config_file.write("max_size = 1G\ncompression = zlib\n")
+    # an old enough bincache.conf is parsed once and then read from config.cache
+    os.utime(str(config_file), (time.time() - 60, time.time() - 60))
+    run_bincache(tmpdir, '/bin/true')
+    run_bincache(tmpdir, '/bin/true')
+    imports = parse_importtime(run_bincache(tmpdir, '/bin/true').stderr.decode())
+
+    assert 'bincache.cli' in imports
+    assert [module for module in MISS_ONLY_MODULES if module in imports] == []
+    assert imports['bincache.cli'][1] < IMPORT_BUDGET_US
@@ -0,0 +1,100 @@
+import os
+import sys
+import subprocess
+import pytest
+from bincache import config
+from bincache import stats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    cache_dir.join('bincache.conf').write("stats = true\n")
+    monkeypatch.setenv('BINCACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(config, '_config', None)
+    yield cache_dir
+    config._config = None
+
+def test_record_and_read(cache_dir):
+    stats.record('miss', 'aa11', 0, 1.5)
+    stats.record('hit', 'aa11', 100, 1.5)
+    stats.record('hit', 'aa11', 100, 1.5)
+    stats.record('hit', 'bb22', 10, 0.25)
+    stats.record('uncacheable', None, 0, 0.5)
+    summary = stats.read_stats(str(cache_dir))
+    assert (summary['hits'], summary['misses'], summary['uncacheable']) == (3, 1, 1)
+    assert summary['bytes_served'] == 210
+    assert summary['saved_ms'] == 3250
+    assert summary['run_ms'] == 2000
+    assert stats.hot_keys(summary, 1) == [('aa11', 2, 3.0)]
+
+def test_journals_are_rotated_and_folded(cache_dir, monkeypatch):
+    monkeypatch.setattr(stats, 'JOURNAL_ROTATE_SIZE', stats.RECORD.size * 3)
+    stats_dir = stats.get_stats_dir(str(cache_dir))
+    for _ in range(7):
+        stats.record('hit', 'aa11', 1, 0.001)
+    live, rotated = stats.list_journals(stats_dir)
+    assert len(rotated) == 2
+    # case: 轮转后的日志稳定之后才合并进汇总
+    monkeypatch.setattr(stats, 'JOURNAL_SETTLE_SECONDS', -1)
+    stats.compact(stats_dir)
+    assert stats.list_journals(stats_dir)[1] == []
+    assert stats.read_summary(stats_dir)['hits'] == 6
+    assert stats.read_stats(str(cache_dir))['hits'] == 7
+
+def test_summary_keeps_hottest_keys(cache_dir, monkeypatch):
+    monkeypatch.setattr(stats, 'HOT_KEYS_KEPT', 2)
+    stats_dir = stats.get_stats_dir(str(cache_dir))
+    summary = stats.new_summary()
+    summary['keys'] = {'a': [1, 0], 'b': [3, 0], 'c': [2, 0]}
+    os.makedirs(stats_dir)
+    stats.write_summary(stats_dir, summary)
+    assert stats.read_summary(stats_dir)['keys'] == {'b': [3, 0], 'c': [2, 0]}
+
+def test_openmetrics_export(cache_dir, tmpdir):
+    stats.record('hit', 'aa11', 100, 1.5)
+    path = str(tmpdir.join('bincache.prom'))
+    stats.export_openmetrics(stats.read_stats(str(cache_dir)), path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'bincache_hits_total 1' in lines
+    assert 'bincache_served_bytes_total 100' in lines
+    assert 'bincache_saved_seconds_total 1.5' in lines
+    assert '# UNIT bincache_saved_seconds seconds' in lines
+    assert lines[-1] == '# EOF'
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')]
+
+def test_record_is_off_by_default(cache_dir, monkeypatch):
+    cache_dir.join('bincache.conf').write("stats = false\n")
+    from bincache.cli import record_stats
+    record_stats('hit', 'aa11', 1, 1)
+    assert not os.path.exists(stats.get_stats_dir(str(cache_dir)))
+
+def run_bincache(cache_dir, *argv):
+    env = dict(os.environ, BINCACHE_DIR=str(cache_dir), PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-m', 'bincache.cli', *argv], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+@pytest.mark.skipif(not os.path.exists('/bin/sleep') or not os.path.exists('/bin/echo'), reason="needs /bin/sleep and /bin/echo")
+def test_hits_count_the_original_runtime(cache_dir):
+    run_bincache(cache_dir, 'sleep', '0.2')
+    run_bincache(cache_dir, 'sleep', '0.2')
+    run_bincache(cache_dir, 'echo', 'hello')
+    run_bincache(cache_dir, 'echo', 'hello')
+    summary = stats.read_stats(str(cache_dir))
+    assert (summary['hits'], summary['misses']) == (2, 2)
+    assert summary['saved_ms'] >= 200
+    assert summary['bytes_served'] == len(b'hello\n')
+    report = run_bincache(cache_dir, '--show-stats').decode()
+    assert 'hits:              2 (50.0%)' in report
+    assert 'hottest keys:' in report
+    assert b'bincache_misses_total 2' in run_bincache(cache_dir, '--export-stats', '-')
+
+def test_concurrent_processes_lose_no_records(cache_dir):
+    code = ("import sys\nfrom bincache import stats\n"
+            "for _ in range(200):\n    stats.record('hit', 'aa11', 1, 0)\n")
+    env = dict(os.environ, BINCACHE_DIR=str(cache_dir), PYTHONPATH=ROOT)
+    processes = [subprocess.Popen([sys.executable, '-c', code], env=env) for _ in range(8)]
+    assert [process.wait() for process in processes] == [0] * 8
+    assert stats.read_stats(str(cache_dir))['hits'] == 1600